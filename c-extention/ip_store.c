@@ -8,328 +8,3520 @@
  *      ...
  *      (10000, 4294967295, area*, isp*)
  *
- *    Use binary search to retrieve ip information. */
+ *    Use binary search to retrieve ip information. IPv6 ranges are kept in
+ *    a separate db of 128-bit integers loaded by load6(), search() tells the
+ *    two apart by the address family.
+ *
+ *    Each IPStore object holds an independent database, the module level
+ *    functions work on the default one, ip_store.default.
+ *
+ *    The database can be dumped to a compact binary file and mapped back
+ *    read-only, so that forked workers share the same pages instead of
+ *    holding their own copy. It can also be published to POSIX shared
+ *    memory by a loader process, the workers attached to it pick up each
+ *    new generation on their next call. */
 
 #include <Python.h>
+#include <stdint.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <errno.h>
 #include <arpa/inet.h>
 
 #if PY_MAJOR_VERSION >= 3
 #define IS_PY3K
 #endif
 
+/* A database is kept as columns rather than an array of records, so that
+ * begin and end are dense arrays of uint32 for the binary search, and so
+ * that the same layout can be used either from the heap or directly from a
+ * memory mapped file (see ip_store_dump for the file format). Area and isp
+ * are stored as indexes into the values table. */
+typedef struct{
+    Py_ssize_t size;
+    uint32_t *begin;
+    uint32_t *end;
+    uint32_t *area;
+    uint32_t *isp;
+    PyObject **values;
+    Py_ssize_t n_values;
+    void *map;            /* mmap'd file backing the columns, or NULL */
+    size_t map_len;
+    uint32_t *jump;       /* optional index, see build_index */
+    Py_ssize_t refs;      /* the owning store and running bulk searches */
+}ip_db;
+
+#define JUMP_SIZE 65536
+
+/* IPv6 segments are kept in a separate database of the same layout, with
+ * 128-bit begin and end */
+typedef struct{
+    uint64_t hi;
+    uint64_t lo;
+}ip6_t;
+
+#define IP6_LT(a, b) ((a).hi < (b).hi || ((a).hi == (b).hi && (a).lo < (b).lo))
+
+typedef struct{
+    Py_ssize_t size;
+    ip6_t *begin;
+    ip6_t *end;
+    uint32_t *area;
+    uint32_t *isp;
+    PyObject **values;
+    Py_ssize_t n_values;
+    Py_ssize_t refs;
+}ip6_db;
+
+/* Optional cache of recent IPv4 lookups, keyed on the parsed address. It
+ * is open addressing over mask + 1 entries: an address lives in one of the
+ * CACHE_PROBES slots from its home slot on. A hit moves the entry to the
+ * front of that window and a miss pushes the last one out, so each window
+ * is kept in LRU order. All entries are invalidated at once by bumping
+ * gen. */
+typedef struct{
+    uint32_t ip;
+    uint32_t gen;
+    Py_ssize_t index;     /* segment index, -1 for a miss */
+}cache_entry;
+
+typedef struct{
+    cache_entry *entries;
+    Py_ssize_t mask;
+    uint32_t gen;
+    Py_ssize_t hits;
+    Py_ssize_t misses;
+}ip_cache;
+
+#define CACHE_PROBES 4
+#define CACHE_MIN_SIZE 16
+
+/* A range corrected by insert_range(), update_range() or delete_range(),
+ * waiting to be merged into the db. See add_patch. */
+typedef struct{
+    uint32_t begin;
+    uint32_t end;
+    PyObject *area;       /* NULL for a deleted range */
+    PyObject *isp;
+}ip_patch;
+
+/* patches are merged into the db once there are more than this */
+#define MAX_PATCHES 4096
+
+/* The db as patched, where it differs from the db: the patches with a value
+ * and the parts of segments of the db the patches leave, in order. Built
+ * from the patches in O(p log n) when a position in the patched db is
+ * needed, dropped whenever the db or the patches change. */
+typedef struct{
+    uint32_t begin;
+    uint32_t end;
+    Py_ssize_t seg;       /* the segment it is part of, -1 for a patch */
+    Py_ssize_t patch;     /* the patch if seg is -1 */
+    Py_ssize_t pos;       /* position in the patched db */
+}view_item;
+
+/* segments [lo, hi] of the db intersect patches, before of them earlier */
+typedef struct{
+    Py_ssize_t lo;
+    Py_ssize_t hi;
+    Py_ssize_t before;
+}view_run;
+
+typedef struct{
+    int valid;
+    view_item *items;
+    Py_ssize_t n_items;
+    view_run *runs;
+    Py_ssize_t n_runs;
+    Py_ssize_t n_touched;
+}patch_view;
+
+/* header of the on-disk format, followed by the begin, end, area, isp
+ * columns, n_values + 1 string offsets and the utf-8 string data */
+typedef struct{
+    char magic[8];
+    uint32_t byte_order;
+    uint32_t version;
+    uint32_t size;
+    uint32_t n_values;
+    uint64_t strings_len;
+}ipdb_header;
+
+#define IPDB_MAGIC "IPSTORE1"
+#define IPDB_BYTE_ORDER 0x01020304
+#define IPDB_VERSION 1
+
+/* Control block of a shared db, see ip_store_publish. Each generation is a
+ * separate shared memory object in the format above. */
+typedef struct{
+    char magic[8];
+    uint32_t byte_order;
+    uint32_t version;
+    uint64_t generation;  /* current generation, 0 if none published yet */
+}ipshm_header;
+
+#define IPSHM_MAGIC "IPSHMCT1"
+#define IPSHM_VERSION 1
+#define IPSHM_PATH_MAX 256
+
+/* a shared db followed by a store */
+typedef struct{
+    ipshm_header *header;   /* mapped read-only, NULL if not attached */
+    char *name;
+    uint64_t generation;    /* the generation of the store's db */
+}ip_shm;
+
+/* Each IPStore holds its own database, so several databases can be used
+ * side by side, and a new one can be built aside and swapped in. The module
+ * level functions work on a default store.
+ *
+ *    Databases are reference counted under the GIL. A bulk search holds a
+ * reference while it runs without the GIL, so that load() or swap() in
+ * another thread can replace the database without freeing it under the
+ * search.
+ *
+ *    Small corrections are kept as patches over the db rather than
+ * rebuilding it each time. Searches look at them first, positions are
+ * those of the patched db, as told by the patch view. They are merged into
+ * a new db once there are too many, on compact(), or before the db is
+ * written out. */
 typedef struct{
-    unsigned long begin;
-    unsigned long end;
-    PyObject * area;
-    PyObject * isp;
-}ip_seg;
+    PyObject_HEAD
+    ip_db *db;
+    ip6_db *db6;
+    int use_index;
+    ip_cache cache;
+    ip_patch *patches;    /* sorted, non-overlapping, override the db */
+    Py_ssize_t n_patches;
+    Py_ssize_t patches_cap;
+    patch_view view;
+    ip_shm shm;
+}ip_store_obj;
+
+/* batches at least this large are searched without the GIL */
+#define NOGIL_BATCH 1024
+
+/* marks an IPv6 address in a batch of IPv4 addresses */
+#define IP6_MARK UINT64_MAX
+
+
+/* return the C string of o, or NULL with an exception set */
+static char *
+inner_as_string(PyObject *o){
+    char *ip_addr;
+
+#ifdef IS_PY3K
+    if(PyUnicode_CheckExact(o)){
+        ip_addr = PyUnicode_AsUTF8(o);
+    } else if (PyBytes_CheckExact(o)){
+        ip_addr = PyBytes_AsString(o);
+    } else if (PyByteArray_CheckExact(o)){
+        ip_addr =  PyByteArray_AsString(o);
+#else
+    if(PyUnicode_CheckExact(o) || PyString_CheckExact(o)){
+        ip_addr =  PyString_AsString(o);
+    } else if (PyByteArray_CheckExact(o)){
+        ip_addr = PyByteArray_AsString(o);
+#endif
+    } else {
+        PyErr_SetString(PyExc_TypeError, "should be built-in string/bytes/byte array");
+        return NULL;
+    }
+
+    return ip_addr;
+}
+
+
+static int
+inner_atohl(PyObject *o, unsigned long *ip_ul){
+    struct in_addr buf;
+    char *ip_addr;
+
+    ip_addr = inner_as_string(o);
+    if (ip_addr == NULL){
+        return 0;
+    }
+
+    if (inet_aton(ip_addr, &buf)){
+        *ip_ul = ntohl(buf.s_addr);
+        return 1;
+    }else{
+        PyErr_SetString(PyExc_ValueError,
+                        "illegal IP address string");
+        return 0;
+    }
+}
+
+
+static void
+inner_unpack6(const unsigned char *p, ip6_t *ip6){
+    int i;
+
+    ip6->hi = ip6->lo = 0;
+    for(i = 0; i < 8; i++){
+        ip6->hi = (ip6->hi << 8) | p[i];
+        ip6->lo = (ip6->lo << 8) | p[i + 8];
+    }
+}
+
+
+/* convert an int, or 4 packed bytes in network byte order given as a
+ * memoryview or any buffer but bytes and bytearray, without going through
+ * a string. Return 1 on success, 0 on error, -1 if o is neither */
+static int
+inner_as_ip4(PyObject *o, unsigned long *ip_ul){
+    const unsigned char *p;
+    Py_buffer view;
+
+#ifdef IS_PY3K
+    if (PyLong_Check(o)){
+        *ip_ul = PyLong_AsUnsignedLong(o);
+        if (*ip_ul == (unsigned long)-1 && PyErr_Occurred()){
+            return 0;
+        }
+#else
+    if (PyInt_Check(o) || PyLong_Check(o)){
+        *ip_ul = PyInt_AsUnsignedLongMask(o);
+#endif
+        if (*ip_ul > 0xFFFFFFFFUL){
+            PyErr_SetString(PyExc_OverflowError, "ip address overflow");
+            return 0;
+        }
+        return 1;
+    }
+
+    /* bytes and bytearray are text, b"1234" being 0.0.4.210 as "1234" */
+    if (PyObject_CheckBuffer(o) && !PyBytes_Check(o) && !PyByteArray_Check(o)){
+        if (PyObject_GetBuffer(o, &view, PyBUF_C_CONTIGUOUS) < 0){
+            return 0;
+        }
+        if (view.len != 4){
+            PyBuffer_Release(&view);
+            PyErr_SetString(PyExc_ValueError, "need 4 bytes for a packed address");
+            return 0;
+        }
+        p = (const unsigned char *)view.buf;
+        *ip_ul = ((unsigned long)p[0] << 24) | ((unsigned long)p[1] << 16)
+                 | ((unsigned long)p[2] << 8) | p[3];
+        PyBuffer_Release(&view);
+        return 1;
+    }
+
+    return -1;
+}
+
+
+/* Parse o as an IPv4 or IPv6 address. An int or a buffer of 4 packed bytes
+ * is taken as IPv4 as it is, a string containing ':' as IPv6. Return AF_INET and
+ * set ip_ul, or return AF_INET6 and set ip6. Return 0 on error. */
+static int
+inner_aton(PyObject *o, unsigned long *ip_ul, ip6_t *ip6){
+    struct in_addr buf4;
+    unsigned char buf[16];
+    char *ip_addr;
+    int res;
+
+    if (!PyUnicode_CheckExact(o)){
+        res = inner_as_ip4(o, ip_ul);
+        if (res >= 0){
+            return res ? AF_INET : 0;
+        }
+    }
+
+    ip_addr = inner_as_string(o);
+    if (ip_addr == NULL){
+        return 0;
+    }
+
+    if (strchr(ip_addr, ':') == NULL){
+        if (inet_aton(ip_addr, &buf4)){
+            *ip_ul = ntohl(buf4.s_addr);
+            return AF_INET;
+        }
+    } else if (inet_pton(AF_INET6, ip_addr, buf) == 1){
+        inner_unpack6(buf, ip6);
+        return AF_INET6;
+    }
+
+    PyErr_SetString(PyExc_ValueError,
+                    "illegal IP address string");
+    return 0;
+}
+
+
+/* convert a Python int in [0, 2**128) */
+static int
+inner_as_ip6(PyObject *o, ip6_t *ip6){
+    PyObject *hi, *shift;
+
+    if(!PyLong_Check(o)){
+        PyErr_Format(PyExc_TypeError,
+                     "expected int, %s found",
+                     Py_TYPE(o)->tp_name);
+        return 0;
+    }
+
+    shift = PyLong_FromLong(64);
+    if (shift == NULL){
+        return 0;
+    }
+    hi = PyNumber_Rshift(o, shift);
+    Py_DECREF(shift);
+    if (hi == NULL){
+        return 0;
+    }
+
+    /* negative numbers give a negative hi, which overflows too */
+    ip6->hi = PyLong_AsUnsignedLongLong(hi);
+    Py_DECREF(hi);
+    if (ip6->hi == (uint64_t)-1 && PyErr_Occurred()){
+        return 0;
+    }
+    ip6->lo = PyLong_AsUnsignedLongLongMask(o);
+    return 1;
+}
+
+
+static PyObject *
+ip6_as_long(ip6_t ip6){
+    PyObject *hi, *lo, *shift, *tmp, *result = NULL;
+
+    hi = PyLong_FromUnsignedLongLong(ip6.hi);
+    lo = PyLong_FromUnsignedLongLong(ip6.lo);
+    shift = PyLong_FromLong(64);
+    if (hi != NULL && lo != NULL && shift != NULL){
+        tmp = PyNumber_Lshift(hi, shift);
+        if (tmp != NULL){
+            result = PyNumber_Or(tmp, lo);
+            Py_DECREF(tmp);
+        }
+    }
+    Py_XDECREF(hi);
+    Py_XDECREF(lo);
+    Py_XDECREF(shift);
+    return result;
+}
+
+
+static PyObject *
+ip_store_atohl(PyObject *self, PyObject *o){
+
+    unsigned long ip_ul;
+
+    if(inner_atohl(o, &ip_ul)){
+        return PyLong_FromUnsignedLong(ip_ul);
+    }else{
+        return NULL;
+    }
+}
+
+
+static void
+release_db(ip_db *db){
+    Py_ssize_t i;
+
+    if (--db->refs > 0){
+        return;
+    }
+
+    if (db->values != NULL){
+        for(i = 0; i < db->n_values; i++){
+            Py_XDECREF(db->values[i]);
+        }
+        PyMem_Free(db->values);
+    }
+    if (db->map != NULL){
+        munmap(db->map, db->map_len);
+    } else {
+        PyMem_Free(db->begin);
+    }
+    PyMem_Free(db->jump);
+    PyMem_Free(db);
+}
+
+
+static void
+release_db6(ip6_db *db){
+    Py_ssize_t i;
+
+    if (--db->refs > 0){
+        return;
+    }
+
+    if (db->values != NULL){
+        for(i = 0; i < db->n_values; i++){
+            Py_XDECREF(db->values[i]);
+        }
+        PyMem_Free(db->values);
+    }
+    PyMem_Free(db->begin);
+    PyMem_Free(db->area);
+    PyMem_Free(db);
+}
+
+
+/* allocate the four columns in one block, see values_from_list for the
+ * values table */
+static ip_db *
+alloc_db(Py_ssize_t size){
+    ip_db *db;
+
+    db = (ip_db *)PyMem_Malloc(sizeof(ip_db));
+    if (db == NULL){
+        PyErr_NoMemory();
+        return NULL;
+    }
+    memset(db, 0, sizeof(ip_db));
+    db->refs = 1;
+    if (size == 0){
+        return db;
+    }
+
+    db->begin = (uint32_t *)PyMem_Malloc(4 * size * sizeof(uint32_t));
+    if (db->begin == NULL){
+        PyMem_Free(db);
+        PyErr_NoMemory();
+        return NULL;
+    }
+
+    db->size = size;
+    db->end = db->begin + size;
+    db->area = db->end + size;
+    db->isp = db->area + size;
+    return db;
+}
+
+
+static ip6_db *
+alloc_db6(Py_ssize_t size){
+    ip6_db *db;
+
+    db = (ip6_db *)PyMem_Malloc(sizeof(ip6_db));
+    if (db == NULL){
+        PyErr_NoMemory();
+        return NULL;
+    }
+    memset(db, 0, sizeof(ip6_db));
+    db->refs = 1;
+    if (size == 0){
+        return db;
+    }
+
+    db->begin = (ip6_t *)PyMem_Malloc(2 * size * sizeof(ip6_t));
+    db->area = (uint32_t *)PyMem_Malloc(2 * size * sizeof(uint32_t));
+    if (db->begin == NULL || db->area == NULL){
+        PyMem_Free(db->begin);
+        PyMem_Free(db->area);
+        PyMem_Free(db);
+        PyErr_NoMemory();
+        return NULL;
+    }
+    db->end = db->begin + size;
+    db->isp = db->area + size;
+    return db;
+}
+
+
+/* return a borrowed reference, or NULL if the code is corrupted */
+static PyObject *
+get_value(PyObject **values, Py_ssize_t n_values, uint32_t code){
+    if (code >= (uint32_t)n_values){
+        PyErr_SetString(PyExc_ValueError, "corrupted value index");
+        return NULL;
+    }
+    return values[code];
+}
+
+/* work on both ip_db and ip6_db */
+#define GET_VALUE(db, code) get_value((db)->values, (db)->n_values, code)
+#define DB_VALUE(db, i) build_value((db)->values, (db)->n_values, \
+                                    (db)->area[i], (db)->isp[i])
+
+
+/* the key of value in the codes dict, (type, value) for values other than
+ * str, so that 1, 1.0 and True stay apart */
+static PyObject *
+value_key(PyObject *value){
+    if (PyUnicode_CheckExact(value)){
+        Py_INCREF(value);
+        return value;
+    }
+    return PyTuple_Pack(2, (PyObject *)Py_TYPE(value), value);
+}
+
+
+/*     Return the code of value in the values list, adding it if new. Equal
+ * values share one code and one object, which is what keeps millions of
+ * per-row duplicates from staying resident. Unhashable values are kept as
+ * they are. Return -1 on error. */
+static long
+intern_value(PyObject *codes, PyObject *values, PyObject *value){
+    PyObject *key, *code;
+    long result = -1;
+
+    key = value_key(value);
+    if (key == NULL){
+        return -1;
+    }
+
+    code = PyDict_GetItemWithError(codes, key);
+    if (code != NULL){
+        result = PyLong_AsLong(code);
+    } else if (!PyErr_Occurred()){
+        code = PyLong_FromSsize_t(PyList_GET_SIZE(values));
+        if (code != NULL && PyDict_SetItem(codes, key, code) == 0
+            && PyList_Append(values, value) == 0){
+            result = (long)(PyList_GET_SIZE(values) - 1);
+        }
+        Py_XDECREF(code);
+    }
+
+    if (result < 0 && PyErr_ExceptionMatches(PyExc_TypeError)
+        && PyObject_Hash(value) == -1){
+        PyErr_Clear();
+        if (PyList_Append(values, value) == 0){
+            result = (long)(PyList_GET_SIZE(values) - 1);
+        }
+    }
+    Py_DECREF(key);
+    return result;
+}
+
+
+/* Append an existing values table to values, with its codes unchanged, and
+ * add them to codes so that intern_value() then reuses them. Return 0 on
+ * error. */
+static int
+intern_table(PyObject *codes, PyObject *values, PyObject **table,
+             Py_ssize_t n_values){
+    PyObject *key, *code;
+    Py_ssize_t i;
+    int ok;
+
+    for(i = 0; i < n_values; i++){
+        if (PyList_Append(values, table[i]) < 0){
+            return 0;
+        }
+        key = value_key(table[i]);
+        if (key == NULL){
+            return 0;
+        }
+        ok = (PyDict_GetItemWithError(codes, key) != NULL);
+        if (!ok && !PyErr_Occurred()){
+            code = PyLong_FromSsize_t(i);
+            ok = (code != NULL && PyDict_SetItem(codes, key, code) == 0);
+            Py_XDECREF(code);
+        }
+        Py_DECREF(key);
+        /* unhashable values are not interned */
+        if (!ok && PyErr_ExceptionMatches(PyExc_TypeError)
+            && PyObject_Hash(table[i]) == -1){
+            PyErr_Clear();
+            ok = 1;
+        }
+        if (!ok){
+            return 0;
+        }
+    }
+    return 1;
+}
+
+
+/* return a new values table holding a reference to each item of list */
+static PyObject **
+values_from_list(PyObject *list){
+    PyObject **values;
+    Py_ssize_t i, n = PyList_GET_SIZE(list);
+
+    values = (PyObject **)PyMem_Malloc((n ? n : 1) * sizeof(PyObject *));
+    if (values == NULL){
+        PyErr_NoMemory();
+        return NULL;
+    }
+    for(i = 0; i < n; i++){
+        values[i] = PyList_GET_ITEM(list, i);
+        Py_INCREF(values[i]);
+    }
+    return values;
+}
+
+
+/* (begin, end, area, isp), area and isp borrowed, NULL if not found */
+static PyObject *
+new_record(uint32_t begin_ip, uint32_t end_ip, PyObject *area, PyObject *isp){
+    PyObject *begin, *end, *record;
+
+    if (area == NULL || isp == NULL){
+        return NULL;
+    }
+
+    record = PyTuple_New(4);
+    if (record == NULL){
+        return NULL;
+    }
+
+#ifdef IS_PY3K
+    begin = PyLong_FromUnsignedLong(begin_ip);
+    end = PyLong_FromUnsignedLong(end_ip);
+#else
+    begin = PyInt_FromLong(begin_ip);
+    end = PyInt_FromLong(end_ip);
+#endif
+    if(begin == NULL || end == NULL){
+        Py_XDECREF(begin);
+        Py_XDECREF(end);
+        Py_XDECREF(record);
+        return NULL;
+    }
+    Py_INCREF(area);
+    Py_INCREF(isp);
+
+    PyTuple_SetItem(record, 0, begin);
+    PyTuple_SetItem(record, 1, end);
+    PyTuple_SetItem(record, 2, area);
+    PyTuple_SetItem(record, 3, isp);
+
+    return record;
+}
+
+
+static PyObject *
+build_record(ip_db *db, Py_ssize_t i){
+    return new_record(db->begin[i], db->end[i], GET_VALUE(db, db->area[i]),
+                      GET_VALUE(db, db->isp[i]));
+}
+
+
+static PyObject *
+build_record6(ip6_db *db, Py_ssize_t i){
+    PyObject *begin, *end, *area, *isp, *record;
+
+    area = GET_VALUE(db, db->area[i]);
+    isp = GET_VALUE(db, db->isp[i]);
+    if (area == NULL || isp == NULL){
+        return NULL;
+    }
+
+    record = PyTuple_New(4);
+    if (record == NULL){
+        return NULL;
+    }
+
+    begin = ip6_as_long(db->begin[i]);
+    end = ip6_as_long(db->end[i]);
+    if(begin == NULL || end == NULL){
+        Py_XDECREF(begin);
+        Py_XDECREF(end);
+        Py_XDECREF(record);
+        return NULL;
+    }
+    Py_INCREF(area);
+    Py_INCREF(isp);
+
+    PyTuple_SetItem(record, 0, begin);
+    PyTuple_SetItem(record, 1, end);
+    PyTuple_SetItem(record, 2, area);
+    PyTuple_SetItem(record, 3, isp);
+
+    return record;
+}
+
+
+static PyObject *
+build_value(PyObject **values, Py_ssize_t n_values, uint32_t area_code,
+            uint32_t isp_code){
+    PyObject *area, *isp, *result;
+
+    area = get_value(values, n_values, area_code);
+    isp = get_value(values, n_values, isp_code);
+    if (area == NULL || isp == NULL){
+        return NULL;
+    }
+
+    result = PyTuple_New(2);
+    if (result == NULL){
+        return NULL;
+    }
+
+    Py_INCREF(area);
+    Py_INCREF(isp);
+    PyTuple_SetItem(result, 0, area);
+    PyTuple_SetItem(result, 1, isp);
+
+    return result;
+}
+
+
+/* index of the first segment in [lo, hi) whose end >= ip, hi if none */
+static Py_ssize_t
+lower_bound(ip_db *db, unsigned long ip_ul, Py_ssize_t lo, Py_ssize_t hi){
+    Py_ssize_t mid;
+
+    while(lo < hi){
+        mid = lo + (hi - lo)/2;
+        if (db->end[mid] < ip_ul){
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+
+/* index of the first segment in [lo, hi) whose begin > ip, hi if none */
+static Py_ssize_t
+upper_bound(ip_db *db, unsigned long ip_ul, Py_ssize_t lo, Py_ssize_t hi){
+    Py_ssize_t mid;
+
+    while(lo < hi){
+        mid = lo + (hi - lo)/2;
+        if (db->begin[mid] > ip_ul){
+            hi = mid;
+        } else {
+            lo = mid + 1;
+        }
+    }
+    return lo;
+}
+
+
+/* Same as lower_bound(db, ip_ul, pos, db->size), but gallops forward from
+ * pos first. When the probes are sorted the answer is usually close to the
+ * previous one, so a batch is resolved in a single merge-style pass. */
+static Py_ssize_t
+gallop(ip_db *db, unsigned long ip_ul, Py_ssize_t pos){
+    Py_ssize_t step = 1, lo = pos;
+
+    while(pos + step < db->size && db->end[pos + step] < ip_ul){
+        lo = pos + step + 1;
+        step <<= 1;
+    }
+    if (pos + step < db->size){
+        return lower_bound(db, ip_ul, lo, pos + step + 1);
+    }
+    return lower_bound(db, ip_ul, lo, db->size);
+}
+
+
+/* Build the jump table: jump[p] is the index of the first segment whose end
+ * >= p << 16, so a lookup of ip only has to search [jump[p], jump[p+1]) for
+ * p = ip >> 16. The table is 256KB and stays in cache, and each lookup then
+ * touches a few cache lines of the end column instead of ~log2(size). */
+static int
+build_index(ip_db *db){
+    Py_ssize_t p, pos = 0;
+    uint32_t *jump;
+
+    if (db->size == 0 || db->jump != NULL){
+        return 1;
+    }
+
+    jump = (uint32_t *)PyMem_Malloc((JUMP_SIZE + 1) * sizeof(uint32_t));
+    if (jump == NULL){
+        PyErr_NoMemory();
+        return 0;
+    }
+
+    for(p = 0; p < JUMP_SIZE; p++){
+        pos = lower_bound(db, (unsigned long)p << 16, pos, db->size);
+        jump[p] = (uint32_t)pos;
+    }
+    jump[JUMP_SIZE] = (uint32_t)db->size;
+    /* only published once complete */
+    db->jump = jump;
+    return 1;
+}
+
+
+/* lower_bound over the whole db, narrowed by the jump table if any */
+static Py_ssize_t
+find(ip_db *db, unsigned long ip_ul){
+    if (db->jump != NULL){
+        return lower_bound(db, ip_ul, db->jump[ip_ul >> 16],
+                           db->jump[(ip_ul >> 16) + 1]);
+    }
+    return lower_bound(db, ip_ul, 0, db->size);
+}
+
+
+static void
+cache_clear(ip_cache *cache){
+    if (cache->entries == NULL){
+        return;
+    }
+    if (++cache->gen == 0){
+        memset(cache->entries, 0, (cache->mask + 1) * sizeof(cache_entry));
+        cache->gen = 1;
+    }
+}
+
+
+/* find() plus the check of begin, through the cache if any. Return the
+ * segment index, or -1 if ip_ul is in no segment. */
+static Py_ssize_t
+cached_find(ip_cache *cache, ip_db *db, unsigned long ip_ul){
+    cache_entry *window[CACHE_PROBES], found;
+    Py_ssize_t home, i, j;
+
+    if (cache->entries == NULL){
+        i = find(db, ip_ul);
+        return (i < db->size && db->begin[i] <= ip_ul) ? i : -1;
+    }
+
+    home = (Py_ssize_t)(((uint64_t)ip_ul * 0x9E3779B97F4A7C15ULL) >> 32);
+    for(j = 0; j < CACHE_PROBES; j++){
+        window[j] = cache->entries + ((home + j) & cache->mask);
+    }
+
+    for(j = 0; j < CACHE_PROBES; j++){
+        if (window[j]->gen == cache->gen && window[j]->ip == ip_ul){
+            break;
+        }
+    }
+
+    if (j < CACHE_PROBES){
+        cache->hits++;
+        found = *window[j];
+    } else {
+        cache->misses++;
+        j = CACHE_PROBES - 1;
+        i = find(db, ip_ul);
+        found.ip = (uint32_t)ip_ul;
+        found.gen = cache->gen;
+        found.index = (i < db->size && db->begin[i] <= ip_ul) ? i : -1;
+    }
+
+    for(; j > 0; j--){
+        *window[j] = *window[j - 1];
+    }
+    *window[0] = found;
+    return found.index;
+}
+
+
+/* index of the first patch whose end >= ip, n_patches if none */
+static Py_ssize_t
+patch_bound(ip_store_obj *store, unsigned long ip_ul){
+    Py_ssize_t lo = 0, hi = store->n_patches, mid;
+
+    while(lo < hi){
+        mid = lo + (hi - lo)/2;
+        if (store->patches[mid].end < ip_ul){
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+
+static void
+view_clear(ip_store_obj *store){
+    PyMem_Free(store->view.items);
+    PyMem_Free(store->view.runs);
+    memset(&store->view, 0, sizeof(patch_view));
+}
+
+
+static void
+clear_patches(ip_store_obj *store){
+    ip_patch *patches = store->patches;
+    Py_ssize_t i, n = store->n_patches;
+
+    view_clear(store);
+
+    /* detached first, releasing a value may run arbitrary code */
+    store->patches = NULL;
+    store->n_patches = store->patches_cap = 0;
+    for(i = 0; i < n; i++){
+        Py_XDECREF(patches[i].area);
+        Py_XDECREF(patches[i].isp);
+    }
+    PyMem_Free(patches);
+}
+
+
+/*     Make [begin, end] map to (area, isp), or to nothing if area is NULL,
+ * whatever the db and the earlier patches said. Patches partly covered by
+ * the new one are cut, so that they stay sorted and non-overlapping, the
+ * ones fully covered are dropped. Return 0 on error. */
+static int
+add_patch(ip_store_obj *store, uint32_t begin, uint32_t end, PyObject *area,
+          PyObject *isp){
+    ip_patch piece[3], *patches, *removed = NULL;
+    Py_ssize_t lo, hi, i, n = 0, n_removed, cap;
+
+    lo = patch_bound(store, begin);
+    for(hi = lo; hi < store->n_patches && store->patches[hi].begin <= end; hi++);
+    n_removed = hi - lo;
+
+    if (n_removed > 0 && store->patches[lo].begin < begin){
+        piece[n] = store->patches[lo];
+        piece[n++].end = begin - 1;
+    }
+    piece[n].begin = begin;
+    piece[n].end = end;
+    piece[n].area = area;
+    piece[n++].isp = isp;
+    if (n_removed > 0 && store->patches[hi - 1].end > end){
+        piece[n] = store->patches[hi - 1];
+        piece[n++].begin = end + 1;
+    }
+
+    cap = store->n_patches - n_removed + n;
+    if (cap > store->patches_cap){
+        cap = (cap < 2 * store->patches_cap) ? 2 * store->patches_cap : cap + 16;
+        patches = (ip_patch *)PyMem_Realloc(store->patches, cap * sizeof(ip_patch));
+        if (patches == NULL){
+            PyErr_NoMemory();
+            return 0;
+        }
+        store->patches = patches;
+        store->patches_cap = cap;
+    }
+    if (n_removed > 0){
+        removed = (ip_patch *)PyMem_Malloc(n_removed * sizeof(ip_patch));
+        if (removed == NULL){
+            PyErr_NoMemory();
+            return 0;
+        }
+        memcpy(removed, store->patches + lo, n_removed * sizeof(ip_patch));
+    }
+
+    for(i = 0; i < n; i++){
+        Py_XINCREF(piece[i].area);
+        Py_XINCREF(piece[i].isp);
+    }
+    view_clear(store);
+    memmove(store->patches + lo + n, store->patches + hi,
+            (store->n_patches - hi) * sizeof(ip_patch));
+    memcpy(store->patches + lo, piece, n * sizeof(ip_patch));
+    store->n_patches += n - n_removed;
+
+    for(i = 0; i < n_removed; i++){
+        Py_XDECREF(removed[i].area);
+        Py_XDECREF(removed[i].isp);
+    }
+    PyMem_Free(removed);
+    return 1;
+}
+
+
+/* whether no address of [begin, end] is in a segment, patches included */
+static int
+range_is_free(ip_store_obj *store, uint32_t begin, uint32_t end){
+    ip_db *db = store->db;
+    ip_patch *p;
+    uint64_t ip = begin, stop;
+    Py_ssize_t i, j;
+
+    j = patch_bound(store, begin);
+    while(ip <= end){
+        p = store->patches + j;
+        if (j < store->n_patches && p->begin <= ip){
+            if (p->area != NULL){
+                return 0;
+            }
+            ip = (uint64_t)p->end + 1;
+            j++;
+            continue;
+        }
+
+        /* [ip, stop] is not patched, it is as in the db */
+        stop = (j < store->n_patches && p->begin <= end) ? p->begin - 1 : end;
+        i = find(db, (unsigned long)ip);
+        if (i < db->size && db->begin[i] <= stop){
+            return 0;
+        }
+        ip = stop + 1;
+    }
+    return 1;
+}
+
+
+/* number of segments of the db intersecting patches before segment k */
+static Py_ssize_t
+touched_before(patch_view *view, Py_ssize_t k){
+    Py_ssize_t lo = 0, hi = view->n_runs, mid;
+    view_run *run;
+
+    while(lo < hi){
+        mid = lo + (hi - lo)/2;
+        if (view->runs[mid].lo < k){
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    if (lo == 0){
+        return 0;
+    }
+    run = view->runs + lo - 1;
+    return run->before + ((k <= run->hi) ? k : run->hi + 1) - run->lo;
+}
+
+
+/* index of the first item whose begin > ip, n_items if none */
+static Py_ssize_t
+view_upper(patch_view *view, unsigned long ip_ul){
+    Py_ssize_t lo = 0, hi = view->n_items, mid;
+
+    while(lo < hi){
+        mid = lo + (hi - lo)/2;
+        if (view->items[mid].begin > ip_ul){
+            hi = mid;
+        } else {
+            lo = mid + 1;
+        }
+    }
+    return lo;
+}
+
+
+/* add [begin, end] of segment seg, or of patch if seg is -1 */
+static void
+view_add(patch_view *view, uint32_t begin, uint32_t end, Py_ssize_t seg,
+         Py_ssize_t patch){
+    view_item *item = view->items + view->n_items++;
+
+    item->begin = begin;
+    item->end = end;
+    item->seg = seg;
+    item->patch = patch;
+}
+
+
+/*     Build the patch view if the patches changed. Each patch yields an
+ * item if it has a value, plus the parts of the segments it cuts, found by
+ * a binary search, so the view is O(p) whatever the size of the db.
+ * Segments fully covered by a patch only count in the runs. Return 0 on
+ * error. */
+static int
+sync_view(ip_store_obj *store){
+    patch_view *view = &store->view;
+    ip_db *db = store->db;
+    ip_patch *p;
+    view_run *run;
+    Py_ssize_t j, lo, hi, seg = -1;
+    uint64_t cur = 0;
+
+    if (view->valid){
+        return 1;
+    }
+    view_clear(store);
+    if (store->n_patches > 0){
+        view->items = (view_item *)PyMem_Malloc(3 * store->n_patches * sizeof(view_item));
+        view->runs = (view_run *)PyMem_Malloc(store->n_patches * sizeof(view_run));
+        if (view->items == NULL || view->runs == NULL){
+            view_clear(store);
+            PyErr_NoMemory();
+            return 0;
+        }
+    }
+
+    /* seg is the segment cut by the previous patch, its rest from cur on
+     * not added yet */
+    for(j = 0; j < store->n_patches; j++){
+        p = store->patches + j;
+        lo = find(db, p->begin);
+        hi = upper_bound(db, p->end, lo, db->size);
+        if (seg >= 0 && seg < lo){
+            view_add(view, (uint32_t)cur, db->end[seg], seg, -1);
+            seg = -1;
+        }
+
+        if (lo < hi){
+            if (seg == lo && cur < p->begin){
+                view_add(view, (uint32_t)cur, p->begin - 1, lo, -1);
+            } else if (seg != lo && db->begin[lo] < p->begin){
+                view_add(view, db->begin[lo], p->begin - 1, lo, -1);
+            }
+
+            run = view->runs + view->n_runs;
+            if (view->n_runs > 0 && run[-1].hi >= lo){
+                /* a segment cut by the previous patch too */
+                run--;
+                if (hi - 1 > run->hi){
+                    view->n_touched += hi - 1 - run->hi;
+                    run->hi = hi - 1;
+                }
+            } else {
+                run->lo = lo;
+                run->hi = hi - 1;
+                run->before = view->n_touched;
+                view->n_runs++;
+                view->n_touched += hi - lo;
+            }
+
+            seg = -1;
+            if (db->end[hi - 1] > p->end){
+                seg = hi - 1;
+                cur = (uint64_t)p->end + 1;
+            }
+        }
+
+        if (p->area != NULL){
+            view_add(view, p->begin, p->end, -1, j);
+        }
+    }
+    if (seg >= 0){
+        view_add(view, (uint32_t)cur, db->end[seg], seg, -1);
+    }
+
+    /* the segments before an item are the untouched ones ending before it */
+    for(j = 0; j < view->n_items; j++){
+        lo = find(db, view->items[j].begin);
+        view->items[j].pos = j + lo - touched_before(view, lo);
+    }
+    view->valid = 1;
+    return 1;
+}
+
+
+/* number of segments of the patched db, the view being in sync */
+static Py_ssize_t
+view_size(ip_store_obj *store){
+    return store->db->size - store->view.n_touched + store->view.n_items;
+}
+
+
+/*     Position in the patched db of the segment containing ip, -1 if none,
+ * seg being the segment of the db containing it, or -1. */
+static Py_ssize_t
+view_position(ip_store_obj *store, unsigned long ip_ul, Py_ssize_t seg){
+    patch_view *view = &store->view;
+    Py_ssize_t j = view_upper(view, ip_ul), touched;
+
+    if (j > 0 && ip_ul <= view->items[j - 1].end){
+        return view->items[j - 1].pos;
+    }
+    if (seg < 0){
+        return -1;
+    }
+    /* a touched segment is patched out where no item is */
+    touched = touched_before(view, seg);
+    if (touched_before(view, seg + 1) > touched){
+        return -1;
+    }
+    return seg - touched + j;
+}
+
+
+/* range(first, stop) of the segments of the patched db intersecting
+ * [begin, end] */
+static PyObject *
+find_range(ip_store_obj *store, unsigned long begin, unsigned long end){
+    patch_view *view = &store->view;
+    ip_db *db = store->db;
+    Py_ssize_t first, stop, lo, hi, mid;
+
+    if (begin > end){
+        PyErr_SetString(PyExc_ValueError, "begin > end");
+        return NULL;
+    }
+
+    /* the items ending before begin */
+    lo = 0;
+    hi = view->n_items;
+    while(lo < hi){
+        mid = lo + (hi - lo)/2;
+        if (view->items[mid].end < begin){
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    first = find(db, begin);
+    first += lo - touched_before(view, first);
+
+    stop = upper_bound(db, end, 0, db->size);
+    stop += view_upper(view, end) - touched_before(view, stop);
+    return PyObject_CallFunction((PyObject *)&PyRange_Type, "nn", first, stop);
+}
+
+
+/* record of segment i of the patched db, which must exist */
+static PyObject *
+view_record(ip_store_obj *store, Py_ssize_t i){
+    patch_view *view = &store->view;
+    ip_db *db = store->db;
+    view_item *item;
+    ip_patch *p;
+    Py_ssize_t lo = 0, hi = view->n_items, mid, k;
+
+    while(lo < hi){
+        mid = lo + (hi - lo)/2;
+        if (view->items[mid].pos < i){
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    item = view->items + lo;
+    if (lo < view->n_items && item->pos == i){
+        if (item->seg < 0){
+            p = store->patches + item->patch;
+            return new_record(item->begin, item->end, p->area, p->isp);
+        }
+        return new_record(item->begin, item->end,
+                          GET_VALUE(db, db->area[item->seg]),
+                          GET_VALUE(db, db->isp[item->seg]));
+    }
+
+    /* the (i - lo)th untouched segment, after the runs starting before it */
+    k = i - lo;
+    lo = 0;
+    hi = view->n_runs;
+    while(lo < hi){
+        mid = lo + (hi - lo)/2;
+        if (view->runs[mid].lo - view->runs[mid].before <= k){
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    if (lo > 0){
+        k += view->runs[lo - 1].before + view->runs[lo - 1].hi
+             - view->runs[lo - 1].lo + 1;
+    }
+    return build_record(db, k);
+}
+
+
+/* Replace the store's IPv4 db, the old one is freed once no search uses it.
+ * Patches over the old db are dropped. */
+static void
+set_db(ip_store_obj *store, ip_db *db){
+    release_db(store->db);
+    store->db = db;
+    cache_clear(&store->cache);
+    view_clear(store);
+    if (store->n_patches > 0){
+        clear_patches(store);
+    }
+}
+
+
+/* stop following a shared db, the store keeps the db it has */
+static void
+shm_detach(ip_store_obj *store){
+    if (store->shm.header != NULL){
+        munmap(store->shm.header, sizeof(ipshm_header));
+    }
+    PyMem_Free(store->shm.name);
+    memset(&store->shm, 0, sizeof(ip_shm));
+}
+
+
+/* build or drop the index of the store's db according to its setting */
+static int
+sync_index(ip_store_obj *store){
+    if (store->use_index){
+        return (store->db->jump != NULL) ? 1 : build_index(store->db);
+    }
+    /* keep it if a bulk search may still be reading it */
+    if (store->db->refs == 1){
+        PyMem_Free(store->db->jump);
+        store->db->jump = NULL;
+    }
+    return 1;
+}
+
+
+/*     Merge the patches into a new db. Segments of the db keep their value
+ * codes and the values of the patches are added to its values table, so
+ * this is a single pass over the columns. The db may be mapped, the new one
+ * is always on the heap. Return 0 on error, the store is then unchanged. */
+static int
+merge_patches(ip_store_obj *store){
+    ip_db *db = store->db, *new_db;
+    ip_patch *p;
+    PyObject *codes, *values;
+    Py_ssize_t i = 0, j = 0, n = 0;
+    uint64_t cur, stop;
+    long area, isp;
+
+    if (store->n_patches == 0){
+        return 1;
+    }
+
+    new_db = alloc_db(db->size + 2 * store->n_patches);
+    codes = PyDict_New();
+    values = PyList_New(0);
+    if (new_db == NULL || codes == NULL || values == NULL
+        || !intern_table(codes, values, db->values, db->n_values)){
+        goto merge_failed;
+    }
+
+    cur = (db->size > 0) ? db->begin[0] : 0;
+    while(i < db->size || j < store->n_patches){
+        p = store->patches + j;
+        if (j < store->n_patches && (i == db->size || p->begin <= cur)){
+            if (p->area != NULL){
+                area = intern_value(codes, values, p->area);
+                isp = (area < 0) ? -1 : intern_value(codes, values, p->isp);
+                if (isp < 0){
+                    goto merge_failed;
+                }
+                new_db->begin[n] = p->begin;
+                new_db->end[n] = p->end;
+                new_db->area[n] = (uint32_t)area;
+                new_db->isp[n++] = (uint32_t)isp;
+            }
+            /* skip what the patch covers */
+            while(i < db->size && db->end[i] <= p->end){
+                if (++i < db->size){
+                    cur = db->begin[i];
+                }
+            }
+            if (i < db->size && cur <= p->end){
+                cur = (uint64_t)p->end + 1;
+            }
+            j++;
+        } else {
+            /* the part of segment i before the next patch */
+            stop = db->end[i];
+            if (j < store->n_patches && p->begin <= stop){
+                stop = p->begin - 1;
+            }
+            new_db->begin[n] = (uint32_t)cur;
+            new_db->end[n] = (uint32_t)stop;
+            new_db->area[n] = db->area[i];
+            new_db->isp[n++] = db->isp[i];
+            if (stop == db->end[i]){
+                if (++i < db->size){
+                    cur = db->begin[i];
+                }
+            } else {
+                cur = p->begin;
+            }
+        }
+    }
+    new_db->size = n;
+
+    new_db->values = values_from_list(values);
+    if (new_db->values == NULL){
+        goto merge_failed;
+    }
+    new_db->n_values = PyList_GET_SIZE(values);
+    if (store->use_index && !build_index(new_db)){
+        goto merge_failed;
+    }
+
+    Py_DECREF(codes);
+    Py_DECREF(values);
+    set_db(store, new_db);
+    return 1;
+merge_failed:
+    Py_XDECREF(codes);
+    Py_XDECREF(values);
+    if (new_db != NULL){
+        release_db(new_db);
+    }
+    return 0;
+}
+
+
+static PyObject *
+ip_store_load(ip_store_obj *self, PyObject *o){
+
+    PyObject *record = NULL, *item, *item2, *codes, *values;
+    Py_ssize_t size, i, j;
+    unsigned long ip_ul;
+    long area, isp;
+    ip_db *new_db;
+
+    if(!PySequence_Check(o)){
+        PyErr_SetString(PyExc_TypeError, "need sequence");
+        return NULL;
+    }
+
+    size = PySequence_Length(o);
+    if(size < 0){
+        return NULL;
+    }
+
+    new_db = alloc_db(size);
+    codes = PyDict_New();
+    values = PyList_New(0);
+    if(new_db == NULL || codes == NULL || values == NULL){
+        goto record_failed;
+    }
+
+    for(i = 0; i < size; i++){
+        record = PySequence_GetItem(o, i);
+        if (record == NULL){
+            goto record_failed;
+        }
+        if (!PySequence_Check(record)){
+            PyErr_SetString(PyExc_TypeError, "need sequence for each record");
+            goto record_failed;
+        }
+
+        for(j = 0; j < 2; j++){
+            item = PySequence_GetItem(record, j);
+            if(item == NULL){
+                goto record_failed;
+            }
+#ifdef IS_PY3K
+            if(!PyLong_Check(item)){
+#else
+            if(!PyInt_CheckExact(item)){
+#endif
+                Py_DECREF(item);
+                PyErr_Format(PyExc_TypeError,
+                             "expected int, %s found",
+                             Py_TYPE(item)->tp_name); 
+                goto record_failed;
+            }
+
+#ifdef IS_PY3K
+            ip_ul = PyLong_AsUnsignedLong(item);
+            if (ip_ul == (unsigned long) -1 && PyErr_Occurred()){
+                Py_DECREF(item);
+                goto record_failed;
+            }
+#else
+            ip_ul = PyInt_AsUnsignedLongMask(item);
+#endif
+            Py_DECREF(item);
+            if (ip_ul > 0xFFFFFFFFUL){
+                PyErr_SetString(PyExc_OverflowError,
+                                "ip address overflow");
+                goto record_failed;
+            }
+
+            if (j == 0){
+                new_db->begin[i] = (uint32_t)ip_ul;
+            } else {
+                new_db->end[i] = (uint32_t)ip_ul;
+            }
+        }
+
+        item = PySequence_GetItem(record, 2);
+        item2 = PySequence_GetItem(record, 3);
+        if(item == NULL || item2 == NULL){
+            Py_XDECREF(item);
+            Py_XDECREF(item2);
+            goto record_failed;
+        }
+        area = intern_value(codes, values, item);
+        isp = (area < 0) ? -1 : intern_value(codes, values, item2);
+        Py_DECREF(item);
+        Py_DECREF(item2);
+        if (isp < 0){
+            goto record_failed;
+        }
+        new_db->area[i] = (uint32_t)area;
+        new_db->isp[i] = (uint32_t)isp;
+        Py_DECREF(record);
+    }
+    record = NULL;
+
+    new_db->values = values_from_list(values);
+    if (new_db->values == NULL){
+        goto record_failed;
+    }
+    new_db->n_values = PyList_GET_SIZE(values);
+    if (self->use_index && !build_index(new_db)){
+        goto record_failed;
+    }
+
+    Py_DECREF(codes);
+    Py_DECREF(values);
+    shm_detach(self);
+    set_db(self, new_db);
+    Py_RETURN_NONE;
+record_failed:
+    Py_XDECREF(record);
+    Py_XDECREF(codes);
+    Py_XDECREF(values);
+    if (new_db != NULL){
+        release_db(new_db);
+    }
+    return NULL;
+}
+
+
+/* parse an address column, either a host integer or a dotted-quad */
+static int
+parse_ip_field(char *field, unsigned long *ip_ul){
+    struct in_addr buf;
+    unsigned long long v;
+    char *end;
+
+    if (strchr(field, '.') != NULL){
+        if (inet_aton(field, &buf)){
+            *ip_ul = ntohl(buf.s_addr);
+            return 1;
+        }
+        return 0;
+    }
+
+    if (*field < '0' || *field > '9'){
+        return 0;
+    }
+    errno = 0;
+    v = strtoull(field, &end, 10);
+    if (errno != 0 || *end != '\0' || v > 0xFFFFFFFFULL){
+        return 0;
+    }
+    *ip_ul = (unsigned long)v;
+    return 1;
+}
+
+
+/* strip leading and trailing white space in place */
+static char *
+strip_field(char *field){
+    char *end;
+
+    while(*field == ' ' || *field == '\t'){
+        field++;
+    }
+    end = field + strlen(field);
+    while(end > field && (end[-1] == ' ' || end[-1] == '\t'
+                          || end[-1] == '\r' || end[-1] == '\n')){
+        *(--end) = '\0';
+    }
+    return field;
+}
+
+
+/* intern the utf-8 field of line line_no, return its code or -1 */
+static long
+intern_field(PyObject *codes, PyObject *values, const char *field,
+             Py_ssize_t line_no){
+    PyObject *value;
+    long code;
+
+    value = PyUnicode_DecodeUTF8(field, strlen(field), NULL);
+    if (value == NULL){
+        if (PyErr_ExceptionMatches(PyExc_UnicodeDecodeError)){
+            PyErr_Clear();
+            PyErr_Format(PyExc_ValueError,
+                         "line %zd: area and isp should be utf-8", line_no);
+        }
+        return -1;
+    }
+    code = intern_value(codes, values, value);
+    Py_DECREF(value);
+    return code;
+}
+
+
+/*     Stream a delimited text file into the db, one record per line:
+ *
+ *      begin,end,area,isp
+ *
+ * begin and end are host integers or dotted-quads. Empty lines and lines
+ * starting with '#' are skipped. Records must be sorted and must not
+ * overlap, which is checked in the same pass, and errors are reported with
+ * the line number. Equal area/isp strings are stored once. */
+static PyObject *
+ip_store_load_file(ip_store_obj *self, PyObject *args, PyObject *kwds){
+
+    static char *kwlist[] = {"path", "delimiter", NULL};
+    const char *path, *delimiter = ",";
+    char *line = NULL, *fields[4], *p;
+    size_t line_cap = 0;
+    Py_ssize_t line_no = 0, size = 0, cap = 0, i;
+    unsigned long begin, end, last_end = 0;
+    uint32_t *rows = NULL, *tmp;
+    long area, isp;
+    PyObject *codes = NULL, *values = NULL;
+    ip_db *new_db = NULL;
+    FILE *fp;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "s|s:load_file", kwlist,
+                                     &path, &delimiter)){
+        return NULL;
+    }
+    if (strlen(delimiter) != 1){
+        PyErr_SetString(PyExc_ValueError, "delimiter should be one character");
+        return NULL;
+    }
+
+    fp = fopen(path, "r");
+    if (fp == NULL){
+        return PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+    }
+
+    codes = PyDict_New();
+    values = PyList_New(0);
+    if (codes == NULL || values == NULL){
+        goto failed;
+    }
+
+    while(getline(&line, &line_cap, fp) != -1){
+        line_no++;
+        p = strip_field(line);
+        if (*p == '\0' || *p == '#'){
+            continue;
+        }
+
+        for(i = 0; i < 4; i++){
+            fields[i] = p;
+            p = strchr(p, delimiter[0]);
+            if (p == NULL){
+                break;
+            }
+            *(p++) = '\0';
+        }
+        if (i != 3){
+            PyErr_Format(PyExc_ValueError,
+                         "line %zd: expected 4 columns", line_no);
+            goto failed;
+        }
+        for(i = 0; i < 4; i++){
+            fields[i] = strip_field(fields[i]);
+        }
+
+        if (!parse_ip_field(fields[0], &begin) || !parse_ip_field(fields[1], &end)){
+            PyErr_Format(PyExc_ValueError,
+                         "line %zd: illegal ip address", line_no);
+            goto failed;
+        }
+        if (begin > end){
+            PyErr_Format(PyExc_ValueError,
+                         "line %zd: begin %lu > end %lu", line_no, begin, end);
+            goto failed;
+        }
+        if (size > 0 && begin <= last_end){
+            PyErr_Format(PyExc_ValueError,
+                         "line %zd: begin %lu overlaps or precedes the previous "
+                         "end %lu", line_no, begin, last_end);
+            goto failed;
+        }
+        last_end = end;
+
+        area = intern_field(codes, values, fields[2], line_no);
+        if (area < 0){
+            goto failed;
+        }
+        isp = intern_field(codes, values, fields[3], line_no);
+        if (isp < 0){
+            goto failed;
+        }
+
+        if (size == cap){
+            cap = cap ? 2 * cap : 1024;
+            tmp = (uint32_t *)PyMem_Realloc(rows, 4 * cap * sizeof(uint32_t));
+            if (tmp == NULL){
+                PyErr_NoMemory();
+                goto failed;
+            }
+            rows = tmp;
+        }
+        rows[4*size] = (uint32_t)begin;
+        rows[4*size + 1] = (uint32_t)end;
+        rows[4*size + 2] = (uint32_t)area;
+        rows[4*size + 3] = (uint32_t)isp;
+        size++;
+    }
+    if (ferror(fp)){
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+        goto failed;
+    }
+
+    new_db = alloc_db(size);
+    if (new_db == NULL){
+        goto failed;
+    }
+    new_db->values = values_from_list(values);
+    if (new_db->values == NULL){
+        release_db(new_db);
+        goto failed;
+    }
+    new_db->n_values = PyList_GET_SIZE(values);
+    for(i = 0; i < size; i++){
+        new_db->begin[i] = rows[4*i];
+        new_db->end[i] = rows[4*i + 1];
+        new_db->area[i] = rows[4*i + 2];
+        new_db->isp[i] = rows[4*i + 3];
+    }
+    if (self->use_index && !build_index(new_db)){
+        release_db(new_db);
+        goto failed;
+    }
+
+    shm_detach(self);
+    set_db(self, new_db);
+
+    fclose(fp);
+    free(line);
+    PyMem_Free(rows);
+    Py_DECREF(codes);
+    Py_DECREF(values);
+    Py_RETURN_NONE;
+failed:
+    fclose(fp);
+    free(line);
+    PyMem_Free(rows);
+    Py_XDECREF(codes);
+    Py_XDECREF(values);
+    return NULL;
+}
+
+
+/*     Write the database to fp in the following format, all integers in
+ * host byte order:
+ *
+ *      ipdb_header
+ *      uint32 begin[size], end[size], area[size], isp[size]
+ *      uint32 offsets[n_values + 1]
+ *      char   strings[strings_len]       utf-8, not terminated
+ *
+ *    Area and isp must be str. Equal values are written once, so area and
+ * isp become indexes into the string table. name is only used in error
+ * messages. Return 0 on error. */
+static int
+write_db(ip_db *db, FILE *fp, const char *name){
+
+    PyObject *codes = NULL, *strings = NULL, *value;
+    uint32_t *new_codes = NULL, offset;
+    long code;
+    Py_ssize_t i, j, len;
+    const char *data;
+    ipdb_header header;
+    int ok = 0;
+
+    codes = PyDict_New();
+    strings = PyList_New(0);
+    new_codes = (uint32_t *)PyMem_Malloc((2 * db->size + 1) * sizeof(uint32_t));
+    if (codes == NULL || strings == NULL){
+        goto finish;
+    }
+    if (new_codes == NULL){
+        PyErr_NoMemory();
+        goto finish;
+    }
+
+    for(i = 0; i < 2 * db->size; i++){
+        value = GET_VALUE(db, (i < db->size) ? db->area[i] : db->isp[i - db->size]);
+        if (value == NULL){
+            goto finish;
+        }
+        if (!PyUnicode_Check(value)){
+            PyErr_Format(PyExc_TypeError,
+                         "area and isp should be str, %s found",
+                         Py_TYPE(value)->tp_name);
+            goto finish;
+        }
+
+        code = intern_value(codes, strings, value);
+        if (code < 0){
+            goto finish;
+        }
+        new_codes[i] = (uint32_t)code;
+    }
+
+    memset(&header, 0, sizeof(header));
+    memcpy(header.magic, IPDB_MAGIC, sizeof(header.magic));
+    header.byte_order = IPDB_BYTE_ORDER;
+    header.version = IPDB_VERSION;
+    header.size = (uint32_t)db->size;
+    header.n_values = (uint32_t)PyList_GET_SIZE(strings);
+    for(i = 0; i < PyList_GET_SIZE(strings); i++){
+        if (PyUnicode_AsUTF8AndSize(PyList_GET_ITEM(strings, i), &len) == NULL){
+            goto finish;
+        }
+        header.strings_len += len;
+    }
+    if (header.strings_len > 0xFFFFFFFFUL){
+        PyErr_SetString(PyExc_OverflowError, "string table too large");
+        goto finish;
+    }
+
+    offset = 0;
+    if (fwrite(&header, sizeof(header), 1, fp) != 1
+        || fwrite(db->begin, sizeof(uint32_t), db->size, fp) != (size_t)db->size
+        || fwrite(db->end, sizeof(uint32_t), db->size, fp) != (size_t)db->size
+        || fwrite(new_codes, sizeof(uint32_t), 2 * db->size, fp) != (size_t)(2 * db->size)
+        || fwrite(&offset, sizeof(uint32_t), 1, fp) != 1){
+        goto io_failed;
+    }
+    for(j = 0; j < 2; j++){
+        /* offsets in the first round, string data in the second */
+        for(i = 0; i < PyList_GET_SIZE(strings); i++){
+            data = PyUnicode_AsUTF8AndSize(PyList_GET_ITEM(strings, i), &len);
+            if (j == 0){
+                offset += (uint32_t)len;
+                if (fwrite(&offset, sizeof(uint32_t), 1, fp) != 1){
+                    goto io_failed;
+                }
+            } else if (fwrite(data, 1, len, fp) != (size_t)len){
+                goto io_failed;
+            }
+        }
+    }
+    if (fflush(fp) != 0){
+        goto io_failed;
+    }
+
+    ok = 1;
+    goto finish;
+io_failed:
+    PyErr_SetFromErrnoWithFilename(PyExc_OSError, name);
+finish:
+    Py_XDECREF(codes);
+    Py_XDECREF(strings);
+    PyMem_Free(new_codes);
+    return ok;
+}
+
+
+/* point the columns of an empty db into a mapped file and decode its string
+ * table, the db should already own the map */
+static int
+attach_map(ip_db *db, void *map, size_t map_len){
+    ipdb_header *header = (ipdb_header *)map;
+    const uint32_t *offsets;
+    const char *strings;
+    Py_ssize_t i;
+    size_t expected;
+
+    if (map_len < sizeof(ipdb_header)
+        || memcmp(header->magic, IPDB_MAGIC, sizeof(header->magic)) != 0){
+        PyErr_SetString(PyExc_ValueError, "not an ip_store database");
+        return 0;
+    }
+    if (header->byte_order != IPDB_BYTE_ORDER || header->version != IPDB_VERSION){
+        PyErr_SetString(PyExc_ValueError,
+                        "unsupported byte order or version of database");
+        return 0;
+    }
+
+    expected = sizeof(ipdb_header) + 4 * (size_t)header->size * sizeof(uint32_t)
+               + ((size_t)header->n_values + 1) * sizeof(uint32_t)
+               + header->strings_len;
+    if (map_len != expected){
+        PyErr_SetString(PyExc_ValueError, "truncated or corrupted database");
+        return 0;
+    }
+
+    db->values = (PyObject **)PyMem_Malloc((header->n_values + 1) * sizeof(PyObject *));
+    if (db->values == NULL){
+        PyErr_NoMemory();
+        return 0;
+    }
+
+    db->size = header->size;
+    db->begin = (uint32_t *)(header + 1);
+    db->end = db->begin + db->size;
+    db->area = db->end + db->size;
+    db->isp = db->area + db->size;
+    offsets = (const uint32_t *)(db->isp + db->size);
+    strings = (const char *)(offsets + header->n_values + 1);
+
+    for(i = 0; i < header->n_values; i++){
+        if (offsets[i] > offsets[i+1] || offsets[i+1] > header->strings_len){
+            PyErr_SetString(PyExc_ValueError, "corrupted string table");
+            goto failed;
+        }
+        db->values[i] = PyUnicode_DecodeUTF8(strings + offsets[i],
+                                             offsets[i+1] - offsets[i], NULL);
+        if (db->values[i] == NULL){
+            goto failed;
+        }
+        db->n_values = i + 1;
+    }
+    return 1;
+failed:
+    /* the columns are released with the map */
+    db->size = 0;
+    return 0;
+}
+
+
+/* map a database written by dump() from fd, name is for error messages */
+static ip_db *
+map_db(int fd, const char *name, int use_index){
+    struct stat st;
+    void *map;
+    ip_db *db;
+
+    if (fstat(fd, &st) < 0){
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, name);
+        return NULL;
+    }
+    if (st.st_size == 0){
+        PyErr_SetString(PyExc_ValueError, "not an ip_store database");
+        return NULL;
+    }
+
+    map = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    if (map == MAP_FAILED){
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, name);
+        return NULL;
+    }
+
+    db = alloc_db(0);
+    if (db == NULL){
+        munmap(map, st.st_size);
+        return NULL;
+    }
+    db->map = map;
+    db->map_len = st.st_size;
+    if (!attach_map(db, map, st.st_size)
+        || (use_index && !build_index(db))){
+        release_db(db);
+        return NULL;
+    }
+    return db;
+}
+
+
+/* Name of the shared memory object of a generation of a shared db, or of
+ * its control block for generation 0. Return 0 if name is too long. */
+static int
+shm_path(char *buf, const char *name, uint64_t generation){
+    const char *slash = (name[0] == '/') ? "" : "/";
+    int len;
+
+    if (generation == 0){
+        len = snprintf(buf, IPSHM_PATH_MAX, "%s%s", slash, name);
+    } else {
+        len = snprintf(buf, IPSHM_PATH_MAX, "%s%s.%llu", slash, name,
+                       (unsigned long long)generation);
+    }
+    if (len < 0 || len >= IPSHM_PATH_MAX){
+        PyErr_SetString(PyExc_ValueError, "name too long");
+        return 0;
+    }
+    return 1;
+}
+
+
+/* Map the control block of a shared db, creating it if create. Return
+ * MAP_FAILED on error. */
+static ipshm_header *
+shm_map_header(const char *name, int create){
+    char path[IPSHM_PATH_MAX];
+    ipshm_header *header;
+    struct stat st;
+    int fd;
+
+    if (!shm_path(path, name, 0)){
+        return MAP_FAILED;
+    }
+    fd = shm_open(path, create ? O_CREAT | O_RDWR : O_RDONLY, 0644);
+    if (fd < 0 || fstat(fd, &st) < 0
+        || (create && st.st_size == 0 && ftruncate(fd, sizeof(ipshm_header)) < 0)){
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+        if (fd >= 0){
+            close(fd);
+        }
+        return MAP_FAILED;
+    }
+    if (st.st_size != 0 && st.st_size != sizeof(ipshm_header)){
+        close(fd);
+        PyErr_SetString(PyExc_ValueError, "not an ip_store shared db");
+        return MAP_FAILED;
+    }
+
+    header = (ipshm_header *)mmap(NULL, sizeof(ipshm_header),
+                                  create ? PROT_READ | PROT_WRITE : PROT_READ,
+                                  MAP_SHARED, fd, 0);
+    close(fd);
+    if (header == MAP_FAILED){
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+        return MAP_FAILED;
+    }
+
+    if (create && st.st_size == 0){
+        memcpy(header->magic, IPSHM_MAGIC, sizeof(header->magic));
+        header->byte_order = IPDB_BYTE_ORDER;
+        header->version = IPSHM_VERSION;
+    } else if (memcmp(header->magic, IPSHM_MAGIC, sizeof(header->magic)) != 0
+               || header->byte_order != IPDB_BYTE_ORDER
+               || header->version != IPSHM_VERSION){
+        munmap(header, sizeof(ipshm_header));
+        PyErr_SetString(PyExc_ValueError,
+                        "not an ip_store shared db, or of another version");
+        return MAP_FAILED;
+    }
+    return header;
+}
+
+
+/*     Switch to the current generation of the shared db the store follows,
+ * if it has changed. When it has not, this is a single load, so it is done
+ * on each call. A generation is unlinked once the next one is published,
+ * if it is gone by the time we open it we just look again. */
+static int
+shm_refresh(ip_store_obj *store){
+    char path[IPSHM_PATH_MAX];
+    uint64_t generation;
+    ip_db *db;
+    int fd, tries;
+
+    if (store->shm.header == NULL){
+        return 1;
+    }
+
+    for(tries = 0; tries < 3; tries++){
+        generation = __atomic_load_n(&store->shm.header->generation,
+                                     __ATOMIC_ACQUIRE);
+        if (generation == store->shm.generation){
+            return 1;
+        }
+        if (!shm_path(path, store->shm.name, generation)){
+            return 0;
+        }
+        fd = shm_open(path, O_RDONLY, 0);
+        if (fd >= 0){
+            db = map_db(fd, path, store->use_index);
+            close(fd);
+            if (db == NULL){
+                return 0;
+            }
+            set_db(store, db);
+            store->shm.generation = generation;
+            return 1;
+        }
+        if (errno != ENOENT){
+            break;
+        }
+    }
+    PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+    return 0;
+}
+
+
+/* bring the store's db up to date before working on segment positions */
+static int
+sync_db(ip_store_obj *store){
+    return shm_refresh(store) && merge_patches(store);
+}
+
+
+PyDoc_STRVAR(publish__doc__,
+"publish(name), publish the IPv4 db as a new generation of the shared db\n\
+name, creating it if needed. Stores attached to name switch to it on their\n\
+next call, the previous generation is unlinked. Area and isp must be str.\n\
+Only one process should publish a given name.");
+
+
+static PyObject *
+ip_store_publish(ip_store_obj *self, PyObject *args){
+
+    const char *name;
+    char path[IPSHM_PATH_MAX];
+    ipshm_header *header;
+    uint64_t generation;
+    FILE *fp;
+    int fd, ok = 0;
+
+    if (!PyArg_ParseTuple(args, "s:publish", &name) || !sync_db(self)){
+        return NULL;
+    }
+
+    header = shm_map_header(name, 1);
+    if (header == MAP_FAILED){
+        return NULL;
+    }
+
+    generation = header->generation + 1;
+    if (!shm_path(path, name, generation)){
+        goto finish;
+    }
+    fd = shm_open(path, O_CREAT | O_EXCL | O_RDWR, 0644);
+    fp = (fd < 0) ? NULL : fdopen(fd, "wb");
+    if (fp == NULL){
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+        if (fd >= 0){
+            close(fd);
+            shm_unlink(path);
+        }
+        goto finish;
+    }
+
+    ok = write_db(self->db, fp, path);
+    if (fclose(fp) != 0 && ok){
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+        ok = 0;
+    }
+    if (!ok){
+        shm_unlink(path);
+        goto finish;
+    }
+
+    /* the new generation is complete before it is seen */
+    __atomic_store_n(&header->generation, generation, __ATOMIC_RELEASE);
+    if (generation > 1 && shm_path(path, name, generation - 1)){
+        shm_unlink(path);
+    }
+finish:
+    munmap(header, sizeof(ipshm_header));
+    if (!ok){
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *
+ip_store_attach(ip_store_obj *self, PyObject *args){
+
+    const char *name;
+    ipshm_header *header;
+    char *copy;
+
+    if (!PyArg_ParseTuple(args, "s:attach", &name)){
+        return NULL;
+    }
+
+    header = shm_map_header(name, 0);
+    if (header == MAP_FAILED){
+        return NULL;
+    }
+    copy = (char *)PyMem_Malloc(strlen(name) + 1);
+    if (copy == NULL){
+        munmap(header, sizeof(ipshm_header));
+        return PyErr_NoMemory();
+    }
+    strcpy(copy, name);
+
+    shm_detach(self);
+    self->shm.header = header;
+    self->shm.name = copy;
+    if (!shm_refresh(self)){
+        shm_detach(self);
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *
+ip_store_detach(ip_store_obj *self){
+    shm_detach(self);
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *
+ip_store_load_mapped(ip_store_obj *self, PyObject *args){
+
+    const char *path;
+    int fd;
+    ip_db *new_db;
+
+    if (!PyArg_ParseTuple(args, "s:load_mapped", &path)){
+        return NULL;
+    }
+
+    fd = open(path, O_RDONLY);
+    if (fd < 0){
+        return PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+    }
+    new_db = map_db(fd, path, self->use_index);
+    close(fd);
+    if (new_db == NULL){
+        return NULL;
+    }
+
+    shm_detach(self);
+    set_db(self, new_db);
+    Py_RETURN_NONE;
+}
+
+
+/* Write the database to path, see write_db. The file is written aside and
+ * renamed over path, so processes still mapping the old file are not
+ * disturbed. */
+static PyObject *
+ip_store_dump(ip_store_obj *self, PyObject *args){
+
+    const char *path;
+    char *tmp_path;
+    FILE *fp;
+    int ok;
+
+    if (!PyArg_ParseTuple(args, "s:dump", &path) || !sync_db(self)){
+        return NULL;
+    }
+
+    tmp_path = (char *)PyMem_Malloc(strlen(path) + 5);
+    if (tmp_path == NULL){
+        return PyErr_NoMemory();
+    }
+    sprintf(tmp_path, "%s.tmp", path);
+    fp = fopen(tmp_path, "wb");
+    if (fp == NULL){
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, tmp_path);
+        PyMem_Free(tmp_path);
+        return NULL;
+    }
+
+    ok = write_db(self->db, fp, tmp_path);
+    if (fclose(fp) != 0 && ok){
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, tmp_path);
+        ok = 0;
+    }
+    if (!ok){
+        unlink(tmp_path);
+    } else if (rename(tmp_path, path) < 0){
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+        ok = 0;
+    }
+    PyMem_Free(tmp_path);
+    if (!ok){
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+
+/* index of the first segment in [lo, hi) whose end >= ip6, hi if none */
+static Py_ssize_t
+lower_bound6(ip6_db *db, ip6_t ip6, Py_ssize_t lo, Py_ssize_t hi){
+    Py_ssize_t mid;
+
+    while(lo < hi){
+        mid = lo + (hi - lo)/2;
+        if (IP6_LT(db->end[mid], ip6)){
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+
+/* index of the first segment in [lo, hi) whose begin > ip, hi if none */
+static Py_ssize_t
+upper_bound6(ip6_db *db, ip6_t ip6, Py_ssize_t lo, Py_ssize_t hi){
+    Py_ssize_t mid;
+
+    while(lo < hi){
+        mid = lo + (hi - lo)/2;
+        if (IP6_LT(ip6, db->begin[mid])){
+            hi = mid;
+        } else {
+            lo = mid + 1;
+        }
+    }
+    return lo;
+}
+
+
+/* see gallop() */
+static Py_ssize_t
+gallop6(ip6_db *db, ip6_t ip6, Py_ssize_t pos){
+    Py_ssize_t step = 1, lo = pos;
+
+    while(pos + step < db->size && IP6_LT(db->end[pos + step], ip6)){
+        lo = pos + step + 1;
+        step <<= 1;
+    }
+    if (pos + step < db->size){
+        return lower_bound6(db, ip6, lo, pos + step + 1);
+    }
+    return lower_bound6(db, ip6, lo, db->size);
+}
+
+
+static PyObject *
+ip_store_load6(ip_store_obj *self, PyObject *o){
+
+    PyObject *seq, *record, *codes = NULL, *values = NULL;
+    Py_ssize_t size, i;
+    long area, isp;
+    ip6_db *new_db;
+
+    seq = PySequence_Fast(o, "need sequence");
+    if (seq == NULL){
+        return NULL;
+    }
+    size = PySequence_Fast_GET_SIZE(seq);
+
+    new_db = alloc_db6(size);
+    if (new_db == NULL){
+        Py_DECREF(seq);
+        return NULL;
+    }
+    codes = PyDict_New();
+    values = PyList_New(0);
+    if (codes == NULL || values == NULL){
+        goto failed;
+    }
+
+    for(i = 0; i < size; i++){
+        record = PySequence_Fast_GET_ITEM(seq, i);
+        if (!PyTuple_Check(record) && !PyList_Check(record)){
+            PyErr_SetString(PyExc_TypeError, "need sequence for each record");
+            goto failed;
+        }
+        if (PySequence_Fast_GET_SIZE(record) != 4){
+            PyErr_SetString(PyExc_IndexError, "need 4 items for each record");
+            goto failed;
+        }
+        if (!inner_as_ip6(PySequence_Fast_GET_ITEM(record, 0), new_db->begin + i)
+            || !inner_as_ip6(PySequence_Fast_GET_ITEM(record, 1), new_db->end + i)){
+            goto failed;
+        }
+
+        area = intern_value(codes, values, PySequence_Fast_GET_ITEM(record, 2));
+        isp = (area < 0) ? -1 : intern_value(codes, values,
+                                             PySequence_Fast_GET_ITEM(record, 3));
+        if (isp < 0){
+            goto failed;
+        }
+        new_db->area[i] = (uint32_t)area;
+        new_db->isp[i] = (uint32_t)isp;
+    }
+
+    new_db->values = values_from_list(values);
+    if (new_db->values == NULL){
+        goto failed;
+    }
+    new_db->n_values = PyList_GET_SIZE(values);
+    new_db->size = size;
+
+    Py_DECREF(seq);
+    Py_DECREF(codes);
+    Py_DECREF(values);
+    release_db6(self->db6);
+    self->db6 = new_db;
+    Py_RETURN_NONE;
+failed:
+    Py_DECREF(seq);
+    Py_XDECREF(codes);
+    Py_XDECREF(values);
+    release_db6(new_db);
+    return NULL;
+}
+
+
+static PyObject *
+ip_store_get6(ip_store_obj *self, PyObject *o){
+
+    Py_ssize_t i;
+
+    if(!PyLong_Check(o)){
+        PyErr_SetString(PyExc_TypeError, "need int");
+        return NULL;
+    }
+
+    i = PyLong_AsSsize_t(o);
+    if(PyErr_Occurred()){
+        return NULL;
+    }
+
+    if (i < 0 || i > self->db6->size -1){
+        PyErr_SetString(PyExc_IndexError, "");
+        return NULL;
+    }
+
+    return build_record6(self->db6, i);
+}
+
+
+static PyObject *
+ip_store_get(ip_store_obj *self, PyObject *o){
+
+    Py_ssize_t i;
+
+#ifdef IS_PY3K
+    if(!PyLong_Check(o)){
+#else
+    if(!PyInt_CheckExact(o)){
+#endif
+        PyErr_SetString(PyExc_TypeError, "need int");
+        return NULL;
+    }
+
+#ifdef IS_PY3K
+    i = PyLong_AsSsize_t(o);
+    if(PyErr_Occurred()){
+        return NULL;
+    }
+#else
+    i = PyInt_AsSsize_t(o);
+#endif
+
+    if (!shm_refresh(self) || !sync_view(self)){
+        return NULL;
+    }
+    if (i < 0 || i > view_size(self) - 1){
+        PyErr_SetString(PyExc_IndexError, "");
+        return NULL;
+    }
+
+    return view_record(self, i);
+}
+
+
+static PyObject *
+ip_store_search(ip_store_obj *self, PyObject *o){
+
+    int family;
+    unsigned long ip_ul;
+    ip6_t ip6;
+    Py_ssize_t mid;
+    ip_patch *p;
+
+    if (!shm_refresh(self)){
+        return NULL;
+    }
+    if (self->db->size == 0 && self->db6->size == 0 && self->n_patches == 0){
+        Py_RETURN_NONE;
+    }
+
+    family = inner_aton(o, &ip_ul, &ip6);
+    if (family == 0){
+        return NULL;
+    } else if (family == AF_INET6){
+        mid = lower_bound6(self->db6, ip6, 0, self->db6->size);
+        if (mid < self->db6->size && !IP6_LT(ip6, self->db6->begin[mid])){
+            return DB_VALUE(self->db6, mid);
+        }
+        Py_RETURN_NONE;
+    }
+
+    /* releasing GIL has been tested in the situation where there is
+     * no IO operation. The result is that releasing GIL make worse
+     * performance */
+
+    if (self->n_patches > 0){
+        mid = patch_bound(self, ip_ul);
+        p = self->patches + mid;
+        if (mid < self->n_patches && p->begin <= ip_ul){
+            if (p->area == NULL){
+                Py_RETURN_NONE;
+            }
+            return PyTuple_Pack(2, p->area, p->isp);
+        }
+    }
+
+    mid = cached_find(&self->cache, self->db, ip_ul);
+    if (mid >= 0){
+        return DB_VALUE(self->db, mid);
+    } else {
+        Py_RETURN_NONE;
+    }
+}
+
+
+static PyObject *
+find_range6(ip6_db *db6, ip6_t begin, ip6_t end){
+    Py_ssize_t first;
+
+    if (IP6_LT(end, begin)){
+        PyErr_SetString(PyExc_ValueError, "begin > end");
+        return NULL;
+    }
+    first = lower_bound6(db6, begin, 0, db6->size);
+    return PyObject_CallFunction((PyObject *)&PyRange_Type, "nn", first,
+                                 upper_bound6(db6, end, first, db6->size));
+}
+
+
+static PyObject *
+ip_store_search_range(ip_store_obj *self, PyObject *args){
+
+    PyObject *begin_o, *end_o;
+    unsigned long begin_ul, end_ul;
+    ip6_t begin6, end6;
+    int family, family_end;
+
+    if (!PyArg_ParseTuple(args, "OO:search_range", &begin_o, &end_o)
+        || !shm_refresh(self)){
+        return NULL;
+    }
+
+    family = inner_aton(begin_o, &begin_ul, &begin6);
+    family_end = (family == 0) ? 0 : inner_aton(end_o, &end_ul, &end6);
+    if (family_end == 0){
+        return NULL;
+    } else if (family != family_end){
+        PyErr_SetString(PyExc_ValueError, "begin and end of different families");
+        return NULL;
+    }
+
+    if (family == AF_INET){
+        if (!sync_view(self)){
+            return NULL;
+        }
+        return find_range(self, begin_ul, end_ul);
+    }
+    return find_range6(self->db6, begin6, end6);
+}
+
+
+static PyObject *
+ip_store_search_cidr(ip_store_obj *self, PyObject *o){
+
+    char *cidr, *slash, *tail, addr[INET6_ADDRSTRLEN];
+    unsigned char buf[16];
+    long prefix;
+    uint32_t ip, mask;
+    uint64_t mask_hi, mask_lo;
+    ip6_t begin6, end6;
+
+    if (!shm_refresh(self)){
+        return NULL;
+    }
+    cidr = inner_as_string(o);
+    if (cidr == NULL){
+        return NULL;
+    }
+
+    slash = strchr(cidr, '/');
+    if (slash == NULL || (size_t)(slash - cidr) >= sizeof(addr)){
+        goto invalid;
+    }
+    memcpy(addr, cidr, slash - cidr);
+    addr[slash - cidr] = '\0';
+    /* ascii digits only, no space or sign as strtol() would take */
+    prefix = 0;
+    for(tail = slash + 1; *tail >= '0' && *tail <= '9' && prefix <= 128;
+        tail++){
+        prefix = prefix * 10 + (*tail - '0');
+    }
+    if (tail == slash + 1 || *tail != '\0'){
+        goto invalid;
+    }
+
+    /* host bits are ignored, as in ip_network(cidr, strict=False) */
+    if (strchr(addr, ':') == NULL){
+        if (prefix > 32 || inet_pton(AF_INET, addr, buf) != 1){
+            goto invalid;
+        }
+        ip = ((uint32_t)buf[0] << 24) | ((uint32_t)buf[1] << 16)
+             | ((uint32_t)buf[2] << 8) | buf[3];
+        mask = (prefix == 0) ? 0 : 0xFFFFFFFFU << (32 - prefix);
+        if (!sync_view(self)){
+            return NULL;
+        }
+        return find_range(self, ip & mask, ip | ~mask);
+    }
+
+    if (prefix > 128 || inet_pton(AF_INET6, addr, buf) != 1){
+        goto invalid;
+    }
+    inner_unpack6(buf, &begin6);
+    mask_hi = (prefix >= 64) ? UINT64_MAX
+                             : (prefix == 0) ? 0 : UINT64_MAX << (64 - prefix);
+    mask_lo = (prefix >= 128) ? UINT64_MAX
+                              : (prefix <= 64) ? 0 : UINT64_MAX << (128 - prefix);
+    begin6.hi &= mask_hi;
+    begin6.lo &= mask_lo;
+    end6.hi = begin6.hi | ~mask_hi;
+    end6.lo = begin6.lo | ~mask_lo;
+    return find_range6(self->db6, begin6, end6);
+
+invalid:
+    PyErr_SetString(PyExc_ValueError, "illegal CIDR block");
+    return NULL;
+}
+
+
+/* Convert o into an array of host integers. A buffer of 4-byte
+ * unsigned integers (array('I'), numpy.uint32, ...) is taken as integers in
+ * the byte order of its format, a buffer of bytes (bytes, bytearray, ...)
+ * as packed addresses in network byte order, anything else should be a
+ * sequence of addresses as taken by inner_aton. IPv6 addresses are marked
+ * by IP6_MARK in ips and kept at the same index of *ips6, which is only
+ * allocated if there is any. Return the number of addresses, or -1 on
+ * error. */
+static Py_ssize_t
+inner_batch_aton(PyObject *o, uint64_t **ips, ip6_t **ips6){
+    Py_buffer view;
+    PyObject *seq;
+    Py_ssize_t n, i;
+    const unsigned char *p;
+    unsigned int u32;
+    unsigned long ip_ul;
+    ip6_t ip6;
+    int family, order;
+    char fmt;
+
+    *ips = NULL;
+    *ips6 = NULL;
+
+    if (PyObject_CheckBuffer(o)){
+        if (PyObject_GetBuffer(o, &view, PyBUF_FORMAT | PyBUF_C_CONTIGUOUS) < 0){
+            return -1;
+        }
+
+        /* uint32 in the byte order of the prefix, native without one */
+        fmt = (view.format == NULL) ? 'B' : view.format[0];
+        order = (fmt == '<') ? 0 : (fmt == '>' || fmt == '!') ? 1 : -1;
+        if (fmt == '@' || fmt == '=' || fmt == '<' || fmt == '>' || fmt == '!'){
+            fmt = view.format[1];
+        }
+
+        if ((fmt == 'I' || fmt == 'L') && view.itemsize == 4){
+            n = view.len / 4;
+        } else if ((fmt == 'B' || fmt == 'b' || fmt == 'c') && view.itemsize == 1
+                   && view.len % 4 == 0){
+            n = view.len / 4;
+        } else {
+            PyBuffer_Release(&view);
+            PyErr_SetString(PyExc_TypeError,
+                            "need a buffer of uint32 or packed 4-byte addresses");
+            return -1;
+        }
+
+        *ips = (uint64_t *)PyMem_Malloc((n ? n : 1) * sizeof(uint64_t));
+        if (*ips == NULL){
+            PyBuffer_Release(&view);
+            PyErr_NoMemory();
+            return -1;
+        }
+
+        p = (const unsigned char *)view.buf;
+        for(i = 0; i < n; i++, p += 4){
+            if (view.itemsize == 4 && order < 0){
+                memcpy(&u32, p, 4);
+                (*ips)[i] = u32;
+            } else if (view.itemsize == 4 && order == 0){
+                (*ips)[i] = ((uint64_t)p[3] << 24) | ((uint64_t)p[2] << 16)
+                            | ((uint64_t)p[1] << 8) | p[0];
+            } else {
+                (*ips)[i] = ((uint64_t)p[0] << 24) | ((uint64_t)p[1] << 16)
+                            | ((uint64_t)p[2] << 8) | p[3];
+            }
+        }
+        PyBuffer_Release(&view);
+        return n;
+    }
+
+    seq = PySequence_Fast(o, "need sequence or buffer");
+    if (seq == NULL){
+        return -1;
+    }
+
+    n = PySequence_Fast_GET_SIZE(seq);
+    *ips = (uint64_t *)PyMem_Malloc((n ? n : 1) * sizeof(uint64_t));
+    if (*ips == NULL){
+        Py_DECREF(seq);
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    for(i = 0; i < n; i++){
+        family = inner_aton(PySequence_Fast_GET_ITEM(seq, i), &ip_ul, &ip6);
+        if (family == AF_INET){
+            (*ips)[i] = ip_ul;
+        } else if (family == AF_INET6){
+            if (*ips6 == NULL){
+                *ips6 = (ip6_t *)PyMem_Malloc(n * sizeof(ip6_t));
+                if (*ips6 == NULL){
+                    PyErr_NoMemory();
+                    family = 0;
+                }
+            }
+            if (*ips6 != NULL){
+                (*ips)[i] = IP6_MARK;
+                (*ips6)[i] = ip6;
+            }
+        }
+        if (family == 0){
+            Py_DECREF(seq);
+            PyMem_Free(*ips);
+            PyMem_Free(*ips6);
+            *ips = NULL;
+            *ips6 = NULL;
+            return -1;
+        }
+    }
+    Py_DECREF(seq);
+    return n;
+}
+
+
+/* Resolve a parsed batch into segment indexes, -1 for a miss. No Python
+ * API is used here, so it can run without the GIL as long as the caller
+ * holds references to both dbs. */
+static void
+search_batch(ip_db *db, ip6_db *db6, const uint64_t *ips, const ip6_t *ips6,
+             Py_ssize_t n, Py_ssize_t *result){
+    uint64_t last = 0;
+    ip6_t last6 = {0, 0};
+    Py_ssize_t i, pos = 0, pos6 = 0;
+
+    for(i = 0; i < n; i++){
+        if (ips[i] == IP6_MARK){
+            /* IPv4 and IPv6 keep their own merge position */
+            if (IP6_LT(ips6[i], last6)){
+                pos6 = lower_bound6(db6, ips6[i], 0, db6->size);
+            } else {
+                pos6 = gallop6(db6, ips6[i], pos6);
+            }
+            last6 = ips6[i];
+
+            if (pos6 < db6->size && !IP6_LT(ips6[i], db6->begin[pos6])){
+                result[i] = pos6;
+            } else {
+                result[i] = -1;
+            }
+        } else {
+            if (ips[i] >= last){
+                pos = gallop(db, ips[i], pos);
+            } else {
+                /* out of order, restart from a plain binary search */
+                pos = find(db, ips[i]);
+            }
+            last = ips[i];
+
+            if (pos < db->size && db->begin[pos] <= ips[i]){
+                result[i] = pos;
+            } else {
+                result[i] = -1;
+            }
+        }
+    }
+}
+
+
+static PyObject *
+ip_store_search_many(ip_store_obj *self, PyObject *o){
+
+    uint64_t *ips;
+    ip6_t *ips6;
+    Py_ssize_t n, i, mid, *index;
+    ip_db *db;
+    ip6_db *db6;
+    ip_patch *p;
+    PyObject *result = NULL, *item;
+
+    /* Parsing may run any code, a load() included, so the dbs are taken
+     * after it, with nothing run between shm_refresh and the references. */
+    n = inner_batch_aton(o, &ips, &ips6);
+    if (n < 0){
+        return NULL;
+    }
+
+    index = (Py_ssize_t *)PyMem_Malloc((n ? n : 1) * sizeof(Py_ssize_t));
+    if (index == NULL){
+        PyErr_NoMemory();
+        goto finish;
+    }
+    if (!shm_refresh(self)){
+        goto finish;
+    }
+    db = self->db;
+    db6 = self->db6;
+
+    /* Parsing and building results need the GIL, the search itself does
+     * not. Releasing it costs more than a single lookup, but for a large
+     * batch it lets other threads search the same dbs on other cores. */
+    db->refs++;
+    db6->refs++;
+    if (n >= NOGIL_BATCH){
+        Py_BEGIN_ALLOW_THREADS
+        search_batch(db, db6, ips, ips6, n, index);
+        Py_END_ALLOW_THREADS
+    } else {
+        search_batch(db, db6, ips, ips6, n, index);
+    }
+
+    /* the patches of the store override the db, as in search() */
+    result = PyList_New(n);
+    for(i = 0; result != NULL && i < n; i++){
+        p = NULL;
+        if (self->n_patches > 0 && ips[i] != IP6_MARK){
+            mid = patch_bound(self, (unsigned long)ips[i]);
+            if (mid < self->n_patches && self->patches[mid].begin <= ips[i]){
+                p = self->patches + mid;
+            }
+        }
+
+        if (p != NULL && p->area != NULL){
+            item = PyTuple_Pack(2, p->area, p->isp);
+        } else if (p != NULL || index[i] < 0){
+            Py_INCREF(Py_None);
+            item = Py_None;
+        } else if (ips[i] == IP6_MARK){
+            item = DB_VALUE(db6, index[i]);
+        } else {
+            item = DB_VALUE(db, index[i]);
+        }
+
+        if (item == NULL){
+            Py_CLEAR(result);
+            break;
+        }
+        PyList_SET_ITEM(result, i, item);
+    }
+    release_db(db);
+    release_db6(db6);
+
+finish:
+    PyMem_Free(ips);
+    PyMem_Free(ips6);
+    PyMem_Free(index);
+    return result;
+}
+
+/* copy the indexes of search_batch into a buffer of int32 or int64 */
+static void
+store_index(const Py_ssize_t *index, Py_ssize_t n, void *out,
+            Py_ssize_t itemsize){
+    Py_ssize_t i;
+
+    if (itemsize == 4){
+        for(i = 0; i < n; i++){
+            ((int32_t *)out)[i] = (int32_t)index[i];
+        }
+    } else {
+        for(i = 0; i < n; i++){
+            ((int64_t *)out)[i] = (int64_t)index[i];
+        }
+    }
+}
+
+
+PyDoc_STRVAR(search_index__doc__,
+"search_index(ips, out) -> out, write the index of the segment of each IPv4\n\
+address to out, -1 for a miss, without building any record.\n\n\
+ips is anything search_many() takes, out a writable buffer of as many int32\n\
+or int64, such as array('q') or numpy.empty(n, numpy.int64). get(index)\n\
+then builds the record of an index when needed.");
+
+
+static PyObject *
+ip_store_search_index(ip_store_obj *self, PyObject *args){
+
+    PyObject *o, *out, *result = NULL;
+    Py_buffer view;
+    uint64_t *ips = NULL;
+    ip6_t *ips6 = NULL;
+    Py_ssize_t n, i, *index = NULL;
+    ip_db *db;
+    ip6_db *db6;
+    char fmt;
+
+    if (!PyArg_ParseTuple(args, "OO:search_index", &o, &out)){
+        return NULL;
+    }
+
+    /* getting the buffer and parsing may run any code, a load() included,
+     * so the dbs are taken after them, see search_many */
+    if (PyObject_GetBuffer(out, &view, PyBUF_WRITABLE | PyBUF_FORMAT
+                                       | PyBUF_C_CONTIGUOUS) < 0){
+        return NULL;
+    }
+    fmt = (view.format == NULL) ? 'B' : view.format[0];
+    if (fmt == '@' || fmt == '='){
+        fmt = view.format[1];
+    }
+    if ((fmt != 'i' && fmt != 'l' && fmt != 'q')
+        || (view.itemsize != 4 && view.itemsize != 8)){
+        PyErr_SetString(PyExc_TypeError,
+                        "need a writable buffer of int32 or int64");
+        goto finish;
+    }
+
+    n = inner_batch_aton(o, &ips, &ips6);
+    if (n < 0){
+        goto finish;
+    }
+    if (ips6 != NULL){
+        PyErr_SetString(PyExc_ValueError, "need IPv4 addresses");
+        goto finish;
+    }
+    if (view.len / view.itemsize != n){
+        PyErr_SetString(PyExc_ValueError, "out should have one item per address");
+        goto finish;
+    }
+
+    if (view.itemsize == sizeof(Py_ssize_t)){
+        index = (Py_ssize_t *)view.buf;
+    } else {
+        index = (Py_ssize_t *)PyMem_Malloc((n ? n : 1) * sizeof(Py_ssize_t));
+        if (index == NULL){
+            PyErr_NoMemory();
+            goto finish;
+        }
+    }
+
+    if (!shm_refresh(self) || !sync_view(self)){
+        goto finish;
+    }
+    db = self->db;
+    db6 = self->db6;
+    if (view.itemsize == 4 && view_size(self) > INT32_MAX){
+        PyErr_SetString(PyExc_OverflowError, "too many segments for int32");
+        goto finish;
+    }
 
-static ip_seg* ipdb = NULL;
-static Py_ssize_t ipdb_size = 0;
+    /* with patches, the indexes of the db are turned into positions in the
+     * patched db, the view of the store must not change meanwhile */
+    db->refs++;
+    db6->refs++;
+    if (n >= NOGIL_BATCH && self->n_patches == 0){
+        Py_BEGIN_ALLOW_THREADS
+        search_batch(db, db6, ips, ips6, n, index);
+        if (index != view.buf){
+            store_index(index, n, view.buf, view.itemsize);
+        }
+        Py_END_ALLOW_THREADS
+    } else {
+        search_batch(db, db6, ips, ips6, n, index);
+        for(i = 0; i < n && self->n_patches > 0; i++){
+            index[i] = view_position(self, (unsigned long)ips[i], index[i]);
+        }
+        if (index != view.buf){
+            store_index(index, n, view.buf, view.itemsize);
+        }
+    }
+    release_db(db);
+    release_db6(db6);
 
+    Py_INCREF(out);
+    result = out;
+finish:
+    if (index != view.buf){
+        PyMem_Free(index);
+    }
+    PyMem_Free(ips);
+    PyMem_Free(ips6);
+    PyBuffer_Release(&view);
+    return result;
+}
 
-static int
-inner_atohl(PyObject *o, unsigned long *ip_ul){
-    struct in_addr buf;
-    char *ip_addr;
 
+static PyObject *
+ip_store_size(ip_store_obj *self){
+    if (!shm_refresh(self) || !sync_view(self)){
+        return NULL;
+    }
 #ifdef IS_PY3K
-    if(PyUnicode_CheckExact(o)){
-        ip_addr = PyUnicode_AsUTF8(o);
-    } else if (PyBytes_CheckExact(o)){
-        ip_addr = PyBytes_AsString(o);
-    } else if (PyByteArray_CheckExact(o)){
-        ip_addr =  PyByteArray_AsString(o);
+    return PyLong_FromSsize_t(view_size(self));
 #else
-    if(PyUnicode_CheckExact(o) || PyString_CheckExact(o)){
-        ip_addr =  PyString_AsString(o);
-    } else if (PyByteArray_CheckExact(o)){
-        ip_addr = PyByteArray_AsString(o);
+    return PyInt_FromSsize_t(view_size(self));
 #endif
-    } else {
-        PyErr_SetString(PyExc_TypeError, "should be built-in string/bytes/byte array");
+}
+
+/* Add up the bytes of the values table of a db to *table, and the bytes
+ * the interning saved compared to one object per area/isp to *saved. */
+static int
+values_usage(PyObject **values, Py_ssize_t n_values, const uint32_t *area,
+             const uint32_t *isp, Py_ssize_t size, Py_ssize_t *table,
+             Py_ssize_t *saved){
+    Py_ssize_t *sizes, i, total = 0, referenced = 0;
+    PyObject *res;
+
+    sizes = (Py_ssize_t *)PyMem_Malloc((n_values ? n_values : 1) * sizeof(Py_ssize_t));
+    if (sizes == NULL){
+        PyErr_NoMemory();
         return 0;
     }
 
-    if (ip_addr == NULL){
-        return 0;
+    for(i = 0; i < n_values; i++){
+        res = PyObject_CallMethod(values[i], "__sizeof__", NULL);
+        if (res == NULL){
+            PyMem_Free(sizes);
+            return 0;
+        }
+        sizes[i] = PyLong_AsSsize_t(res);
+        Py_DECREF(res);
+        if (sizes[i] == -1 && PyErr_Occurred()){
+            PyMem_Free(sizes);
+            return 0;
+        }
+        total += sizes[i] + sizeof(PyObject *);
     }
 
-    if (inet_aton(ip_addr, &buf)){
-        *ip_ul = ntohl(buf.s_addr);
-        return 1;
-    }else{
-        PyErr_SetString(PyExc_ValueError,
-                        "illegal IP address string");
-        return 0;
+    for(i = 0; i < size; i++){
+        if (area[i] < (uint32_t)n_values && isp[i] < (uint32_t)n_values){
+            referenced += sizes[area[i]] + sizes[isp[i]] + 2 * sizeof(PyObject *);
+        }
     }
+
+    PyMem_Free(sizes);
+    *table += total;
+    *saved += referenced - total;
+    return 1;
 }
 
 
-static PyObject *
-ip_store_atohl(PyObject *self, PyObject *o){
+PyDoc_STRVAR(memory_usage__doc__,
+"memory_usage() -> dict, bytes used by the IPv4 and IPv6 dbs.\n\n\
+segments, values: number of segments, patches included, and of distinct\n\
+area/isp values of the dbs\n\
+columns: begin, end and value codes of all segments of the dbs\n\
+values_table: the distinct values, objects included\n\
+index: the jump table, if any\n\
+mapped: bytes mapped from a file, included in columns\n\
+patches: the corrections not merged into the IPv4 db yet, see compact()\n\
+saved: bytes saved by interning, compared to one object per area/isp");
 
-    unsigned long ip_ul;
 
-    if(inner_atohl(o, &ip_ul)){
-        return PyLong_FromUnsignedLong(ip_ul);
-    }else{
+static PyObject *
+ip_store_memory_usage(ip_store_obj *self){
+    ip_db *db;
+    ip6_db *db6;
+    Py_ssize_t segments, patches, table = 0, saved = 0;
+    PyObject *result = NULL;
+
+    if (!shm_refresh(self) || !sync_view(self)){
         return NULL;
     }
-}
+    db = self->db;
+    db6 = self->db6;
+    segments = view_size(self) + db6->size;
+    patches = self->patches_cap * sizeof(ip_patch)
+              + 3 * self->n_patches * sizeof(view_item)
+              + self->n_patches * sizeof(view_run);
 
+    /* __sizeof__ may run any code, a load() included */
+    db->refs++;
+    db6->refs++;
+    if (values_usage(db->values, db->n_values, db->area, db->isp, db->size,
+                     &table, &saved)
+        && values_usage(db6->values, db6->n_values, db6->area, db6->isp,
+                        db6->size, &table, &saved)){
+        result = Py_BuildValue("{s:n,s:n,s:n,s:n,s:n,s:n,s:n,s:n}",
+            "segments", segments,
+            "values", db->n_values + db6->n_values,
+            "columns", (Py_ssize_t)(db->size * 4 * sizeof(uint32_t)
+                                    + db6->size * (2 * sizeof(ip6_t) + 2 * sizeof(uint32_t))),
+            "values_table", table,
+            "index", (Py_ssize_t)((db->jump != NULL) ? (JUMP_SIZE + 1) * sizeof(uint32_t) : 0),
+            "mapped", (Py_ssize_t)db->map_len,
+            "patches", patches,
+            "saved", saved);
+    }
+    release_db(db);
+    release_db6(db6);
+    return result;
+}
 
-static void
-free_db(ip_seg* db, Py_ssize_t size){
-    Py_ssize_t i;
 
-    for(i = 0; i < size; i++){
-        Py_XDECREF(db[i].area);
-        Py_XDECREF(db[i].isp);
-    }
-    PyMem_Free(db);
+static PyObject *
+ip_store_size6(ip_store_obj *self){
+    return PyLong_FromSsize_t(self->db6->size);
 }
 
 
 static PyObject *
-build_record(ip_seg seg){
-    PyObject *begin, *end, *record;
+ip_store_swap(ip_store_obj *self, PyObject *o){
+    ip_store_obj *other = (ip_store_obj *)o;
+    ip_db *tmp;
+    ip6_db *tmp6;
+    ip_patch *patches;
+    Py_ssize_t n_patches, patches_cap;
+    ip_shm shm;
 
-    record = PyTuple_New(4);
-    if (record == NULL){
+    if (!PyObject_TypeCheck(o, Py_TYPE(self))){
+        PyErr_SetString(PyExc_TypeError, "need IPStore");
         return NULL;
     }
 
-#ifdef IS_PY3K
-    begin = PyLong_FromUnsignedLong(seg.begin);
-    end = PyLong_FromUnsignedLong(seg.end);
-#else
-    begin = PyInt_FromLong(seg.begin);
-    end = PyInt_FromLong(seg.end);
-#endif
-    if(begin == NULL || end == NULL){
-        Py_XDECREF(begin);
-        Py_XDECREF(end);
-        Py_XDECREF(record);
+    tmp = self->db;
+    self->db = other->db;
+    other->db = tmp;
+    tmp6 = self->db6;
+    self->db6 = other->db6;
+    other->db6 = tmp6;
+    patches = self->patches;
+    n_patches = self->n_patches;
+    patches_cap = self->patches_cap;
+    self->patches = other->patches;
+    self->n_patches = other->n_patches;
+    self->patches_cap = other->patches_cap;
+    other->patches = patches;
+    other->n_patches = n_patches;
+    other->patches_cap = patches_cap;
+    shm = self->shm;
+    self->shm = other->shm;
+    other->shm = shm;
+
+    cache_clear(&self->cache);
+    cache_clear(&other->cache);
+    view_clear(self);
+    view_clear(other);
+
+    /* a failed index only costs speed, the swap itself is done */
+    if (!sync_index(self) || !sync_index(other)){
         return NULL;
     }
-    Py_INCREF(seg.area);
-    Py_INCREF(seg.isp);
+    Py_RETURN_NONE;
+}
 
-    PyTuple_SetItem(record, 0, begin);
-    PyTuple_SetItem(record, 1, end);
-    PyTuple_SetItem(record, 2, seg.area);
-    PyTuple_SetItem(record, 3, seg.isp);
 
-    return record;
+/* parse the bounds of an IPv4 range, as taken by search() */
+static int
+parse_range(PyObject *begin_o, PyObject *end_o, uint32_t *begin,
+            uint32_t *end){
+    unsigned long begin_ul, end_ul;
+    ip6_t ip6;
+    int family;
+
+    family = inner_aton(begin_o, &begin_ul, &ip6);
+    if (family == AF_INET){
+        family = inner_aton(end_o, &end_ul, &ip6);
+    }
+    if (family == 0){
+        return 0;
+    } else if (family == AF_INET6){
+        PyErr_SetString(PyExc_ValueError, "only IPv4 ranges can be patched");
+        return 0;
+    }
+    if (begin_ul > end_ul){
+        PyErr_SetString(PyExc_ValueError, "begin > end");
+        return 0;
+    }
+    *begin = (uint32_t)begin_ul;
+    *end = (uint32_t)end_ul;
+    return 1;
 }
 
 
+/* add a patch, merging them all once there are too many */
 static PyObject *
-ip_store_load(PyObject *self, PyObject *o){
+patch_range(ip_store_obj *self, uint32_t begin, uint32_t end,
+            PyObject *area, PyObject *isp){
+    if (!shm_refresh(self) || !add_patch(self, begin, end, area, isp)){
+        return NULL;
+    }
+    if (self->n_patches > MAX_PATCHES && !merge_patches(self)){
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
 
-    PyObject *record, *item, *item2;
-    Py_ssize_t size, i, j;
-    unsigned long ip_ul;
-    ip_seg* new_db = NULL;
 
-    if(!PySequence_Check(o)){
-        PyErr_SetString(PyExc_TypeError, "need sequence");
+static PyObject *
+ip_store_insert_range(ip_store_obj *self, PyObject *args){
+    PyObject *begin_o, *end_o, *area, *isp;
+    uint32_t begin, end;
+
+    if (!PyArg_ParseTuple(args, "OOOO:insert_range", &begin_o, &end_o,
+                          &area, &isp)
+        || !parse_range(begin_o, end_o, &begin, &end)){
         return NULL;
     }
-
-    size = PySequence_Length(o);
-    if(size < 0){
+    /* against the generation the patch will go over */
+    if (!shm_refresh(self)){
         return NULL;
-    }else if (size == 0){
-        goto finish;
     }
+    if (!range_is_free(self, begin, end)){
+        PyErr_SetString(PyExc_ValueError, "range overlaps an existing segment");
+        return NULL;
+    }
+    return patch_range(self, begin, end, area, isp);
+}
 
-    new_db = (ip_seg*)PyMem_Malloc(size * sizeof(ip_seg));
-    if(new_db == NULL){
-        return PyErr_NoMemory();
-    }else{
-        for(i = 0; i < size; i++){
-            new_db[i].area = NULL;
-            new_db[i].isp = NULL;
-        }
+
+static PyObject *
+ip_store_update_range(ip_store_obj *self, PyObject *args){
+    PyObject *begin_o, *end_o, *area, *isp;
+    uint32_t begin, end;
+
+    if (!PyArg_ParseTuple(args, "OOOO:update_range", &begin_o, &end_o,
+                          &area, &isp)
+        || !parse_range(begin_o, end_o, &begin, &end)){
+        return NULL;
     }
+    return patch_range(self, begin, end, area, isp);
+}
 
-    for(i = 0; i < size; i++){
-        record = PySequence_GetItem(o, i);
-        if (!PySequence_Check(record)){
-            PyErr_SetString(PyExc_TypeError, "need sequence for each record");
-            goto record_failed;
-        }
 
-        for(j = 0; j < 2; j++){
-            item = PySequence_GetItem(record, j);
-            if(item == NULL){
-                goto record_failed;
-            }
-#ifdef IS_PY3K
-            if(!PyLong_Check(item)){
-#else
-            if(!PyInt_CheckExact(item)){
-#endif
-                Py_DECREF(item);
-                PyErr_Format(PyExc_TypeError,
-                             "expected int, %s found",
-                             Py_TYPE(item)->tp_name); 
-                goto record_failed;
-            }
+static PyObject *
+ip_store_delete_range(ip_store_obj *self, PyObject *args){
+    PyObject *begin_o, *end_o;
+    uint32_t begin, end;
 
-#ifdef IS_PY3K
-            ip_ul = PyLong_AsUnsignedLong(item);
-            if (ip_ul == (unsigned long) -1 && PyErr_Occurred()){
-                Py_DECREF(item);
-                goto record_failed;
-            }
-#else
-            ip_ul = PyInt_AsUnsignedLongMask(item);
-#endif
+    if (!PyArg_ParseTuple(args, "OO:delete_range", &begin_o, &end_o)
+        || !parse_range(begin_o, end_o, &begin, &end)){
+        return NULL;
+    }
+    return patch_range(self, begin, end, NULL, NULL);
+}
 
-            ((unsigned long *)(new_db + i))[j] = ip_ul;
-            Py_DECREF(item);
-        }
 
-        item = PySequence_GetItem(record, 2);
-        item2 = PySequence_GetItem(record, 3);
-        if(item == NULL || item2 == NULL){
-            Py_XDECREF(item);
-            Py_XDECREF(item2);
-            goto record_failed;
-        }
-        new_db[i].area = item;
-        new_db[i].isp = item2;
+static PyObject *
+ip_store_compact(ip_store_obj *self){
+    if (!sync_db(self)){
+        return NULL;
     }
-    
-finish:    
-    free_db(ipdb, ipdb_size);
-    ipdb_size = size;
-    ipdb = new_db;
     Py_RETURN_NONE;
-record_failed:
-    Py_XDECREF(record);
-    free_db(new_db, size);
-    return NULL;
 }
 
 
-static PyObject *
-ip_store_get(PyObject *self, PyObject *o){
+static void
+ip_store_dealloc(ip_store_obj *self){
+    if (self->db != NULL){
+        release_db(self->db);
+    }
+    if (self->db6 != NULL){
+        release_db6(self->db6);
+    }
+    clear_patches(self);
+    shm_detach(self);
+    PyMem_Free(self->cache.entries);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
 
-    Py_ssize_t i;
 
-#ifdef IS_PY3K
-    if(!PyLong_Check(o)){
-#else
-    if(!PyInt_CheckExact(o)){
-#endif
-        PyErr_SetString(PyExc_TypeError, "need int");
+static PyObject *
+ip_store_new(PyTypeObject *type, PyObject *args, PyObject *kwds){
+    ip_store_obj *self;
+
+    self = (ip_store_obj *)type->tp_alloc(type, 0);
+    if (self == NULL){
         return NULL;
     }
 
-#ifdef IS_PY3K
-    i = PyLong_AsSsize_t(o);
-    if(PyErr_Occurred()){
+    self->use_index = 1;
+    memset(&self->cache, 0, sizeof(ip_cache));
+    self->db = alloc_db(0);
+    self->db6 = alloc_db6(0);
+    if (self->db == NULL || self->db6 == NULL){
+        Py_DECREF(self);
         return NULL;
     }
-#else
-    i = PyInt_AsSsize_t(o);
-#endif
+    return (PyObject *)self;
+}
 
-    if (i < 0 || i > ipdb_size -1){
-        PyErr_SetString(PyExc_IndexError, "");
-        return NULL;
+
+static int
+set_cache(ip_store_obj *self, Py_ssize_t size){
+    cache_entry *entries = NULL;
+    Py_ssize_t n = CACHE_MIN_SIZE;
+
+    if (size < 0){
+        PyErr_SetString(PyExc_ValueError, "cache size should be >= 0");
+        return 0;
+    }
+    if (size > 0){
+        while(n < size){
+            n <<= 1;
+        }
+        entries = (cache_entry *)PyMem_Malloc(n * sizeof(cache_entry));
+        if (entries == NULL){
+            PyErr_NoMemory();
+            return 0;
+        }
+        memset(entries, 0, n * sizeof(cache_entry));
     }
 
-    return build_record(ipdb[i]);
+    PyMem_Free(self->cache.entries);
+    memset(&self->cache, 0, sizeof(ip_cache));
+    self->cache.entries = entries;
+    self->cache.mask = n - 1;
+    self->cache.gen = 1;
+    return 1;
 }
 
 
 static PyObject *
-ip_store_search(PyObject *self, PyObject *o){
-
-    int found = 0;
-    unsigned long ip_ul;
-    Py_ssize_t begin = 0, end = ipdb_size -1, mid;
-    ip_seg *m_record;
-    PyObject *result;
+ip_store_set_cache(ip_store_obj *self, PyObject *o){
+    Py_ssize_t size;
 
-    if (ipdb_size == 0){
-        Py_RETURN_NONE;
+    size = PyNumber_AsSsize_t(o, PyExc_OverflowError);
+    if (size == -1 && PyErr_Occurred()){
+        return NULL;
     }
-
-    if(!inner_atohl(o, &ip_ul)){
+    if (!set_cache(self, size)){
         return NULL;
     }
+    Py_RETURN_NONE;
+}
 
-    /* releasing GIL has been tested in the situation where there is
-     * no IO operation. The result is that releasing GIL make worse
-     * performance */
-
-    /*
-    Py_INCREF(o);
-    Py_BEGIN_ALLOW_THREADS */
-
-    while(begin <= end){
-        mid = (begin + end)/2;
-        m_record = ipdb + mid;
-
-        if (ip_ul < m_record->begin){
-            end = mid - 1;
-        } else if (ip_ul > m_record->end){
-            begin = mid + 1;
-        } else{
-            if (ip_ul <= m_record->end && ip_ul >= m_record->begin){
-                found = 1;
-            }
-            break;
-        }
-    }
 
-    /*
-    Py_END_ALLOW_THREADS
-    Py_DECREF(o); */
+static PyObject *
+ip_store_cache_info(ip_store_obj *self){
+    return Py_BuildValue("{s:n,s:n,s:n}",
+        "hits", self->cache.hits,
+        "misses", self->cache.misses,
+        "size", (self->cache.entries == NULL) ? 0 : self->cache.mask + 1);
+}
 
-    if (found){
-        result = PyTuple_New(2);
-        if (result == NULL){
-            return NULL;
-        }
 
-        Py_INCREF(m_record->area);
-        Py_INCREF(m_record->isp);
-        PyTuple_SetItem(result, 0, m_record->area);
-        PyTuple_SetItem(result, 1, m_record->isp);
+static int
+ip_store_init(ip_store_obj *self, PyObject *args, PyObject *kwds){
+    static char *kwlist[] = {"index", "cache", NULL};
+    PyObject *index = Py_True;
+    Py_ssize_t cache = 0;
+    int use_index;
 
-        return result;
-    } else {
-        Py_RETURN_NONE;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|On:IPStore", kwlist,
+                                     &index, &cache)){
+        return -1;
     }
+    use_index = PyObject_IsTrue(index);
+    if (use_index < 0){
+        return -1;
+    }
+    self->use_index = use_index;
+    if (!set_cache(self, cache)){
+        return -1;
+    }
+    return sync_index(self) ? 0 : -1;
 }
 
+
 static PyObject *
-ip_store_size(PyObject *self){
-#ifdef IS_PY3K
-    return PyLong_FromSsize_t(ipdb_size);
-#else
-    return PyInt_FromSsize_t(ipdb_size);
-#endif
+ip_store_unlink_shared(PyObject *self, PyObject *args){
+
+    const char *name;
+    char path[IPSHM_PATH_MAX];
+    ipshm_header *header;
+    uint64_t generation;
+
+    if (!PyArg_ParseTuple(args, "s:unlink_shared", &name)){
+        return NULL;
+    }
+
+    header = shm_map_header(name, 0);
+    if (header == MAP_FAILED){
+        return NULL;
+    }
+    generation = header->generation;
+    munmap(header, sizeof(ipshm_header));
+
+    if (generation > 0 && shm_path(path, name, generation)){
+        shm_unlink(path);
+    }
+    if (shm_path(path, name, 0) && shm_unlink(path) < 0){
+        PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+    }
+    if (PyErr_Occurred()){
+        return NULL;
+    }
+    Py_RETURN_NONE;
 }
 
-static PyMethodDef methods[] = {
-    {"atohl",  (PyCFunction)ip_store_atohl, METH_O,
-     "convert an ip address in dotted format to host long integer."},
+
+/* these are also exported as module functions bound to the default store */
+static PyMethodDef store_methods[] = {
     {"load",  (PyCFunction)ip_store_load, METH_O,
      "load ipdb."},
     {"search",  (PyCFunction)ip_store_search, METH_O,
-     "search by ip."},
+     "search by ip, given as a string (str or bytes), a host int or 4\n"
+     "packed bytes in a memoryview or other buffer. IPv6 addresses are\n"
+     "searched in the IPv6 db."},
+    {"search_many",  (PyCFunction)ip_store_search_many, METH_O,
+     "search a batch of ips given as a sequence of anything search()\n"
+     "takes, a buffer of uint32 or a buffer of packed addresses. Return a\n"
+     "list of results."},
+    {"search_index",  (PyCFunction)ip_store_search_index, METH_VARARGS,
+     search_index__doc__},
+    {"search_range",  (PyCFunction)ip_store_search_range, METH_VARARGS,
+     "search_range(begin, end) -> range of the indexes of the segments\n"
+     "intersecting [begin, end], to be read with get(), or get6() for IPv6."},
+    {"search_cidr",  (PyCFunction)ip_store_search_cidr, METH_O,
+     "search_cidr(cidr) -> range of the indexes of the segments intersecting\n"
+     "a block such as '10.0.0.0/8' or '2001:db8::/32', see search_range()."},
+    {"load_file",  (PyCFunction)ip_store_load_file, METH_VARARGS | METH_KEYWORDS,
+     "load_file(path, delimiter=','), stream records 'begin,end,area,isp'\n"
+     "from a text file, validating that they are sorted and do not overlap."},
+    {"dump",  (PyCFunction)ip_store_dump, METH_VARARGS,
+     "dump(path), write ipdb to a binary file that load_mapped() can map."},
+    {"load_mapped",  (PyCFunction)ip_store_load_mapped, METH_VARARGS,
+     "load_mapped(path), map a file written by dump() read-only and search\n"
+     "directly against it."},
     {"size",  (PyCFunction)ip_store_size, METH_NOARGS,
      "current size of db_store."},
     {"get",  (PyCFunction)ip_store_get, METH_O,
      "get one record by positive index"},
+    {"load6",  (PyCFunction)ip_store_load6, METH_O,
+     "load the IPv6 db, begin and end are ints in [0, 2**128)."},
+    {"size6",  (PyCFunction)ip_store_size6, METH_NOARGS,
+     "current size of the IPv6 db."},
+    {"get6",  (PyCFunction)ip_store_get6, METH_O,
+     "get one IPv6 record by positive index"},
+    {"memory_usage",  (PyCFunction)ip_store_memory_usage, METH_NOARGS,
+     memory_usage__doc__},
+    {"set_cache",  (PyCFunction)ip_store_set_cache, METH_O,
+     "set_cache(size), cache the last IPv4 lookups of search() in about\n"
+     "size entries, 0 disables the cache. Counters are reset."},
+    {"cache_info",  (PyCFunction)ip_store_cache_info, METH_NOARGS,
+     "cache_info() -> dict of hits, misses and size of the cache."},
+    {"swap",  (PyCFunction)ip_store_swap, METH_O,
+     "swap(other), exchange the databases of two stores atomically."},
+    {"insert_range",  (PyCFunction)ip_store_insert_range, METH_VARARGS,
+     "insert_range(begin, end, area, isp), add a segment where there was\n"
+     "none, begin and end are addresses as taken by search(). Range changes\n"
+     "of an attached store are dropped when it switches generation."},
+    {"update_range",  (PyCFunction)ip_store_update_range, METH_VARARGS,
+     "update_range(begin, end, area, isp), make [begin, end] a segment,\n"
+     "cutting the segments it overlaps. Dropped like insert_range()."},
+    {"delete_range",  (PyCFunction)ip_store_delete_range, METH_VARARGS,
+     "delete_range(begin, end), remove [begin, end] from the segments it\n"
+     "overlaps. Dropped like insert_range()."},
+    {"publish",  (PyCFunction)ip_store_publish, METH_VARARGS,
+     publish__doc__},
+    {"attach",  (PyCFunction)ip_store_attach, METH_VARARGS,
+     "attach(name), follow the shared db name read-only: each call switches\n"
+     "to the last generation published, if any, dropping the range changes\n"
+     "made since the previous one. load(), load_file() and load_mapped()\n"
+     "detach."},
+    {"detach",  (PyCFunction)ip_store_detach, METH_NOARGS,
+     "detach(), stop following the shared db, keeping the current one."},
+    {"compact",  (PyCFunction)ip_store_compact, METH_NOARGS,
+     "compact(), merge the pending range changes into the db now. They\n"
+     "are merged anyway when too many, and before dump() and publish().\n"
+     "Searches and the other reads see them without merging."},
+    {NULL, NULL, 0, NULL}        /* Sentinel */
+};
+
+
+static PyTypeObject IPStoreType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "ip_store.IPStore",        /* tp_name */
+    sizeof(ip_store_obj),      /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)ip_store_dealloc, /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT |
+        Py_TPFLAGS_BASETYPE,   /* tp_flags */
+    "IPStore(index=True, cache=0)\n\n"
+    "Independent ip database. With index, a prefix jump table is built at\n"
+    "load time to speed up lookups at the cost of 256KB. With cache, the\n"
+    "last IPv4 lookups of search() are cached, see set_cache().", /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    0,                         /* tp_iter */
+    0,                         /* tp_iternext */
+    store_methods,             /* tp_methods */
+    NULL,                      /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc)ip_store_init,   /* tp_init */
+    0,                         /* tp_alloc */
+    ip_store_new,              /* tp_new */
+};
+
+
+static PyMethodDef methods[] = {
+    {"atohl",  (PyCFunction)ip_store_atohl, METH_O,
+     "convert an ip address in dotted format to host long integer."},
+    {"unlink_shared",  (PyCFunction)ip_store_unlink_shared, METH_VARARGS,
+     "unlink_shared(name), remove the shared db name. Attached stores keep\n"
+     "the generation they have."},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
@@ -354,6 +3546,9 @@ PyMODINIT_FUNC
 initip_store(void)
 #endif
 {
+    PyObject *store, *func;
+    PyMethodDef *def;
+
     #ifdef IS_PY3K
     PyObject *module = PyModule_Create(&spammodule);
     #else
@@ -363,6 +3558,24 @@ initip_store(void)
     if (module == NULL)
         INITERROR;
 
+    if (PyType_Ready(&IPStoreType) < 0)
+        INITERROR;
+    Py_INCREF(&IPStoreType);
+    PyModule_AddObject(module, "IPStore", (PyObject *)&IPStoreType);
+
+    store = PyObject_CallObject((PyObject *)&IPStoreType, NULL);
+    if (store == NULL)
+        INITERROR;
+    for(def = store_methods; def->ml_name != NULL; def++){
+        func = PyObject_GetAttrString(store, def->ml_name);
+        if (func == NULL || PyModule_AddObject(module, def->ml_name, func) < 0){
+            Py_XDECREF(func);
+            Py_DECREF(store);
+            INITERROR;
+        }
+    }
+    PyModule_AddObject(module, "default", store);
+
 #ifdef IS_PY3K
     return module;
 #endif
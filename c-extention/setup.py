@@ -2,14 +2,18 @@
 import sys
 from distutils.core import setup, Extension
 
-m_ipstore_2_3 = Extension("ip_store", ["ip_store.c"])
+# shm_open is in librt before glibc 2.34
+m_ipstore_2_3 = Extension("ip_store", ["ip_store.c"],
+                          libraries=["rt"] if sys.platform.startswith("linux") else [])
 m_func_example_2_3 = Extension('basic_func',
                                sources=['basic_func.c'])
 
 m_obj_example_2 = Extension("simple_obj", ["simple_obj.c"])
 
 m_sort_3 = Extension("sort_example", ["sort_example.c"])
-m_tree_3 = Extension("tree", ["tree.c"])
+# pthread_rwlock_* is in libpthread before glibc 2.34
+m_tree_3 = Extension("tree", ["tree.c"],
+                     libraries=["pthread"] if sys.platform.startswith("linux") else [])
 
 
 m_list = [m_func_example_2_3, m_ipstore_2_3]
@@ -0,0 +1,234 @@
+"""Benchmark of ip_store lookups.
+
+Run from c-extention after building, for example:
+
+    python -m test.bench_ipdb --sizes 10000,1000000 --output bench.jsonl
+
+Each measurement is written as one JSON object per line, so that runs can be
+compared by a script. A short summary is printed to stderr.
+"""
+
+import argparse
+import array
+import gc
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+import ip_store
+
+
+AREAS = ["area%d" % i for i in range(300)]
+ISPS = ["isp%d" % i for i in range(30)]
+
+
+def make_columns(size, rnd):
+    """begin and end columns of size segments, each followed by a gap"""
+    step = 2 ** 32 // size
+    if step < 4:
+        raise ValueError("too many segments: %s" % size)
+
+    begin = array.array("I", range(0, size * step, step))
+    end = array.array("I", (b + rnd.randint(0, step * 3 // 4 - 1)
+                            for b in begin))
+    return begin, end
+
+
+def write_csv(path, begin, end, rnd):
+    with open(path, "w") as f:
+        for i in range(len(begin)):
+            f.write("%d,%d,%s,%s\n" % (begin[i], end[i], rnd.choice(AREAS),
+                                       rnd.choice(ISPS)))
+
+
+def make_probes(begin, end, n, hit_ratio, sequential, rnd):
+    probes = array.array("I")
+    size = len(begin)
+    for _ in range(n):
+        i = rnd.randrange(size)
+        if rnd.random() < hit_ratio:
+            probes.append(rnd.randint(begin[i], end[i]))
+        else:
+            probes.append(end[i] + 1)
+    if sequential:
+        probes = array.array("I", sorted(probes))
+    return probes
+
+
+def py_search(begin, end, ip_int):
+    """the pure-Python search of test_ipdb, over the two columns"""
+    lo = 0
+    hi = len(begin) - 1
+
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        if ip_int < begin[mid]:
+            hi = mid - 1
+        elif ip_int > end[mid]:
+            lo = mid + 1
+        else:
+            return mid
+    return None
+
+
+def htoa(ip_int):
+    return socket.inet_ntoa(struct.pack("!I", ip_int))
+
+
+def best_of(repeat, func):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        t = time.perf_counter()
+        func()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def lookup_cases(store, begin, end, probes, py_limit):
+    """yield (impl, input, n, function) for each way of searching probes"""
+    ints = probes.tolist()
+    strs = [htoa(ip) for ip in ints]
+    out = array.array("q", [0]) * len(probes)
+    search = store.search
+
+    def c_single_int():
+        for ip in ints:
+            search(ip)
+
+    def c_single_str():
+        for ip in strs:
+            search(ip)
+
+    py_probes = ints[:py_limit]
+
+    def py_single_int():
+        for ip in py_probes:
+            py_search(begin, end, ip)
+
+    yield "c", "int", len(ints), c_single_int
+    yield "c", "str", len(strs), c_single_str
+    yield "c_batch", "list", len(ints), lambda: store.search_many(ints)
+    yield "c_batch", "buffer", len(ints), lambda: store.search_many(probes)
+    yield "c_index", "buffer", len(ints), lambda: store.search_index(probes, out)
+    if py_probes:
+        yield "python", "int", len(py_probes), py_single_int
+
+
+def run_size(size, args, emit):
+    rnd = random.Random(args.seed)
+    begin, end = make_columns(size, rnd)
+
+    store = ip_store.IPStore(index=not args.no_index, cache=args.cache)
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        write_csv(path, begin, end, rnd)
+        t = best_of(1, lambda: store.load_file(path))
+        emit(case="load_file", size=size, seconds=t,
+             rows_per_sec=size / t)
+    finally:
+        os.unlink(path)
+
+    if size <= args.list_max:
+        rows = [store.get(i) for i in range(size)]
+        t = best_of(1, lambda: store.load(rows))
+        emit(case="load", size=size, seconds=t, rows_per_sec=size / t)
+        del rows
+
+    usage = store.memory_usage()
+    usage.update(case="memory", size=size,
+                 max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    emit(**usage)
+
+    for hit_ratio in args.hit_ratios:
+        for sequential in (False, True):
+            probes = make_probes(begin, end, args.probes, hit_ratio,
+                                 sequential, rnd)
+            for impl, kind, n, func in lookup_cases(store, begin, end, probes,
+                                                    args.py_probes):
+                t = best_of(args.repeat, func)
+                emit(case="search", size=size, impl=impl, input=kind,
+                     order="sequential" if sequential else "random",
+                     hit_ratio=hit_ratio, n=n, seconds=t,
+                     ops_per_sec=n / t, ns_per_lookup=t * 1e9 / n)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="benchmark ip_store lookups")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma separated numbers of segments, up to "
+                             "50000000 with enough memory")
+    parser.add_argument("--probes", type=int, default=100000,
+                        help="lookups per measurement")
+    parser.add_argument("--py-probes", type=int, default=10000,
+                        help="lookups for the pure-Python search, 0 to skip")
+    parser.add_argument("--hit-ratios", default="1.0,0.5",
+                        help="comma separated ratios of probes that hit")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="best of this many runs")
+    parser.add_argument("--list-max", type=int, default=2000000,
+                        help="also time load() of a list up to this size")
+    parser.add_argument("--cache", type=int, default=0,
+                        help="cache size of the store, see IPStore")
+    parser.add_argument("--no-index", action="store_true",
+                        help="do not build the jump table")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="file for the JSON lines, "
+                                         "default stdout")
+    parser.add_argument("--profile", action="store_true",
+                        help="run under cProfile, stats go to stderr")
+
+    args = parser.parse_args(argv)
+    args.sizes = [int(s) for s in args.sizes.split(",")]
+    args.hit_ratios = [float(r) for r in args.hit_ratios.split(",")]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    out = open(args.output, "w") if args.output else sys.stdout
+
+    def emit(**record):
+        out.write(json.dumps(record, sort_keys=True) + "\n")
+        out.flush()
+        if record["case"] == "search":
+            sys.stderr.write("%(size)10d %(impl)-8s %(input)-6s %(order)-10s "
+                             "hit=%(hit_ratio).2f %(ns_per_lookup)10.1f ns\n"
+                             % record)
+        elif "seconds" in record:
+            sys.stderr.write("%(size)10d %(case)-27s %(seconds)10.3f s\n"
+                             % record)
+
+    emit(case="meta", python=platform.python_version(),
+         platform=platform.platform(), argv=sys.argv[1:], time=time.time())
+
+    def run():
+        for size in args.sizes:
+            run_size(size, args, emit)
+
+    try:
+        if args.profile:
+            import cProfile
+            import pstats
+            profile = cProfile.Profile()
+            profile.runcall(run)
+            pstats.Stats(profile, stream=sys.stderr).sort_stats(
+                "cumulative").print_stats(30)
+        else:
+            run()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,14 @@
 
+import os
 import sys
+import array
+import binascii
+import ctypes
+import shutil
 import socket
 import struct
+import tempfile
+import threading
 import timeit
 import unittest
 from random import randint
@@ -111,6 +118,7 @@ class Test(unittest.TestCase):
 
     def setUp(self):
         ip_store.load([])
+        ip_store.load6([])
 
     def test_atohl(self):
         ip_list = ["127.0.0.1", "0.0.0.0", "255.255.255.255",
@@ -186,8 +194,9 @@ class Test(unittest.TestCase):
             self.assertTrue(ref_count + change == ref_count_new,
                             (name, ref_count, ref_count_new))
 
-        test_ok(test_db1, 4, "test_db1")
-        test_ok(test_db2, 6, "test_db2")
+        # equal values are interned, so only one reference is held
+        test_ok(test_db1, 1, "test_db1")
+        test_ok(test_db2, 1, "test_db2")
         test_ok(test_db3, 0, "test_db3")
 
         for i in range(2):
@@ -214,6 +223,489 @@ class Test(unittest.TestCase):
         with self.assertRaises(IndexError):
             ip_store.get(1)
 
+    def test_dump_load_mapped(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, "ip.db")
+        try:
+            test_db = [(1, 2, 'a', 'isp1'),
+                       (3, 4, 'b', 'isp1'),
+                       (10, 2**32 - 1, u'\u4e2d\u56fd', 'isp2')]
+            ip_store.load(test_db)
+            ip_store.dump(path)
+            ip_store.load([])
+
+            ip_store.load_mapped(path)
+            self.assertTrue(ip_store.size() == len(test_db))
+            for i in range(len(test_db)):
+                self.assertTrue(ip_store.get(i) == test_db[i])
+            self.assertTrue(ip_store.search("0.0.0.4") == ('b', 'isp1'))
+            self.assertTrue(ip_store.search("0.0.0.5") is None)
+            self.assertTrue(ip_store.search_many(["0.0.0.1", "255.0.0.1"]) ==
+                            [('a', 'isp1'), (u'\u4e2d\u56fd', 'isp2')])
+
+            # dump a mapped db again, then replace the file being mapped
+            ip_store.dump(path)
+            ip_store.load_mapped(path)
+            self.assertTrue(ip_store.get(2) == test_db[2])
+
+            ip_store.load([(1, 2, 1, 2)])
+            with self.assertRaises(TypeError):
+                ip_store.dump(path)
+
+            with open(path, "wb") as f:
+                f.write(b"IPSTORE0" + b"\0" * 100)
+            with self.assertRaises(ValueError):
+                ip_store.load_mapped(path)
+            with self.assertRaises(OSError):
+                ip_store.load_mapped(os.path.join(tmp_dir, "missing"))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_shared(self):
+        name = "ip_store_test_%d" % os.getpid()
+        loader = ip_store.IPStore()
+        worker = ip_store.IPStore()
+        loader.load([(1, 2, 'a', 'isp1')])
+        loader.publish(name)
+        try:
+            worker.attach(name)
+            self.assertTrue(worker.search(1) == ('a', 'isp1'))
+
+            # picked up on the next call
+            loader.load([(1, 2, 'b', 'isp1'), (5, 6, 'c', 'isp2')])
+            loader.publish(name)
+            self.assertTrue(worker.search(5) == ('c', 'isp2'))
+            self.assertTrue(worker.size() == 2)
+            self.assertTrue(worker.memory_usage()["mapped"] > 0)
+
+            loader.load([(1, 2, 1, 2)])
+            with self.assertRaises(TypeError):
+                loader.publish(name)
+            self.assertTrue(worker.size() == 2)
+
+            # a detached store keeps its generation
+            worker.detach()
+            loader.load([])
+            loader.publish(name)
+            self.assertTrue(worker.search(1) == ('b', 'isp1'))
+            other = ip_store.IPStore()
+            other.attach(name)
+            self.assertTrue(other.size() == 0)
+
+            # range changes go over the last generation, until the next
+            loader.load([(10, 20, 'e', 'isp3')])
+            loader.publish(name)
+            with self.assertRaises(ValueError):
+                other.insert_range(10, 15, 'f', 'f')
+            other.update_range(30, 40, 'g', 'g')
+            self.assertTrue(other.search(35) == ('g', 'g'))
+            loader.publish(name)
+            self.assertTrue(other.search(35) is None)
+            self.assertTrue(other.search(15) == ('e', 'isp3'))
+        finally:
+            ip_store.unlink_shared(name)
+
+        self.assertTrue(worker.search(6) == ('c', 'isp2'))
+        with self.assertRaises(OSError):
+            worker.attach(name)
+        with self.assertRaises(ValueError):
+            worker.attach("x" * 300)
+
+    def test_independent_stores(self):
+        geo = ip_store.IPStore()
+        asn = ip_store.IPStore()
+        geo.load([(1, 2, 'a', 'a')])
+        asn.load([(1, 2, 'b', 'b'), (3, 4, 'b', 'b')])
+
+        self.assertTrue(ip_store.size() == 0)
+        self.assertTrue(geo.size() == 1 and asn.size() == 2)
+        self.assertTrue(geo.search("0.0.0.1") == ('a', 'a'))
+        self.assertTrue(asn.search("0.0.0.1") == ('b', 'b'))
+
+        # build aside and swap in
+        geo.swap(asn)
+        self.assertTrue(geo.size() == 2 and asn.size() == 1)
+        self.assertTrue(geo.search("0.0.0.1") == ('b', 'b'))
+        ip_store.default.swap(geo)
+        self.assertTrue(ip_store.size() == 2)
+        self.assertTrue(ip_store.search("0.0.0.3") == ('b', 'b'))
+
+        with self.assertRaises(TypeError):
+            geo.swap([])
+
+        ref_count = sys.getrefcount('a')
+        del asn
+        self.assertTrue(sys.getrefcount('a') == ref_count - 1)
+
+
+    def test_ipv6(self):
+        def aton6(ip):
+            return int(binascii.hexlify(socket.inet_pton(socket.AF_INET6, ip)), 16)
+
+        test_db = [(aton6("::1"), aton6("::ff"), 'a', 'a'),
+                   (aton6("2001:db8::"), aton6("2001:db8::ffff"), 'b', 'b'),
+                   (aton6("fe80::"), 2**128 - 1, 'c', 'c')]
+        ip_store.load([(1, 2, 'v4', 'v4')])
+        ip_store.load6(test_db)
+        self.assertTrue(ip_store.size() == 1 and ip_store.size6() == 3)
+        for i in range(len(test_db)):
+            self.assertTrue(ip_store.get6(i) == test_db[i])
+
+        self.assertTrue(ip_store.search("0.0.0.1") == ('v4', 'v4'))
+        self.assertTrue(ip_store.search("::1") == ('a', 'a'))
+        self.assertTrue(ip_store.search(b"2001:db8::1:0") is None)
+        self.assertTrue(ip_store.search("2001:db8::abcd") == ('b', 'b'))
+        self.assertTrue(ip_store.search("ffff::1") == ('c', 'c'))
+        self.assertTrue(ip_store.search("::") is None)
+        with self.assertRaises(ValueError):
+            ip_store.search("2001:db8:::1")
+
+        ips = ["ffff::1", "0.0.0.2", "::5", "0.0.0.3", "2001:db8::1", "::1"]
+        self.assertTrue(ip_store.search_many(ips) ==
+                        [('c', 'c'), ('v4', 'v4'), ('a', 'a'), None,
+                         ('b', 'b'), ('a', 'a')])
+
+        with self.assertRaises(OverflowError):
+            ip_store.load6([(-1, 1, 'a', 'a')])
+        with self.assertRaises(OverflowError):
+            ip_store.load6([(0, 2**128, 'a', 'a')])
+        with self.assertRaises(TypeError):
+            ip_store.load6([("::1", 1, 'a', 'a')])
+        with self.assertRaises(IndexError):
+            ip_store.load6([(1, 1, 'a')])
+        self.assertTrue(ip_store.size6() == 3)
+
+        ip_store.load6([])
+        self.assertTrue(ip_store.search("::1") is None)
+
+
+    def test_index(self):
+        test_db = [(1, 2, 'a', 'a'),
+                   (65530, 65540, 'b', 'b'),
+                   (3 << 16, 5 << 16, 'c', 'c'),
+                   (2**32 - 2, 2**32 - 1, 'd', 'd')]
+        probes = ["0.0.0.0", "0.0.0.2", "0.0.255.250", "0.1.0.4", "0.1.0.5",
+                  "0.3.0.0", "0.4.255.255", "0.5.0.0", "0.5.0.1",
+                  "255.255.255.253", "255.255.255.255"]
+        with_index = ip_store.IPStore()
+        without_index = ip_store.IPStore(index=False)
+        with_index.load(test_db)
+        without_index.load(test_db)
+        for probe in probes:
+            self.assertTrue(with_index.search(probe) == without_index.search(probe),
+                            probe)
+        self.assertTrue(with_index.search("0.1.0.0") == ('b', 'b'))
+
+        # the index follows the store, not the db
+        with_index.swap(without_index)
+        for probe in probes:
+            self.assertTrue(with_index.search(probe) == without_index.search(probe),
+                            probe)
+
+
+    def test_load_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, "ip.csv")
+
+        def write(content):
+            with open(path, "wb" if isinstance(content, bytes) else "w") as f:
+                f.write(content)
+
+        try:
+            write("# begin,end,area,isp\n"
+                  "1,2,a,isp1\n"
+                  "\n"
+                  " 0.0.0.3 , 0.0.0.4 , b , isp1\r\n"
+                  "10,4294967295,a,isp2\n")
+            ip_store.load_file(path)
+            self.assertTrue(ip_store.size() == 3)
+            self.assertTrue([ip_store.get(i) for i in range(3)] ==
+                            [(1, 2, 'a', 'isp1'), (3, 4, 'b', 'isp1'),
+                             (10, 2**32 - 1, 'a', 'isp2')])
+            self.assertTrue(ip_store.search("0.0.0.4") == ('b', 'isp1'))
+            # repeated strings are interned
+            self.assertTrue(ip_store.get(0)[2] is ip_store.get(2)[2])
+
+            write("1|2|a|b\n")
+            ip_store.load_file(path, delimiter="|")
+            self.assertTrue(ip_store.get(0) == (1, 2, 'a', 'b'))
+
+            bad_files = [("1,2,a,b\n2,3,a,b\n", "line 2"),
+                         ("5,6,a,b\n1,2,a,b\n", "line 2"),
+                         ("1,2,a,b\n\n4,3,a,b\n", "line 3"),
+                         ("1,4294967296,a,b\n", "line 1"),
+                         ("1,x,a,b\n", "line 1"),
+                         ("1,2,a\n", "line 1"),
+                         ("1,2,a,b,c\n", "line 1"),
+                         (b"1,2,a,b\n3,4,\xff,b\n", "line 2"),
+                         (b"1,2,\xff,\xfe\n", "line 1")]
+            for content, error in bad_files:
+                write(content)
+                with self.assertRaises(ValueError) as cm:
+                    ip_store.load_file(path)
+                self.assertTrue(str(cm.exception).startswith(error),
+                                (content, str(cm.exception)))
+            self.assertTrue(ip_store.size() == 1)
+
+            with self.assertRaises(OSError):
+                ip_store.load_file(os.path.join(tmp_dir, "missing"))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_interning(self):
+        # a fresh string per row, as read from a file
+        test_db = [(i * 10, i * 10 + 5, "area%s" % (i % 3), "isp%s" % (i % 2))
+                   for i in range(1000)]
+        ip_store.load(test_db)
+        self.assertTrue(ip_store.get(0)[2] is ip_store.get(3)[2])
+        self.assertTrue(ip_store.search("0.0.0.1") == ("area0", "isp0"))
+
+        usage = ip_store.memory_usage()
+        self.assertTrue(usage["segments"] == 1000)
+        self.assertTrue(usage["values"] == 5)
+        self.assertTrue(usage["columns"] == 1000 * 16)
+        self.assertTrue(usage["saved"] > 1000 * 2 * sys.getsizeof("area0") // 2,
+                        usage)
+
+        # equal but distinct values and unhashable values are kept apart
+        ip_store.load([(1, 2, 1, 1.0), (3, 4, True, [1]), (5, 6, [1], 'a')])
+        self.assertTrue([ip_store.get(i) for i in range(3)] ==
+                        [(1, 2, 1, 1.0), (3, 4, True, [1]), (5, 6, [1], 'a')])
+        self.assertTrue(type(ip_store.get(1)[2]) is bool)
+        self.assertTrue(ip_store.memory_usage()["values"] == 6)
+
+
+    def test_cache(self):
+        store = ip_store.IPStore(cache=100)
+        self.assertTrue(store.cache_info() == {"hits": 0, "misses": 0, "size": 128})
+        store.load([(1, 2, 'a', 'a'), (5, 6, 'b', 'b')])
+
+        for i in range(3):
+            self.assertTrue(store.search("0.0.0.1") == ('a', 'a'))
+            self.assertTrue(store.search("0.0.0.3") is None)
+        self.assertTrue(store.cache_info()["hits"] == 4)
+        self.assertTrue(store.cache_info()["misses"] == 2)
+
+        # load() invalidates cached results
+        store.load([(1, 4, 'c', 'c')])
+        self.assertTrue(store.search("0.0.0.1") == ('c', 'c'))
+        self.assertTrue(store.search("0.0.0.3") == ('c', 'c'))
+        self.assertTrue(store.cache_info()["misses"] == 4)
+
+        # many more addresses than entries
+        test_db = [(i * 10, i * 10 + 5, i, i) for i in range(1000)]
+        store.load(test_db)
+        for j in range(2):
+            for i in range(0, 10000, 3):
+                expected = (i // 10, i // 10) if i % 10 <= 5 else None
+                self.assertTrue(store.search(htoa(i)) == expected, i)
+
+        store.set_cache(0)
+        self.assertTrue(store.cache_info() == {"hits": 0, "misses": 0, "size": 0})
+        self.assertTrue(store.search("0.0.0.1") == (0, 0))
+        with self.assertRaises(ValueError):
+            store.set_cache(-1)
+
+
+    def test_search_int_and_packed(self):
+        ip_store.load([(1, 2, 'a', 'a'), (2130706433, 2130706433, 'lo', 'lo')])
+        loopback = socket.inet_aton("127.0.0.1")
+
+        for ip in [2130706433, memoryview(loopback), array.array("B", loopback),
+                   "127.0.0.1", b"127.0.0.1", bytearray(b"127.0.0.1")]:
+            self.assertTrue(ip_store.search(ip) == ('lo', 'lo'), ip)
+        self.assertTrue(ip_store.search(0) is None)
+        self.assertTrue(ip_store.search_many([1, memoryview(b"\0\0\0\2"), 3,
+                                              memoryview(loopback)]) ==
+                        [('a', 'a'), ('a', 'a'), None, ('lo', 'lo')])
+
+        # 4 bytes are text like any other bytes, packed only in a buffer
+        ip_store.load([(1234, 1234, 'text', 'text')])
+        for ip in ["1234", b"1234", bytearray(b"1234"), memoryview(b"\0\0\4\xd2")]:
+            self.assertTrue(ip_store.search(ip) == ('text', 'text'), ip)
+        with self.assertRaises(ValueError):
+            ip_store.search(loopback)
+
+        with self.assertRaises(OverflowError):
+            ip_store.search(-1)
+        with self.assertRaises(OverflowError):
+            ip_store.search(2**32)
+        with self.assertRaises(ValueError):
+            ip_store.search(memoryview(b"abc"))
+        with self.assertRaises(TypeError):
+            ip_store.search(1.0)
+
+    def test_reload_while_parsing(self):
+        store = ip_store.IPStore()
+        big = [(i * 10, i * 10 + 9, 'old', 'old') for i in range(10000)]
+
+        def ips():
+            # parsing the batch runs this, the store must not be searched
+            # with the db it had before
+            store.load([(0, 99, 'new', 'new')])
+            yield 5
+            yield 50000
+
+        store.load(big)
+        self.assertTrue(store.search_many(ips()) == [('new', 'new'), None])
+
+        store.load(big)
+        out = array.array("q", [7, 7])
+        self.assertTrue(store.search_index(ips(), out) is out)
+        self.assertTrue(list(out) == [0, -1])
+
+    def test_search_range(self):
+        ip_store.load([(10, 19, 'a', 'x'), (20, 29, 'b', 'x'),
+                       (40, 49, 'c', 'y'), (atohl("10.0.0.0"), atohl("10.0.255.255"), 'd', 'y'),
+                       (atohl("10.1.0.0"), atohl("10.255.255.255"), 'e', 'y')])
+        ip_store.load6([(2**96, 2**96 + 9, 'v6', 'x')])
+
+        self.assertTrue(ip_store.search_range(0, 9) == range(0, 0))
+        self.assertTrue(ip_store.search_range(15, 15) == range(0, 1))
+        self.assertTrue(ip_store.search_range(19, 40) == range(0, 3))
+        self.assertTrue(ip_store.search_range(30, 39) == range(2, 2))
+        self.assertTrue(ip_store.search_range("0.0.0.0", 2**32 - 1) == range(0, 5))
+        self.assertTrue([ip_store.get(i)[2] for i in ip_store.search_range(25, 45)]
+                        == ['b', 'c'])
+
+        self.assertTrue(ip_store.search_cidr("10.0.0.0/8") == range(3, 5))
+        self.assertTrue(ip_store.search_cidr("10.1.2.3/16") == range(4, 5))
+        self.assertTrue(ip_store.search_cidr("0.0.0.32/27") == range(2, 3))
+        self.assertTrue(ip_store.search_cidr("0.0.0.16/28") == range(0, 2))
+        self.assertTrue(ip_store.search_cidr("0.0.0.0/0") == range(0, 5))
+        self.assertTrue(ip_store.search_cidr("11.0.0.0/32") == range(5, 5))
+        self.assertTrue(ip_store.search_cidr("0:1::/96") == range(0, 1))
+        self.assertTrue(ip_store.search_cidr("0:1::/127") == range(0, 1))
+        self.assertTrue(ip_store.search_cidr("0:2::/96") == range(1, 1))
+        self.assertTrue(ip_store.search_range("0:1::9", "0:1::ff") == range(0, 1))
+
+        for bad in ["10.0.0.0", "10.0.0/8", "10.0.0.0/33", "10.0.0.0/-1",
+                    "10.0.0.0/", "::/129", "10.0.0.0/8x", "10.0.0.0/ 8",
+                    "10.0.0.0/+8", "::/99999999999999999999"]:
+            with self.assertRaises(ValueError):
+                ip_store.search_cidr(bad)
+        with self.assertRaises(ValueError):
+            ip_store.search_range(2, 1)
+        with self.assertRaises(ValueError):
+            ip_store.search_range(1, "::1")
+
+    def check_patched(self, store):
+        """the positions of a patched store agree with its searches"""
+        records = [store.get(i) for i in range(store.size())]
+        for i in range(1, len(records)):
+            self.assertTrue(records[i - 1][1] < records[i][0])
+
+        def position(ip):
+            for i, record in enumerate(records):
+                if record[0] <= ip <= record[1]:
+                    return i
+            return -1
+
+        ips = list(range(120))
+        positions = [position(ip) for ip in ips]
+        self.assertTrue([store.search(ip) for ip in ips] ==
+                        [None if i < 0 else records[i][2:] for i in positions])
+        self.assertTrue(store.search_many(ips) == [store.search(ip) for ip in ips])
+        out = array.array("q", [0]) * len(ips)
+        self.assertTrue(list(store.search_index(ips, out)) == positions)
+        for begin in range(0, 120, 7):
+            for end in (begin, begin + 3, begin + 40):
+                first = len([r for r in records if r[1] < begin])
+                stop = len([r for r in records if r[0] <= end])
+                self.assertTrue(store.search_range(begin, end) == range(first, stop),
+                                (begin, end))
+
+    def test_range_updates(self):
+        store = ip_store.IPStore(cache=64)
+        store.load([(10, 19, 'a', 'x'), (20, 29, 'b', 'x'), (40, 49, 'c', 'y')])
+        self.assertTrue(store.search(42) == ('c', 'y'))
+
+        store.insert_range(30, 39, 'd', 'y')
+        store.update_range(15, 24, 'e', 'z')
+        store.delete_range("0.0.0.42", "0.0.0.45")
+        with self.assertRaises(ValueError):
+            store.insert_range(35, 50, 'f', 'f')
+        with self.assertRaises(ValueError):
+            store.delete_range(2, 1)
+        with self.assertRaises(ValueError):
+            store.update_range("::1", "::2", 'f', 'f')
+
+        self.assertTrue(store.search(14) == ('a', 'x'))
+        self.assertTrue(store.search(24) == ('e', 'z'))
+        self.assertTrue(store.search(30) == ('d', 'y'))
+        self.assertTrue(store.search(42) is None)
+        self.assertTrue(store.search(46) == ('c', 'y'))
+
+        store.insert_range(42, 45, 'f', 'f')
+        self.assertTrue(store.size() == 7)
+        self.assertTrue([store.get(i) for i in range(store.size())] ==
+                        [(10, 14, 'a', 'x'), (15, 24, 'e', 'z'),
+                         (25, 29, 'b', 'x'), (30, 39, 'd', 'y'),
+                         (40, 41, 'c', 'y'), (42, 45, 'f', 'f'),
+                         (46, 49, 'c', 'y')])
+        # read without merging the patches
+        self.assertTrue(store.memory_usage()["values"] == 5)
+        self.assertTrue(store.memory_usage()["segments"] == 7)
+        self.assertTrue(store.memory_usage()["patches"] > 0)
+        store.compact()
+        self.assertTrue(store.memory_usage()["values"] == 9)
+        self.assertTrue(store.memory_usage()["patches"] == 0)
+
+        # random changes against every address of a small space, the
+        # positions of the patched db being those of the merged one
+        expected = dict((ip, store.search(ip)) for ip in range(100))
+        for round in range(300):
+            begin = randint(0, 99)
+            end = min(begin + randint(0, 10), 99)
+            value = ('v%d' % randint(0, 5), 'isp')
+            dice = randint(0, 2)
+            if dice == 0:
+                if all(expected[ip] is None for ip in range(begin, end + 1)):
+                    store.insert_range(begin, end, *value)
+                else:
+                    self.assertRaises(ValueError, store.insert_range,
+                                      begin, end, *value)
+                    continue
+            elif dice == 1:
+                store.update_range(begin, end, *value)
+            else:
+                value = None
+                store.delete_range(begin, end)
+            for ip in range(begin, end + 1):
+                expected[ip] = value
+            if round % 30 == 0:
+                self.check_patched(store)
+
+        self.assertTrue([store.search(ip) for ip in range(100)] ==
+                        [expected[ip] for ip in range(100)])
+        self.check_patched(store)
+        patched = [store.get(i) for i in range(store.size())]
+        store.compact()
+        self.assertTrue([store.get(i) for i in range(store.size())] == patched)
+        records = [store.get(i) for i in range(store.size())]
+        for i in range(1, len(records)):
+            self.assertTrue(records[i - 1][1] < records[i][0])
+        self.assertTrue(store.search_many(list(range(100))) ==
+                        [expected[ip] for ip in range(100)])
+
+        # a mapped db is copied on merge
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, "ip.db")
+        try:
+            store.dump(path)
+            store.load_mapped(path)
+            store.update_range(0, 99, 'all', 'isp')
+            self.assertTrue(store.search(0) == ('all', 'isp'))
+            self.assertTrue(store.get(0) == (0, 99, 'all', 'isp'))
+            self.assertTrue(store.memory_usage()["mapped"] > 0)
+            store.compact()
+            self.assertTrue(store.get(0) == (0, 99, 'all', 'isp'))
+            self.assertTrue(store.memory_usage()["mapped"] == 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
 
 def get_test_db():
     db = []
@@ -261,6 +753,61 @@ class TestSearch(unittest.TestCase):
             self.assertTrue(probe[1] == ip_store.search(probe[0]),
                             (probe[1], ip_store.search(probe[0])))
 
+    def test_c_search_many(self):
+        ip_store.load(db)
+        ips = [probe[0] for probe in probe_list]
+        self.assertTrue(ip_store.search_many(ips) ==
+                        [probe[1] for probe in probe_list])
+
+        # sorted input goes through the merge-style pass
+        probes = sorted(probe_list, key=lambda x: atohl(x[0]))
+        expected = [probe[1] for probe in probes]
+        ips = [probe[0] for probe in probes]
+        self.assertTrue(ip_store.search_many(ips) == expected)
+
+        # buffer of host integers and buffer of packed addresses
+        host = array.array("I", [atohl(ip) for ip in ips])
+        packed = b"".join(socket.inet_aton(ip) for ip in ips)
+        self.assertTrue(ip_store.search_many(host) == expected)
+        self.assertTrue(ip_store.search_many(packed) == expected)
+
+        # uint32 of either byte order, as told by the buffer format
+        for uint32 in (ctypes.c_uint32.__ctype_be__, ctypes.c_uint32.__ctype_le__):
+            ordered = (uint32 * len(host))(*host)
+            self.assertTrue(ip_store.search_many(ordered) == expected)
+
+        self.assertTrue(ip_store.search_many([]) == [])
+        with self.assertRaises(TypeError):
+            ip_store.search_many(1)
+        with self.assertRaises(TypeError):
+            ip_store.search_many(b"abc")
+        with self.assertRaises(ValueError):
+            ip_store.search_many(["123."])
+
+    def test_c_search_index(self):
+        ip_store.load(db)
+        host = array.array("I", [atohl(probe[0]) for probe in probe_list])
+        expected = [probe[1] for probe in probe_list]
+
+        for typecode in "iq":
+            out = array.array(typecode, [0]) * len(host)
+            self.assertTrue(ip_store.search_index(host, out) is out)
+            self.assertTrue([None if i < 0 else ip_store.get(i)[2:4]
+                             for i in out] == expected)
+
+        out = array.array("q", [0, 0])
+        ip_store.search_index(["0.0.0.0", db[0][0]], out)
+        self.assertTrue(list(out) == [-1, 0])
+
+        with self.assertRaises(ValueError):
+            ip_store.search_index(host, array.array("q", [0]))
+        with self.assertRaises(ValueError):
+            ip_store.search_index(["::1"], array.array("q", [0]))
+        with self.assertRaises(TypeError):
+            ip_store.search_index(host, array.array("I", [0]) * len(host))
+        with self.assertRaises(TypeError):
+            ip_store.search_index(host, bytearray(8 * len(host)))
+
     def test_speed(self):
         ip_store.load(db)
         raw_stmt_p = """
@@ -279,6 +826,67 @@ for probe in probe_list:
             new_t = timeit.timeit(raw_stmt_c, number=1, globals=globals())
             print("C time: %s" % round(new_t, 3))
 
+            store = ip_store.IPStore(index=False)
+            store.load(db)
+            old_t = timeit.timeit(raw_stmt_c, number=1,
+                                  globals={"ip_store": store,
+                                           "probe_list": probe_list})
+            print("C time without index: %s, x%s" %
+                  (round(old_t, 3), round(old_t/new_t, 2)))
+
+            new_t = timeit.timeit("ip_store.search_many(ips)", number=1,
+                                  globals={"ip_store": ip_store,
+                                           "ips": [p[0] for p in probe_list]})
+            print("C batch time: %s" % round(new_t, 3))
+
+    def test_threads(self):
+        """bulk lookups release the GIL, so they should scale with threads
+        as long as there are cores for them"""
+        ip_store.load(db)
+        batch = array.array("I", [atohl(probe[0]) for probe in probe_list])
+        self.assertTrue(ip_store.search_many(batch) ==
+                        [probe[1] for probe in probe_list])
+
+        rounds = 16
+
+        def work(n):
+            for i in range(n):
+                ip_store.search_many(batch)
+
+        print()
+        base_t = None
+        for n_threads in (1, 2, 4, 8):
+            threads = [threading.Thread(target=work, args=(rounds//n_threads,))
+                       for i in range(n_threads)]
+            t = timeit.default_timer()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            t = timeit.default_timer() - t
+            base_t = base_t or t
+            print("%s threads: %s, x%s" % (n_threads, round(t, 3),
+                                           round(base_t/t, 2)))
+
+    def test_load_while_searching(self):
+        batch = array.array("I", [atohl(probe[0]) for probe in probe_list])
+        stop = []
+
+        def reload():
+            while not stop:
+                ip_store.load(db[:len(db)//2])
+                ip_store.load(db)
+
+        thread = threading.Thread(target=reload)
+        thread.start()
+        try:
+            for i in range(10):
+                results = ip_store.search_many(batch)
+                self.assertTrue(len(results) == len(batch))
+        finally:
+            stop.append(1)
+            thread.join()
+
 
 class TestMemory(unittest.TestCase):
 
@@ -1,10 +1,13 @@
 
 import sys
+import copy
+import pickle
 import random
 import timeit
+import threading
 import unittest
 
-from tree import BinaryTree, Empty
+from tree import AVLTree, BinaryTree, Empty
 
 
 def random_insert_ascii(tree):
@@ -227,6 +230,588 @@ class TestBinaryTree(unittest.TestCase):
         self.assertTrue(tree.root() == (1, "a"))
         self.assertTrue(ref_a + 1 == sys.getrefcount("a"))
 
+    def test_churn(self):
+        tree = self.tree_cls()
+        value = "churn" + str(random.random())
+        ref_value = sys.getrefcount(value)
+
+        for i in range(5):
+            keys = list(range(3000))
+            random.shuffle(keys)
+            for key in keys:
+                tree[key] = value
+            random.shuffle(keys)
+            for key in keys[:2000]:
+                self.assertTrue(tree.pop(key) is value)
+            self.assertTrue(tree.keys() == sorted(keys[2000:]))
+            self.assertTrue(ref_value + 1000 == sys.getrefcount(value))
+            for key in keys[2000:]:
+                tree.pop(key)
+            self.assertTrue(len(tree) == 0)
+
+        # the tree holds the last reference of a popped value
+        tree[1] = [1]
+        self.assertTrue(tree.pop(1) == [1])
+
+        insert_integer(tree, range(100))
+        tree[0] = value
+        del tree
+        self.assertTrue(ref_value == sys.getrefcount(value))
+
+    def test_clear(self):
+        tree = self.tree_cls()
+        value = "clear" + str(random.random())
+        ref_value = sys.getrefcount(value)
+
+        self.assertTrue(tree.clear() == 0)
+        for key in range(5000):
+            tree[key] = value
+        it = tree.iterkeys()
+        self.assertTrue(tree.clear(1000) == 4000)
+        self.assertTrue(len(tree) == 0 and tree.keys() == [])
+        self.assertRaises(RuntimeError, next, it)
+        del it
+        self.assertTrue(ref_value + 4000 == sys.getrefcount(value))
+
+        # the tree is usable before the removed items are all released
+        tree[1] = 1
+        self.assertTrue(tree.pop(1) == 1)
+        tree[2] = value
+        self.assertTrue(tree.clear(1000) == 3001)
+        while tree.clear(1000):
+            pass
+        self.assertTrue(ref_value == sys.getrefcount(value))
+
+        # what is left is released with the tree
+        for key in range(100):
+            tree[key] = value
+        tree.clear(10)
+        del tree
+        self.assertTrue(ref_value == sys.getrefcount(value))
+
+    def test_deep(self):
+        # a BinaryTree of sorted keys is a list, no walk recurses
+        n = 20000
+        tree = self.tree_cls()
+        insert_integer(tree, range(n))
+        self.assertTrue(tree.keys() == list(range(n)))
+        self.assertTrue(tree.items() == [(i, i) for i in range(n)])
+        self.assertTrue(list(reversed(tree)) == list(range(n - 1, -1, -1)))
+        self.assertTrue(self.tree_cls.load(tree.dump()).keys() == list(range(n)))
+        tree.update({-1: -1})
+        self.assertTrue(len(tree) == n + 1 and tree.select(n)[0] == n - 1)
+        del tree
+
+    def test_from_sorted(self):
+        value = "sorted" + str(random.random())
+        ref_value = sys.getrefcount(value)
+
+        tree = self.tree_cls.from_sorted([(i, value) for i in range(1, 1024)])
+        self.assertTrue(type(tree) is self.tree_cls)
+        self.assertTrue(tree.root() == (512, value))
+        self.assertTrue(tree.keys() == list(range(1, 1024)))
+        self.assertTrue(tree.floor(100.5) == (100, value))
+        self.assertTrue(ref_value + 1023 == sys.getrefcount(value))
+
+        # mappings, other pairs and the empty input
+        self.assertTrue(self.tree_cls.from_sorted(tree).items() == tree.items())
+        self.assertTrue(self.tree_cls.from_sorted({"a": 1, "b": 2}).items()
+                        == [("a", 1), ("b", 2)])
+        self.assertTrue(self.tree_cls.from_sorted(["ab", "cd"]).items()
+                        == [("a", "b"), ("c", "d")])
+        self.assertTrue(len(self.tree_cls.from_sorted(iter([]))) == 0)
+
+        with self.assertRaises(ValueError):
+            self.tree_cls.from_sorted([(1, 1), (1, 2)])
+        with self.assertRaises(ValueError):
+            self.tree_cls.from_sorted([(2, 1), (1, 2)])
+        with self.assertRaises(ValueError):
+            self.tree_cls.from_sorted([(1, 1, 1)])
+        with self.assertRaises(TypeError):
+            self.tree_cls.from_sorted([(1, 1), ("a", 2)])
+        with self.assertRaises(TypeError):
+            self.tree_cls.from_sorted(1)
+
+        del tree
+        self.assertTrue(ref_value == sys.getrefcount(value))
+
+    def test_update(self):
+        value = "update" + str(random.random())
+        ref_value = sys.getrefcount(value)
+        tree = self.tree_cls()
+        d = {}
+
+        # merged, then inserted one by one
+        for items in ([(i, i) for i in range(0, 1000, 3)],
+                      [(i, value) for i in range(0, 1000, 2)],
+                      [(i, i) for i in range(500, 520)],
+                      [(i, i) for i in range(100, 0, -1)],
+                      {2000: value, -1: value}):
+            tree.update(items)
+            d.update(items)
+            self.assertTrue(tree.items() == sorted(d.items()))
+            self.assertTrue(len(tree) == len(d))
+        # held by the tree and d
+        del items
+        count = sum(v is value for v in d.values())
+        self.assertTrue(ref_value + 2 * count == sys.getrefcount(value))
+        del d
+
+        tree = self.tree_cls()
+        tree.update([(i, i) for i in range(1, 1024)])
+        self.assertTrue(tree.root() == (512, 512))
+        it = iter(tree)
+        tree.update([(0, 0)])
+        with self.assertRaises(RuntimeError):
+            next(it)
+
+        # nothing changes on error
+        with self.assertRaises(TypeError):
+            tree.update([(2000, 0), (2001, 0), ("a", 0)])
+        self.assertTrue(tree.keys() == list(range(1024)))
+        with self.assertRaises(TypeError):
+            tree.update([(-1, value), ("a", value)])
+        self.assertTrue(tree.keys() == list(range(1024)))
+        self.assertTrue(ref_value == sys.getrefcount(value))
+
+    def test_order_statistics(self):
+        tree = self.tree_cls()
+        with self.assertRaises(IndexError):
+            tree.select(0)
+        self.assertTrue(tree.rank(1) == 0 and tree.count_range() == 0)
+
+        def check(tree):
+            keys = tree.keys()
+            for i, key in enumerate(keys):
+                self.assertTrue(tree.select(i) == (key, tree[key]))
+                self.assertTrue(tree.select(i - len(keys))[0] == key)
+                self.assertTrue(tree.rank(key) == i)
+            with self.assertRaises(IndexError):
+                tree.select(len(keys))
+            with self.assertRaises(IndexError):
+                tree.select(-len(keys) - 1)
+            for i in range(20):
+                lo, hi = sorted(random.randint(-10, 1010) for _ in range(2))
+                inclusive = (bool(random.randint(0, 1)), bool(random.randint(0, 1)))
+                self.assertTrue(tree.count_range(lo, hi, inclusive)
+                                == len(list(tree.irange(lo, hi, inclusive))))
+                self.assertTrue(tree.rank(lo + 0.5)
+                                == len([k for k in keys if k < lo + 0.5]))
+
+        # deep paths of a BinaryTree
+        insert_integer(tree, range(500))
+        for i in range(0, 500, 2):
+            tree.pop(i)
+        check(tree)
+        tree = self.tree_cls()
+
+        # random inserts and pops, then the bulk paths
+        d = {}
+        for i in range(5000):
+            key = random.randint(0, 1000)
+            if random.randint(0, 2):
+                tree[key] = d[key] = i
+            else:
+                self.assertTrue(tree.pop(key, None) == d.pop(key, None))
+        check(tree)
+        tree.update([(i, i) for i in range(0, 1000, 7)])
+        check(tree)
+        check(self.tree_cls.load(tree.dump()))
+        while len(tree) > 10:
+            tree.pop(tree.select(random.randrange(len(tree)))[0])
+        check(tree)
+
+        self.assertTrue(tree.count_range(hi=-1) == 0)
+        self.assertTrue(tree.count_range(lo=2000) == 0)
+        self.assertTrue(tree.count_range(5, 1) == 0)
+        self.assertTrue(tree.count_range() == 10)
+        with self.assertRaises(TypeError):
+            tree.rank("a")
+        with self.assertRaises(TypeError):
+            tree.select("a")
+
+    def test_set_operations(self):
+        a = self.tree_cls(threadsafe=True)
+        b = BinaryTree()
+        insert_integer(a, range(0, 300, 2))
+        insert_integer(b, range(0, 300, 3))
+        for key in range(0, 300, 3):
+            b[key] = -key
+
+        union = a.union(b)
+        self.assertTrue(type(union) is self.tree_cls and union.threadsafe)
+        self.assertTrue(union.keys() == sorted(set(range(0, 300, 2)) | set(range(0, 300, 3))))
+        self.assertTrue(union[6] == -6 and union[4] == 4 and union[3] == -3)
+        common = a.intersection(b)
+        self.assertTrue(common.items() == [(i, i) for i in range(0, 300, 6)])
+        self.assertTrue(len(a) == 150 and len(b) == 100)
+        self.assertTrue(len(a.intersection(self.tree_cls())) == 0)
+
+        lower, upper = union.split(150)
+        self.assertTrue(lower.keys() == [k for k in union.keys() if k < 150])
+        self.assertTrue(upper.keys() == [k for k in union.keys() if k >= 150])
+        lower, upper = union.split(151)
+        self.assertTrue(upper.min() == (152, 152) and lower.max() == (150, -150))
+        lower, upper = union.split(1000)
+        self.assertTrue(len(lower) == len(union) and len(upper) == 0)
+        self.assertTrue(lower.select(100) == union.select(100))
+
+        a.merge(b)
+        self.assertTrue(a.items() == union.items())
+        a.merge(a)
+        self.assertTrue(a.items() == union.items())
+        self.assertRaises(TypeError, a.merge, {1: 1})
+        self.assertRaises(TypeError, a.union, [(1, 1)])
+        self.assertRaises(TypeError, a.split, "a")
+
+    def test_pickle(self):
+        tree = self.tree_cls()
+        for i in range(1000):
+            tree[random.randint(0, 10 ** 6)] = [i]
+        tree[-1] = tree
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            loaded = pickle.loads(pickle.dumps(tree, protocol))
+            self.assertTrue(type(loaded) is self.tree_cls)
+            self.assertTrue(loaded.keys() == tree.keys())
+            self.assertTrue(loaded.values()[1:] == tree.values()[1:])
+            self.assertTrue(loaded.pop(-1) is loaded)
+
+        tree.pop(-1)
+        copied = copy.deepcopy(tree)
+        self.assertTrue(copied.items() == tree.items())
+        self.assertTrue(copied.min()[1] is not tree.min()[1])
+        copied = copy.copy(tree)
+        self.assertTrue(copied.min()[1] is tree.min()[1])
+        self.assertTrue(len(pickle.loads(pickle.dumps(self.tree_cls()))) == 0)
+
+    def test_dump_load(self):
+        value = "dump" + str(random.random())
+        ref_value = sys.getrefcount(value)
+        for keys in ([random.randint(-2 ** 63, 2 ** 63 - 1) for i in range(1000)],
+                     ["%s\u00e9\U0001f600" % random.random() for i in range(1000)]
+                     + ["", "a", "ab", "b"],
+                     []):
+            tree = self.tree_cls()
+            for key in keys:
+                tree[key] = value
+            data = tree.dump()
+            for buf in (data, bytearray(data), memoryview(b" " + data)[1:]):
+                loaded = self.tree_cls.load(buf)
+                self.assertTrue(type(loaded) is self.tree_cls)
+                self.assertTrue(loaded.items() == tree.items())
+                self.assertTrue(loaded.values() == [value] * len(tree))
+                if keys:
+                    self.assertTrue(loaded[keys[0]] == value)
+            del tree, loaded
+
+        self.assertTrue(ref_value == sys.getrefcount(value))
+
+        # the tree stays thread-safe, images from before have no flags
+        for threadsafe in (False, True):
+            tree = self.tree_cls(threadsafe=threadsafe)
+            tree.update([("a", 1), ("b", 2)])
+            data = tree.dump()
+            loaded = self.tree_cls.load(data)
+            self.assertTrue(loaded.threadsafe == threadsafe)
+            self.assertTrue(loaded.items() == [("a", 1), ("b", 2)])
+            self.assertFalse(self.tree_cls.load(
+                data[:20] + b"\0" * 4 + data[24:]).threadsafe)
+
+        # balanced in one pass
+        tree = self.tree_cls.load(
+            self.tree_cls.from_sorted((i, i) for i in range(1, 1024)).dump())
+        self.assertTrue(tree.root() == (512, 512))
+
+        # keys that dump() does not support
+        for keys in ([1.5], [2 ** 64], [1, "a"], [(1, 2)]):
+            tree = self.tree_cls()
+            with self.assertRaises(TypeError):
+                tree.update([(key, 0) for key in keys])
+                tree.dump()
+
+        # bad images
+        data = self.tree_cls.from_sorted([(1, 1), (2, 2)]).dump()
+        with self.assertRaises(ValueError):
+            self.tree_cls.load(b"")
+        with self.assertRaises(ValueError):
+            self.tree_cls.load(b"x" + data[1:])
+        with self.assertRaises(ValueError):
+            self.tree_cls.load(data[:40])
+        with self.assertRaises(ValueError):
+            # unknown flags
+            self.tree_cls.load(data[:20] + b"\xff" * 4 + data[24:])
+        with self.assertRaises(ValueError):
+            # keys out of order
+            self.tree_cls.load(data[:40] + data[48:56] + data[40:48] + data[56:])
+        with self.assertRaises(Exception):
+            self.tree_cls.load(data[:-1])
+
+    def test_key_kinds(self):
+        big = 2 ** 70
+        cases = [
+            [random.randint(-2 ** 63, 2 ** 63 - 1) for i in range(1000)],
+            [str(random.random()) for i in range(1000)],
+            [random.random() - 0.5 for i in range(1000)],
+            # mixed kinds and the kinds not compared natively
+            [random.randint(0, 100) for i in range(500)] +
+            [random.random() * 100 for i in range(500)],
+            [random.randint(0, 100) for i in range(500)] + [big, -big],
+            [True, False, 2, 3.5],
+            [(1, 2), (0, 3), (1, 1)],
+        ]
+        for keys in cases:
+            for i in range(2):
+                tree = self.tree_cls()
+                for key in keys:
+                    tree[key] = key
+                self.assertTrue(tree.keys() == sorted(set(keys)))
+                for key in keys:
+                    self.assertTrue(tree[key] == key)
+                for key in keys[::2]:
+                    tree.pop(key, None)
+                self.assertTrue(tree.keys() == sorted(set(keys[1::2]) - set(keys[::2])))
+                keys = keys[::-1]
+
+        # keys of other kinds, or out of 64 bits, are still found
+        tree = self.tree_cls()
+        insert_integer(tree, range(100))
+        self.assertTrue(tree[3.0] == 3 and tree[True] == 1)
+        self.assertTrue(tree.floor(2 ** 64) == (99, 99))
+        self.assertTrue(tree.ceiling(-2 ** 64) == (0, 0))
+        with self.assertRaises(KeyError):
+            tree[2 ** 64]
+        with self.assertRaises(TypeError):
+            tree["a"]
+
+        tree = self.tree_cls()
+        tree["b"] = tree["a"] = 1
+        with self.assertRaises(TypeError):
+            tree[1]
+        self.assertTrue(tree.keys() == ["a", "b"])
+
+        # kinds start over once empty
+        tree.pop("a")
+        tree.pop("b")
+        insert_integer(tree, [2, 1, 3])
+        self.assertTrue(tree.keys() == [1, 2, 3])
+
+    def test_threadsafe(self):
+        self.assertFalse(self.tree_cls().threadsafe)
+        tree = self.tree_cls(threadsafe=True)
+        self.assertTrue(tree.threadsafe)
+        self.assertTrue(pickle.loads(pickle.dumps(tree)).threadsafe)
+
+        # readers see the even keys while a writer changes the odd ones
+        n = 4000
+        tree.update((i, i) for i in range(0, n, 2))
+        errors = []
+        stop = []
+
+        def read(keys):
+            try:
+                while not stop:
+                    for key in keys:
+                        assert tree[key] == key
+                        assert tree.floor(key + 1)[0] in (key, key + 1)
+                        assert tree.rank(key) <= key
+                    try:
+                        assert len(list(tree.irange(0, 100))) >= 51
+                    except RuntimeError:
+                        # a change between two steps of the iterator
+                        pass
+            except Exception as e:
+                errors.append(e)
+
+        def write():
+            for i in range(3):
+                for key in range(1, n, 2):
+                    tree[key] = key
+                for key in range(1, n, 2):
+                    del tree[key]
+            tree.update((key, key) for key in range(1, n, 2))
+
+        readers = [threading.Thread(target=read,
+                                    args=(random.sample(range(0, n, 2), 100),))
+                   for i in range(4)]
+        for thread in readers:
+            thread.start()
+        write()
+        stop.append(1)
+        for thread in readers:
+            thread.join()
+        self.assertFalse(errors, errors[:1])
+        self.assertTrue(tree.keys() == list(range(n)))
+
+        # mixed keys keep the GIL and the lock
+        tree[0.5] = tree
+        self.assertTrue(tree[1] == 1 and tree.floor(0.7) == (0.5, tree))
+        with self.assertRaises(KeyError):
+            tree[1.5]
+        self.assertTrue(tree.count_range(0, 2) == 4)
+        self.assertTrue(tree.pop(0.5) is tree)
+        with self.assertRaises(TypeError):
+            tree["a"]
+
+    def test_threadsafe_reentry(self):
+        tree = self.tree_cls(threadsafe=True)
+        calls = []
+
+        class Key(object):
+            def __init__(self, k):
+                self.k = k
+
+            def __lt__(self, other):
+                if calls:
+                    calls.pop()()
+                return self.k < other.k
+
+            def __eq__(self, other):
+                return self.k == other.k
+
+        for k in range(10):
+            tree[Key(k)] = k
+
+        # a key may read the tree while it is written
+        seen = []
+        calls.append(lambda: seen.append(len(tree)))
+        tree[Key(5.5)] = 5.5
+        self.assertTrue(seen == [10] and len(tree) == 11)
+        calls.append(lambda: seen.append(tree.min()[1]))
+        calls.append(lambda: seen.append(tree.keys()[0].k))
+        self.assertTrue(tree[Key(3)] == 3 and seen == [10, 0, 0])
+
+        # but not write it, from a read or a write, instead of waiting
+        # for itself
+        def write():
+            tree[Key(100)] = 100
+
+        for op in (lambda: tree[Key(3)], lambda: tree.floor(Key(3)),
+                   lambda: tree.rank(Key(3)), lambda: tree.pop(Key(4)),
+                   lambda: tree.update([(Key(-1), -1)]), write):
+            calls.append(write)
+            with self.assertRaises(RuntimeError):
+                op()
+            self.assertFalse(calls)
+        self.assertTrue(len(tree) == 11 and Key(100) not in tree.keys())
+
+        # the lock is left free, for this thread and the others
+        tree[Key(20)] = 20
+        thread = threading.Thread(target=write)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(len(tree) == 13 and tree.max()[1] == 100)
+
+    def test_threadsafe_performance(self):
+        # lookups release the GIL, they scale with the cores available
+        tree = self.tree_cls.from_sorted((i, i) for i in range(10 ** 6))
+        safe = self.tree_cls(threadsafe=True)
+        safe.update(tree)
+        keys = [random.randrange(10 ** 6) for i in range(100000)]
+
+        def work(tree, keys):
+            for key in keys:
+                tree[key]
+
+        print()
+        for name, t in (("not threadsafe", tree), ("threadsafe", safe)):
+            base_t = None
+            for n_threads in (1, 2, 4):
+                threads = [threading.Thread(
+                    target=work, args=(t, keys[:len(keys) // n_threads]))
+                    for i in range(n_threads)]
+                start = timeit.default_timer()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                start = timeit.default_timer() - start
+                base_t = base_t or start
+                print("%s, %s threads: %s, x%s" % (
+                    name, n_threads, round(start, 3), round(base_t / start, 2)))
+
+    def test_performance(self):
+        class Int(int):
+            pass
+
+        class Str(str):
+            pass
+
+        class Float(float):
+            pass
+
+        n = 200000
+        numbers = random.sample(range(10 ** 9), n)
+        print()
+        print(self.tree_cls.__name__)
+        for name, native, other in (("int", int, Int), ("str", str, Str),
+                                    ("float", float, Float)):
+            times = []
+            for cls in (native, other):
+                keys = [cls(i) for i in numbers]
+                tree = self.tree_cls()
+                stmt = "for key in keys: tree[key] = key"
+                t_insert = timeit.timeit(stmt, number=1, globals=locals())
+                stmt = "for key in keys: tree[key]"
+                t_search = timeit.timeit(stmt, number=1, globals=locals())
+                times.append((t_insert, t_search))
+            print("%5s insert %6s, x%s search %6s, x%s" % (
+                name, round(times[0][0], 3), round(times[1][0] / times[0][0], 1),
+                round(times[0][1], 3), round(times[1][1] / times[0][1], 1)))
+
+    def test_iterators(self):
+        tree = self.tree_cls()
+        self.assertTrue(list(tree) == [])
+        self.assertTrue(list(tree.irange(1, 2)) == [])
+
+        d = random_insert_ascii(tree)
+        keys = sorted(d.keys())
+        self.assertTrue(list(tree) == keys)
+        self.assertTrue(list(tree.iterkeys()) == keys)
+        self.assertTrue(list(tree.itervalues()) == [chr(k) for k in keys])
+        self.assertTrue(list(tree.iteritems()) == [(k, chr(k)) for k in keys])
+        self.assertTrue(list(reversed(tree)) == keys[::-1])
+
+        # lazy, and stops on changes
+        it = iter(tree)
+        self.assertTrue(next(it) == keys[0])
+        tree[ord("a")] = "a"
+        self.assertTrue(next(it) == keys[1])
+        tree.pop(keys[0])
+        with self.assertRaises(RuntimeError):
+            next(it)
+        tree[keys[0]] = chr(keys[0])
+
+        for lo, hi in [(None, None), (10, 20), (-5, 3), (100, 100),
+                       (250, 300), (30, 20), (None, 50), (200, None)]:
+            for inclusive in [(True, True), (False, False), (True, False),
+                              (False, True)]:
+                expected = [k for k in keys
+                            if (lo is None or k > lo or inclusive[0] and k == lo)
+                            and (hi is None or k < hi or inclusive[1] and k == hi)]
+                self.assertTrue(list(tree.irange(lo, hi, inclusive)) == expected,
+                                (lo, hi, inclusive))
+                self.assertTrue(list(tree.irange(lo, hi, inclusive, True)) ==
+                                expected[::-1], (lo, hi, inclusive))
+        self.assertTrue(list(tree.irange_items(hi=keys[1])) ==
+                        [(k, chr(k)) for k in keys[:2]])
+        with self.assertRaises(TypeError):
+            list(tree.irange("a"))
+
+        for key in range(-1, 258):
+            below = [k for k in keys if k <= key]
+            above = [k for k in keys if k >= key]
+            if below:
+                self.assertTrue(tree.floor(key) == (below[-1], chr(below[-1])))
+            else:
+                self.assertRaises(KeyError, tree.floor, key)
+            if above:
+                self.assertTrue(tree.ceiling(key) == (above[0], chr(above[0])))
+            else:
+                self.assertRaises(KeyError, tree.ceiling, key)
+            self.assertTrue(tree.bisect_left(key) == len([k for k in keys if k < key]))
+            self.assertTrue(tree.bisect_right(key) == len(below))
+
     def test_pop_exactly(self):
 
         # predecessor is direct child and target is root
@@ -360,3 +945,98 @@ class TestBinaryTree(unittest.TestCase):
         """
         self.assertTrue(tree.pop(30) == 30)
         self.assertTrue(tree.items() == [(10, 10), (35, 35), (40, 40), (45, 45)])
+
+
+class TestAVLTree(TestBinaryTree):
+
+    tree_cls = AVLTree
+
+    def test_pop_exactly(self):
+        # successor takes the place, then rotate right at the root
+        tree = self.tree_cls()
+        insert_integer(tree, [20, 10, 30, 5])
+        self.assertTrue(tree.pop(20) == 20)
+        self.assertTrue(tree.root() == (10, 10))
+        self.assertTrue(tree.items() == [(5, 5), (10, 10), (30, 30)])
+
+        # rotate left then right
+        tree = self.tree_cls()
+        insert_integer(tree, [20, 10, 30, 5, 15, 40, 13])
+        self.assertTrue(tree.pop(40) == 40)
+        self.assertTrue(tree.root() == (15, 15))
+        self.assertTrue(tree.items() == [(5, 5), (10, 10), (13, 13), (15, 15),
+                                         (20, 20), (30, 30)])
+
+        # pop with a default, del
+        self.assertTrue(tree.pop(40, None) is None)
+        del tree[13]
+        with self.assertRaises(KeyError):
+            del tree[13]
+        with self.assertRaises(TypeError):
+            tree.pop("a", None)
+        self.assertTrue(tree.keys() == [5, 10, 15, 20, 30])
+
+    def test_reentry(self):
+        # the path to rebalance is stale once a key changes the tree
+        tree = self.tree_cls()
+        calls = []
+
+        class Key(object):
+            def __init__(self, k):
+                self.k = k
+
+            def __lt__(self, other):
+                if calls:
+                    calls.pop()()
+                return self.k < other.k
+
+            def __eq__(self, other):
+                return self.k == other.k
+
+        for k in range(20):
+            tree[Key(k)] = k
+
+        def insert(k):
+            tree[Key(k)] = k
+
+        def remove(k):
+            del tree[Key(k)]
+
+        # the change by the key is done, the operation is not
+        for op, change in ((lambda: insert(50), lambda: insert(100)),
+                           (lambda: remove(10), lambda: insert(101)),
+                           (lambda: tree.pop(Key(5)), lambda: remove(0))):
+            calls.append(change)
+            with self.assertRaises(RuntimeError):
+                op()
+            self.assertFalse(calls)
+        keys = [key.k for key in tree.keys()]
+        self.assertTrue(len(keys) == len(tree) == 21)
+        self.assertTrue(keys == list(range(1, 20)) + [100, 101])
+        self.assertTrue(tree.values() == keys)
+
+    def test_balanced(self):
+        # sorted keys give a perfect tree
+        tree = self.tree_cls()
+        insert_integer(tree, range(1, 1024))
+        self.assertTrue(tree.root() == (512, 512))
+
+        tree = self.tree_cls()
+        n = 200000
+        insert_integer(tree, range(n))
+        self.assertTrue(len(tree) == n)
+        self.assertTrue(tree.min() == (0, 0) and tree.max() == (n - 1, n - 1))
+        for i in range(0, n, 2):
+            self.assertTrue(tree.pop(i) == i)
+        self.assertTrue(tree.keys() == list(range(1, n, 2)))
+
+        # random changes against a dict
+        tree = self.tree_cls()
+        d = {}
+        for i in range(20000):
+            key = random.randint(0, 1000)
+            if random.randint(0, 2):
+                tree[key] = d[key] = i
+            else:
+                self.assertTrue(tree.pop(key, None) == d.pop(key, None))
+        self.assertTrue(tree.items() == sorted(d.items()))
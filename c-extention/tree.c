@@ -1,5 +1,7 @@
 
 #include <Python.h>
+#include <errno.h>
+#include <pthread.h>
 
 #define LEFT 0
 #define RIGHT 1
@@ -7,75 +9,436 @@
 #define LEFT_NODE(node) (node->children[LEFT])
 #define RIGHT_NODE(node) (node->children[RIGHT])
 
+/* AVLTree keeps the height of each subtree in xdata, a leaf being 1 */
+#define HEIGHT(node) ((node) == NULL ? 0 : (node)->xdata)
+
+/* an AVL tree of 2**64 nodes is less than 93 levels high */
+#define AVL_MAX_HEIGHT 96
+
 typedef struct tree_node node_t;
 
+/* an int or float key, kept in the node to compare without the object */
+typedef union {
+    long long i;
+    double f;
+} native_key;
+
 struct tree_node {
     node_t *children[2];
     PyObject *key;
     PyObject *value;
+    native_key nkey;
+    Py_ssize_t count;     /* number of nodes of the subtree */
     int xdata;
 };
 
+#define COUNT(node) ((node) == NULL ? 0 : (node)->count)
+
+/* Nodes are allocated from slabs owned by the tree, so that insert and pop
+ * mostly skip the general allocator and the tree is freed slab by slab. A
+ * free node has a NULL key and is kept in a list linked by its left
+ * child. */
+typedef struct node_slab node_slab;
+
+struct node_slab {
+    node_slab *next;
+    Py_ssize_t used;
+    Py_ssize_t capacity;
+    node_t nodes[1];
+};
+
+#define SLAB_MIN 16
+#define SLAB_MAX 1024
+
+/* update() merges sorted items if they are at least 1/16 of the tree */
+#define UPDATE_MERGE_RATIO 16
+
+typedef enum{KEY, VALUE, ITEM} content_type;
+
+/* what the keys of a tree are, exact int fitting in 64 bits, str or float
+ * keys are compared natively as long as they are all of the same kind */
+typedef enum{EMPTY_KEYS, INT_KEYS, STR_KEYS, FLOAT_KEYS, OBJECT_KEYS} key_kind;
+
 typedef struct {
     PyObject_HEAD
     node_t *root;
     Py_ssize_t size;
     int d_flag;
+    Py_ssize_t version;   /* changed whenever a node is added or removed */
+    node_slab *slabs;     /* the last allocated first */
+    node_t *free_nodes;
+    key_kind kind;
+    node_slab *dropped;       /* slabs of cleared nodes, to be released */
+    Py_ssize_t n_dropped;     /* nodes of dropped still holding a key */
+    pthread_rwlock_t *lock;   /* only for a thread-safe tree */
+    int writing;              /* the lock is held exclusively */
+    unsigned long writer;     /* by this thread */
+    int nested;               /* reads of the writer inside its write */
+    unsigned long *readers;   /* threads holding it shared, once per read */
+    Py_ssize_t n_readers;
+    Py_ssize_t readers_capacity;
+    PyObject **trash;         /* references released once unlocked */
+    Py_ssize_t n_trash;
+    Py_ssize_t trash_capacity;
 }base_tree;
 
-typedef enum{KEY, VALUE, ITEM} content_type;
 
 static PyObject *EmptyError;
 const char *empty_error_str = "tree is empty";
 
+/* A thread-safe tree has a reader-writer lock. Lookups of native keys run
+ * without the GIL under the shared lock, other reads hold both, writes
+ * take the lock exclusively. No thread waits for the lock while holding
+ * the GIL, as the holder may be waiting for the GIL. A writer keeps the
+ * references it drops until it unlocks, so that no finalizer runs under
+ * the exclusive lock.
+ *
+ *    Python code run under the lock, comparisons, may use the tree again
+ * from the same thread, which is told by the thread holding the lock. It
+ * may read the tree, taking nothing more, but writing it would wait for
+ * itself: that raises RuntimeError instead. */
+static int
+_lock_error(int res){
+    errno = res;
+    PyErr_SetFromErrno(PyExc_OSError);
+    return -1;
+}
+
+
+/* index of the last read of the current thread in readers, -1 if none */
+static Py_ssize_t
+_reader(base_tree *tree, unsigned long me){
+    Py_ssize_t i;
+
+    for(i = tree->n_readers - 1; i >= 0; i--){
+        if (tree->readers[i] == me)
+            return i;
+    }
+    return -1;
+}
+
+
+/* room for one more reader, taken before locking so as not to fail after */
+static int
+_reserve_reader(base_tree *tree){
+    unsigned long *readers;
+    Py_ssize_t capacity;
+
+    if (tree->n_readers < tree->readers_capacity)
+        return 0;
+    capacity = tree->readers_capacity ? 2 * tree->readers_capacity : 8;
+    readers = PyMem_Realloc(tree->readers, capacity * sizeof(unsigned long));
+    if (readers == NULL){
+        PyErr_NoMemory();
+        return -1;
+    }
+    tree->readers = readers;
+    tree->readers_capacity = capacity;
+    return 0;
+}
+
+
+/* Take the lock of a tree for the current thread, if it has one, with the
+ * GIL. Return 0, or -1 with an exception set. */
+static int
+_lock(base_tree *tree, int exclusive){
+    unsigned long me;
+    int res;
+
+    if (tree->lock == NULL)
+        return 0;
+    me = PyThread_get_thread_ident();
+    if ((tree->writing && tree->writer == me) || _reader(tree, me) >= 0){
+        if (exclusive){
+            PyErr_SetString(PyExc_RuntimeError,
+                            "tree changed while being used by the same thread");
+            return -1;
+        }
+        if (tree->writing && tree->writer == me){
+            tree->nested++;
+            return 0;
+        }
+        if (_reserve_reader(tree) < 0)
+            return -1;
+        tree->readers[tree->n_readers++] = me;
+        return 0;
+    }
+
+    if (!exclusive && _reserve_reader(tree) < 0)
+        return -1;
+    res = exclusive ? pthread_rwlock_trywrlock(tree->lock)
+                    : pthread_rwlock_tryrdlock(tree->lock);
+    if (res == EBUSY){
+        Py_BEGIN_ALLOW_THREADS
+        if (exclusive){
+            res = pthread_rwlock_wrlock(tree->lock);
+        } else {
+            res = pthread_rwlock_rdlock(tree->lock);
+        }
+        Py_END_ALLOW_THREADS
+    }
+    if (res != 0)
+        return _lock_error(res);
+
+    if (exclusive){
+        tree->writing = 1;
+        tree->writer = me;
+        tree->nested = 0;
+    } else {
+        tree->readers[tree->n_readers++] = me;
+    }
+    return 0;
+}
+
+
+/* release what _lock took, with the GIL */
+static void
+_unlock(base_tree *tree){
+    PyObject **trash = NULL;
+    Py_ssize_t i, n = 0;
+    unsigned long me;
+
+    if (tree->lock == NULL)
+        return;
+    me = PyThread_get_thread_ident();
+    if (tree->writing && tree->writer == me){
+        if (tree->nested > 0){
+            tree->nested--;
+            return;
+        }
+        trash = tree->trash;
+        n = tree->n_trash;
+        tree->writing = 0;
+        tree->trash = NULL;
+        tree->n_trash = tree->trash_capacity = 0;
+    } else {
+        i = _reader(tree, me);
+        tree->readers[i] = tree->readers[--tree->n_readers];
+        if (_reader(tree, me) >= 0)
+            return;
+    }
+    pthread_rwlock_unlock(tree->lock);
+
+    for(i = 0; i < n; i++)
+        Py_DECREF(trash[i]);
+    PyMem_Free(trash);
+}
+
+
+/* Py_XDECREF, or later if the tree is being written */
 static void
-_delete_tree(node_t *root){
-    if (root == NULL){
+_release(base_tree *tree, PyObject *obj){
+    PyObject **trash;
+    Py_ssize_t capacity;
+
+    if (obj == NULL)
         return;
+    if (tree->writing){
+        if (tree->n_trash == tree->trash_capacity){
+            capacity = tree->trash_capacity ? 2 * tree->trash_capacity : 16;
+            trash = PyMem_Realloc(tree->trash, capacity * sizeof(PyObject *));
+            if (trash != NULL){
+                tree->trash = trash;
+                tree->trash_capacity = capacity;
+            }
+        }
+        if (tree->n_trash < tree->trash_capacity){
+            tree->trash[tree->n_trash++] = obj;
+            return;
+        }
+    }
+    Py_DECREF(obj);
+}
+
+
+/* take the GIL back, keeping the lock */
+static void
+_resume(PyThreadState **state){
+    if (*state != NULL){
+        PyEval_RestoreThread(*state);
+        *state = NULL;
+    }
+}
+
+
+/* Begin a read of tree. A thread-safe tree is locked for reading, without
+ * the GIL if nogil, *state being then set for _resume. Return 0, or -1 with
+ * an exception set. */
+static int
+_begin_read(base_tree *tree, int nogil, PyThreadState **state){
+    unsigned long me;
+    int res;
+
+    *state = NULL;
+    if (tree->lock == NULL)
+        return 0;
+    me = PyThread_get_thread_ident();
+    if (!nogil || (tree->writing && tree->writer == me)
+        || _reader(tree, me) >= 0){
+        return _lock(tree, 0);
+    }
+
+    /* registered first, as readers is only changed with the GIL */
+    if (_reserve_reader(tree) < 0)
+        return -1;
+    tree->readers[tree->n_readers++] = me;
+    *state = PyEval_SaveThread();
+    res = pthread_rwlock_rdlock(tree->lock);
+    if (res != 0){
+        _resume(state);
+        tree->readers[_reader(tree, me)] = tree->readers[--tree->n_readers];
+        return _lock_error(res);
+    }
+    return 0;
+}
+
+
+/* the kind of key, whose native value is set in *n for an int or float */
+static key_kind
+_key_kind(PyObject *key, native_key *n){
+    int overflow;
+
+    if (PyLong_CheckExact(key)){
+        n->i = PyLong_AsLongLongAndOverflow(key, &overflow);
+        return overflow ? OBJECT_KEYS : INT_KEYS;
+    } else if (PyUnicode_CheckExact(key)){
+        return STR_KEYS;
+    } else if (PyFloat_CheckExact(key)){
+        n->f = PyFloat_AS_DOUBLE(key);
+        return FLOAT_KEYS;
     }
-    if (LEFT_NODE(root) != NULL){
-        _delete_tree(LEFT_NODE(root));
+    return OBJECT_KEYS;
+}
+
+
+/* Empty the tree at once, its nodes being released by _release_dropped.
+ * No code is run. */
+static void
+_drop_nodes(base_tree *tree){
+    node_slab *slab = tree->slabs;
+
+    if (slab != NULL){
+        while(slab->next != NULL)
+            slab = slab->next;
+        slab->next = tree->dropped;
+        tree->dropped = tree->slabs;
     }
-    if (RIGHT_NODE(root) != NULL){
-        _delete_tree(RIGHT_NODE(root));
+    tree->n_dropped += tree->size;
+    tree->root = NULL;
+    tree->size = 0;
+    tree->version++;
+    tree->slabs = NULL;
+    tree->free_nodes = NULL;
+    tree->kind = EMPTY_KEYS;
+}
+
+
+/* Release the keys and values of up to limit dropped nodes, all of them if
+ * limit is negative, freeing the slabs once done with. Each node is taken
+ * off before its references, which may run any code, even clear() again.
+ * Return the number of nodes left. */
+static Py_ssize_t
+_release_dropped(base_tree *tree, Py_ssize_t limit){
+    node_slab *slab;
+    node_t *node;
+    PyObject *key, *value;
+
+    while((slab = tree->dropped) != NULL && (limit != 0 || tree->n_dropped == 0)){
+        if (slab->used == 0){
+            tree->dropped = slab->next;
+            PyMem_Free(slab);
+            continue;
+        }
+        node = &slab->nodes[--slab->used];
+        if (node->key == NULL)
+            continue;
+        key = node->key;
+        value = node->value;
+        node->key = node->value = NULL;
+        tree->n_dropped--;
+        if (limit > 0)
+            limit--;
+        Py_DECREF(key);
+        Py_DECREF(value);
     }
-    Py_XDECREF(root->key);
-    Py_XDECREF(root->value);
-    PyMem_Free(root);
+    return tree->n_dropped;
 }
 
 
 static node_t *
-_new_node(PyObject *key, PyObject *value){
-    node_t * node = PyMem_Malloc(sizeof(node_t));
+_new_node(base_tree *tree, PyObject *key, PyObject *value){
+    node_t *node = tree->free_nodes;
+    node_slab *slab = tree->slabs;
+    Py_ssize_t capacity;
+    key_kind kind;
+
     if (node != NULL){
-        LEFT_NODE(node) = NULL;
-        RIGHT_NODE(node) = NULL;
-        Py_INCREF(key);
-        Py_INCREF(value);
-        node->key = key;
-        node->value = value;
+        tree->free_nodes = LEFT_NODE(node);
+    } else {
+        if (slab == NULL || slab->used == slab->capacity){
+            capacity = (slab == NULL) ? SLAB_MIN : 2 * slab->capacity;
+            if (capacity > SLAB_MAX)
+                capacity = SLAB_MAX;
+            slab = PyMem_Malloc(sizeof(node_slab) + (capacity - 1) * sizeof(node_t));
+            if (slab == NULL){
+                PyErr_NoMemory();
+                return NULL;
+            }
+            slab->next = tree->slabs;
+            slab->used = 0;
+            slab->capacity = capacity;
+            tree->slabs = slab;
+        }
+        node = &slab->nodes[slab->used++];
+    }
+
+    kind = _key_kind(key, &node->nkey);
+    if (tree->kind == EMPTY_KEYS){
+        tree->kind = kind;
+    } else if (tree->kind != kind){
+        tree->kind = OBJECT_KEYS;
     }
+
+    LEFT_NODE(node) = NULL;
+    RIGHT_NODE(node) = NULL;
+    node->count = 1;
+    Py_INCREF(key);
+    Py_INCREF(value);
+    node->key = key;
+    node->value = value;
     return node;
 }
 
 
+/* put an unlinked node back to the free list. The slabs are released at
+ * once when the tree becomes empty. */
 static void
-_delete_node(node_t *node){
-    if (node != NULL){
-        Py_XDECREF(node->key);
-        Py_XDECREF(node->value);
-        PyMem_Free(node);
+_delete_node(base_tree *tree, node_t *node){
+    PyObject *key = node->key, *value = node->value;
+
+    node->key = node->value = NULL;
+    if (tree->size == 0){
+        /* no node holds a key */
+        _drop_nodes(tree);
+        _release_dropped(tree, 0);
+    } else {
+        LEFT_NODE(node) = tree->free_nodes;
+        tree->free_nodes = node;
     }
+    /* last, as it may run arbitrary code */
+    _release(tree, key);
+    _release(tree, value);
 }
 
 static void
 _swap_node_data(node_t *n1, node_t *n2){
     PyObject *tmp_p;
+    native_key tmp_n;
     int tmp_i;
 
     tmp_p = n1->key;   n1->key = n2->key;  n2->key = tmp_p;
     tmp_p = n1->value;   n1->value = n2->value;  n2->value = tmp_p;
+    tmp_n = n1->nkey;   n1->nkey = n2->nkey;  n2->nkey = tmp_n;
     tmp_i = n1->xdata;   n1->xdata = n2->xdata;  n2->xdata = tmp_i;
 }
 
@@ -84,15 +447,17 @@ _swap_node_data(node_t *n1, node_t *n2){
  * return 1:  key1 > key2
  * return 0:  key1 == key2 or error*/
 static int
-_compare(PyObject *key1, PyObject *key2){
+_rich_compare(PyObject *key1, PyObject *key2){
     int res;
 
     res = PyObject_RichCompareBool(key1, key2, Py_LT);
     if (res > 0){
         return -1;
     } else if (res < 0){
-        /* should check error indicator later */
-        PyErr_SetString(PyExc_TypeError, "invalid type for key");
+        /* should check error indicator later, others than a TypeError,
+         * e.g. from using the tree in __lt__, are kept */
+        if (PyErr_ExceptionMatches(PyExc_TypeError))
+            PyErr_SetString(PyExc_TypeError, "invalid type for key");
         return 0;
     }
 
@@ -102,6 +467,174 @@ _compare(PyObject *key1, PyObject *key2){
 }
 
 
+/* Same as _rich_compare. If the keys of tree are all of one kind, keys of
+ * that kind are compared natively in one go. tree may be NULL when the
+ * keys are not those of a tree. */
+static int
+_compare(base_tree *tree, PyObject *key1, PyObject *key2){
+    native_key n1, n2;
+    key_kind kind;
+
+    if (Py_TYPE(key1) == Py_TYPE(key2)
+        && (tree == NULL || tree->kind != OBJECT_KEYS)){
+        kind = _key_kind(key1, &n1);
+        if (kind == STR_KEYS){
+            return PyUnicode_Compare(key1, key2);
+        } else if (kind != OBJECT_KEYS && _key_kind(key2, &n2) == kind){
+            if (kind == INT_KEYS)
+                return (n1.i > n2.i) - (n1.i < n2.i);
+            /* NaN is equal to anything, as with rich comparison */
+            return (n1.f > n2.f) - (n1.f < n2.f);
+        }
+    }
+    return _rich_compare(key1, key2);
+}
+
+
+/* A key looked up in a tree, converted once for all the nodes on the way
+ * if it is of the kind of all the keys of the tree. */
+typedef struct {
+    PyObject *key;
+    key_kind kind;      /* kind of the tree, or OBJECT_KEYS if not native */
+    native_key n;
+} probe_t;
+
+
+static void
+_init_probe(base_tree *tree, PyObject *key, probe_t *probe){
+    probe->key = key;
+    probe->kind = OBJECT_KEYS;
+    probe->n.i = 0;
+    if (tree->kind != OBJECT_KEYS && _key_kind(key, &probe->n) == tree->kind){
+        probe->kind = tree->kind;
+    }
+}
+
+
+/* PyUnicode_Compare, which may run without the GIL */
+static int
+_str_compare(PyObject *s1, PyObject *s2){
+    int kind1 = PyUnicode_KIND(s1), kind2 = PyUnicode_KIND(s2);
+    const void *data1 = PyUnicode_DATA(s1), *data2 = PyUnicode_DATA(s2);
+    Py_ssize_t i, len1 = PyUnicode_GET_LENGTH(s1), len2 = PyUnicode_GET_LENGTH(s2);
+    Py_ssize_t len = (len1 < len2) ? len1 : len2;
+    Py_UCS4 c1, c2;
+    int res;
+
+    if (kind1 == PyUnicode_1BYTE_KIND && kind2 == PyUnicode_1BYTE_KIND){
+        res = memcmp(data1, data2, len);
+        if (res != 0)
+            return (res > 0) - (res < 0);
+    } else {
+        for(i = 0; i < len; i++){
+            c1 = PyUnicode_READ(kind1, data1, i);
+            c2 = PyUnicode_READ(kind2, data2, i);
+            if (c1 != c2)
+                return (c1 > c2) - (c1 < c2);
+        }
+    }
+    return (len1 > len2) - (len1 < len2);
+}
+
+
+/* Begin a lookup of one or two probes, set by _init_probe, or of none.
+ * Lookups of native probes in a thread-safe tree run without the GIL, see
+ * _begin_read. The kind of the tree may have changed while waiting for the
+ * lock, and the probes are checked again. Return 0, or -1 with an
+ * exception set. */
+static int
+_begin_lookup(base_tree *tree, probe_t *probe1, probe_t *probe2,
+              PyThreadState **state){
+    int nogil = (probe1 == NULL || probe1->kind != OBJECT_KEYS)
+                && (probe2 == NULL || probe2->kind != OBJECT_KEYS);
+
+    if (_begin_read(tree, nogil, state) < 0)
+        return -1;
+    if (probe1 != NULL && probe1->kind != tree->kind)
+        probe1->kind = OBJECT_KEYS;
+    if (probe2 != NULL && probe2->kind != tree->kind)
+        probe2->kind = OBJECT_KEYS;
+    if (nogil && ((probe1 != NULL && probe1->kind == OBJECT_KEYS)
+                  || (probe2 != NULL && probe2->kind == OBJECT_KEYS)))
+        _resume(state);
+    return 0;
+}
+
+
+/* whether comparing probe failed, a native probe never fails and may be
+ * compared without the GIL */
+#define PROBE_ERROR(probe) \
+    ((probe)->kind == OBJECT_KEYS && PyErr_Occurred() != NULL)
+
+
+/* _compare of the probe with the key of node */
+static int
+_compare_probe(base_tree *tree, probe_t *probe, node_t *node){
+    switch(probe->kind){
+    case INT_KEYS:
+        return (probe->n.i > node->nkey.i) - (probe->n.i < node->nkey.i);
+    case FLOAT_KEYS:
+        return (probe->n.f > node->nkey.f) - (probe->n.f < node->nkey.f);
+    case STR_KEYS:
+        return _str_compare(probe->key, node->key);
+    default:
+        return _rich_compare(probe->key, node->key);
+    }
+}
+
+
+/* The nodes from the root down to a node of a BinaryTree, whose height is
+ * not bounded: on the C stack first, then on the heap. Also the stack of
+ * the walks, no traversal recursing. */
+typedef struct {
+    node_t **nodes;
+    Py_ssize_t depth;
+    Py_ssize_t capacity;
+    node_t *local[AVL_MAX_HEIGHT];
+} node_path;
+
+
+static void
+_path_init(node_path *path){
+    path->nodes = path->local;
+    path->depth = 0;
+    path->capacity = AVL_MAX_HEIGHT;
+}
+
+
+static int
+_path_push(node_path *path, node_t *node){
+    node_t **nodes;
+
+    if (path->depth == path->capacity){
+        nodes = PyMem_Malloc(2 * path->capacity * sizeof(node_t *));
+        if (nodes == NULL){
+            PyErr_NoMemory();
+            return -1;
+        }
+        memcpy(nodes, path->nodes, path->depth * sizeof(node_t *));
+        if (path->nodes != path->local)
+            PyMem_Free(path->nodes);
+        path->nodes = nodes;
+        path->capacity *= 2;
+    }
+    path->nodes[path->depth++] = node;
+    return 0;
+}
+
+
+/* add delta to the sizes of the nodes of path, and release it */
+static void
+_path_done(node_path *path, Py_ssize_t delta){
+    Py_ssize_t i;
+
+    for(i = 0; i < path->depth; i++)
+        path->nodes[i]->count += delta;
+    if (path->nodes != path->local)
+        PyMem_Free(path->nodes);
+}
+
+
 /* if get a key or a value, return a borrowed reference,
  * if get a key-value pair, return a new reference,
  * if failed, return NULL */
@@ -126,28 +659,44 @@ _get_object(node_t *node, content_type t){
 }
 
 
+/* Set the keys, values or items of the subtree of node in order to list
+ * from index 0, with an explicit stack. The subtree must fill list exactly,
+ * else RuntimeError is raised and list is not to be used. */
 static int
 _inorder_walk(node_t *node, PyObject *list, content_type t){
+    node_path stack;
     PyObject *item;
-    int res;
-
-    if (node != NULL){
-        if (_inorder_walk(CHILD(node, LEFT), list, t) < 0)
-            return -1;
+    Py_ssize_t i = 0;
 
-        item = _get_object(node, t);
-        if (item == NULL)
-            return -1;
-        res = PyList_Append(list, item);
-        if (t == ITEM)
-            Py_DECREF(item);
-        if (res < 0)
-            return -1;
-    
-        if(_inorder_walk(CHILD(node, RIGHT), list, t) < 0)
-            return -1;
+    _path_init(&stack);
+    while(node != NULL || stack.depth > 0){
+        if (node != NULL){
+            if (_path_push(&stack, node) < 0){
+                _path_done(&stack, 0);
+                return -1;
+            }
+            node = LEFT_NODE(node);
+        } else {
+            node = stack.nodes[--stack.depth];
+            if (i == PyList_GET_SIZE(list))
+                break;
+            item = _get_object(node, t);
+            if (item == NULL){
+                _path_done(&stack, 0);
+                return -1;
+            }
+            if (t != ITEM)
+                Py_INCREF(item);
+            PyList_SET_ITEM(list, i++, item);
+            node = RIGHT_NODE(node);
+        }
+    }
+    _path_done(&stack, 0);
+    if (i != PyList_GET_SIZE(list) || node != NULL || stack.depth > 0){
+        PyErr_SetString(PyExc_RuntimeError,
+                        "tree size does not match its nodes");
+        return -1;
     }
-
     return 0;
 }
 
@@ -171,34 +720,109 @@ _min_or_max(node_t *node, node_t **target, node_t **parent, int is_max){
 }
 
 
+static int
+init_tree(base_tree *self, PyObject *args, PyObject *kwds){
+    static char *kwlist[] = {"threadsafe", NULL};
+    int threadsafe = 0, res;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|p", kwlist, &threadsafe))
+        return -1;
+
+    /* a thread-safe tree stays so, other threads may be using the lock */
+    if (threadsafe && self->lock == NULL){
+        self->lock = PyMem_RawMalloc(sizeof(pthread_rwlock_t));
+        if (self->lock == NULL){
+            PyErr_NoMemory();
+            return -1;
+        }
+        res = pthread_rwlock_init(self->lock, NULL);
+        if (res != 0){
+            PyMem_RawFree(self->lock);
+            self->lock = NULL;
+            return _lock_error(res);
+        }
+    }
+    return 0;
+}
+
+
 static void
 dealloc_tree(base_tree *self){
-    _delete_tree(self->root);
-    self->root = NULL;
+    _drop_nodes(self);
+    _release_dropped(self, -1);
+    if (self->lock != NULL){
+        pthread_rwlock_destroy(self->lock);
+        PyMem_RawFree(self->lock);
+    }
+    PyMem_Free(self->readers);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+
+PyDoc_STRVAR(clear__doc__,
+"clear(limit=-1) -> number of removed items left to release\n\n\
+Remove all items at once, then release the keys and values of up to limit\n\
+of them, all if limit is negative. The next calls release the rest, so\n\
+that a large tree is freed by chunks, e.g. while tree.clear(10000): ...");
+
+static PyObject *
+tree_clear(base_tree *self, PyObject *args){
+    Py_ssize_t limit = -1;
+
+    if (!PyArg_ParseTuple(args, "|n:clear", &limit))
+        return NULL;
+
+    if (_lock(self, 1) < 0)
+        return NULL;
+    _drop_nodes(self);
+    _unlock(self);
+    return PyLong_FromSsize_t(_release_dropped(self, limit));
+}
+
+
+static PyObject *
+tree_threadsafe(base_tree *self, void *closure){
+    return PyBool_FromLong(self->lock != NULL);
 }
 
 
+static PyGetSetDef tree_getset[] = {
+    {"threadsafe", (getter)tree_threadsafe, NULL,
+     "whether the tree has a reader-writer lock", NULL},
+    {NULL}  /* Sentinel */
+};
+
+
 static PyObject *
 tree_root(base_tree *self){
+    PyObject *item = NULL;
+
+    if (_lock(self, 0) < 0)
+        return NULL;
     if (self->root == NULL){
         PyErr_SetString(EmptyError, empty_error_str);
-        return NULL;
     } else {
-        return _get_object(self->root, ITEM);
+        item = _get_object(self->root, ITEM);
     }
+    _unlock(self);
+    return item;
 }
 
-
 #define DEFINE_MAX_MIN(SUFFIX, IS_MAX) \
     static PyObject * \
     tree_##SUFFIX(base_tree *self){ \
         node_t *node, *p; \
+        PyObject *item = NULL; \
+        if (_lock(self, 0) < 0) \
+            return NULL; \
         if (self->size == 0){ \
             PyErr_SetString(EmptyError, empty_error_str); \
-            return NULL; \
+        } else { \
+            _min_or_max(self->root, &node, &p, IS_MAX); \
+            item = _get_object(node, ITEM); \
         } \
-        _min_or_max(self->root, &node, &p, IS_MAX); \
-        return _get_object(node, ITEM); \
+        _unlock(self); \
+        return item; \
     } \
 
 
@@ -210,38 +834,55 @@ static PyObject *
 tree_subscript(base_tree *self, PyObject *key){
 
     int cmp_res;
-    node_t *node = self->root;
+    node_t *node;
+    PyObject *value = NULL;
+    PyThreadState *state;
+    probe_t probe;
 
+    _init_probe(self, key, &probe);
+    if (_begin_lookup(self, &probe, NULL, &state) < 0)
+        return NULL;
+    node = self->root;
     while(node != NULL){
-        cmp_res = _compare(key, node->key);
-        if (cmp_res == 0){
-            if (PyErr_Occurred())
-                return NULL;
-            Py_INCREF(node->value);
-            return node->value;
-        }
+        cmp_res = _compare_probe(self, &probe, node);
+        if (cmp_res == 0)
+            break;
         node = CHILD(node, (cmp_res > 0) ? RIGHT : LEFT);
     }
-    _PyErr_SetKeyError(key);
-    return NULL;
+    _resume(&state);
+
+    if (node == NULL){
+        _PyErr_SetKeyError(key);
+    } else if (!PyErr_Occurred()){
+        value = node->value;
+        Py_INCREF(value);
+    }
+    _unlock(self);
+    return value;
+}
+
+
+/* all keys, values or items in order, to be called under the lock */
+static PyObject *
+_get_all(base_tree *self, content_type t){
+    PyObject *list = PyList_New(self->size);
+
+    if (list != NULL && _inorder_walk(self->root, list, t) < 0){
+        Py_CLEAR(list);
+    }
+    return list;
 }
 
+
 #define DEFINE_GET_ALL(SUFFIX,C_TYPE) \
     static PyObject * \
     tree_##SUFFIX(base_tree *self){ \
-        PyObject *list = PyList_New(0); \
-        if (self->size == 0){ \
-            return list; \
-        } else { \
-            if (list == NULL){ \
-                return NULL; \
-            } \
-            if (_inorder_walk(self->root, list, C_TYPE) < 0){ \
-                Py_DECREF(list); \
-                return NULL; \
-            } \
-            return list; \
-        } \
+        PyObject *list; \
+        if (_lock(self, 0) < 0) \
+            return NULL; \
+        list = _get_all(self, C_TYPE); \
+        _unlock(self); \
+        return list; \
     } \
 
 DEFINE_GET_ALL(keys, KEY)
@@ -253,125 +894,1679 @@ tree_length(base_tree *self){
     return self->size;
 }
 
-static int
-binary_insert(base_tree *self, PyObject *key, PyObject *value){
+/* Lazy in-order iterator over the keys, values or items of a tree, walking
+ * it with an explicit stack. The stack holds the nodes still to be yielded
+ * whose subtree on the side already walked is done: the next node is on
+ * top, and after yielding it the spine of its other subtree is pushed. A
+ * reverse iterator walks the mirror image. */
+typedef struct {
+    PyObject_HEAD
+    base_tree *tree;
+    node_t **stack;
+    Py_ssize_t depth;
+    Py_ssize_t capacity;
+    content_type t;
+    int d;                /* LEFT in ascending order, RIGHT in descending */
+    PyObject *stop;       /* bound of the last key, or NULL */
+    int stop_inclusive;
+    Py_ssize_t version;
+} tree_iterator;
 
-    node_t *node, *p;
-    int cmp_res, child;
+static PyTypeObject TreeIterType;
 
-    if (self->root == NULL){
-        node = _new_node(key, value);
-        if (node == NULL)
-            return -1;
-        self->root = node;
-        self->size = 1;
-        return 0;
-    }
 
-    p = NULL;
+static int
+_iter_push(tree_iterator *it, node_t *node){
+    node_t **stack;
+    Py_ssize_t capacity;
+
+    if (it->depth == it->capacity){
+        capacity = it->capacity ? 2 * it->capacity : 32;
+        stack = PyMem_Realloc(it->stack, capacity * sizeof(node_t *));
+        if (stack == NULL){
+            PyErr_NoMemory();
+            return -1;
+        }
+        it->stack = stack;
+        it->capacity = capacity;
+    }
+    it->stack[it->depth++] = node;
+    return 0;
+}
+
+
+/* Compare key to bound in the order of the iteration. Return 1 if key
+ * comes after bound, or is equal and equal passes, 0 if not, -1 on error. */
+static int
+_passes(tree_iterator *it, PyObject *key, PyObject *bound, int equal){
+    int cmp_res = _compare(it->tree, key, bound);
+
+    if (cmp_res == 0){
+        return PyErr_Occurred() ? -1 : equal;
+    }
+    return ((it->d == LEFT) ? cmp_res : -cmp_res) > 0;
+}
+
+
+/* Push the path to the first node at or after start, or to the first node
+ * of the tree if start is NULL */
+static int
+_iter_seek(tree_iterator *it, PyObject *start, int start_inclusive){
+    node_t *node = it->tree->root;
+    int res;
+
+    while(node != NULL){
+        if (start == NULL){
+            res = 1;
+        } else {
+            res = _passes(it, node->key, start, start_inclusive);
+            if (res < 0)
+                return -1;
+        }
+        if (res){
+            if (_iter_push(it, node) < 0)
+                return -1;
+            node = CHILD(node, it->d);
+        } else {
+            node = CHILD(node, 1 - it->d);
+        }
+    }
+    return 0;
+}
+
+
+static PyObject *
+_new_iter(base_tree *tree, content_type t, int reverse, PyObject *start,
+          int start_inclusive, PyObject *stop, int stop_inclusive){
+    tree_iterator *it;
+    int res;
+
+    it = PyObject_New(tree_iterator, &TreeIterType);
+    if (it == NULL)
+        return NULL;
+
+    Py_INCREF(tree);
+    it->tree = tree;
+    it->stack = NULL;
+    it->depth = it->capacity = 0;
+    it->t = t;
+    it->d = reverse ? RIGHT : LEFT;
+    Py_XINCREF(stop);
+    it->stop = stop;
+    it->stop_inclusive = stop_inclusive;
+
+    if (_lock(tree, 0) < 0){
+        Py_DECREF(it);
+        return NULL;
+    }
+    it->version = tree->version;
+    res = _iter_seek(it, start, start_inclusive);
+    _unlock(tree);
+    if (res < 0){
+        Py_DECREF(it);
+        return NULL;
+    }
+    return (PyObject *)it;
+}
+
+
+static void
+tree_iter_dealloc(tree_iterator *it){
+    Py_DECREF(it->tree);
+    Py_XDECREF(it->stop);
+    PyMem_Free(it->stack);
+    PyObject_Del(it);
+}
+
+
+static PyObject *
+_tree_iter_next(tree_iterator *it){
+    node_t *node, *next;
+    PyObject *item;
+    int res;
+
+    if (it->depth == 0)
+        return NULL;
+    if (it->version != it->tree->version){
+        /* the nodes on the stack may be gone */
+        it->depth = 0;
+        PyErr_SetString(PyExc_RuntimeError,
+                        "tree changed size during iteration");
+        return NULL;
+    }
+
+    node = it->stack[--it->depth];
+    if (it->stop != NULL){
+        res = _passes(it, node->key, it->stop, !it->stop_inclusive);
+        if (res != 0){
+            it->depth = 0;
+            return NULL;
+        }
+    }
+
+    for(next = CHILD(node, 1 - it->d); next != NULL; next = CHILD(next, it->d)){
+        if (_iter_push(it, next) < 0)
+            return NULL;
+    }
+
+    item = _get_object(node, it->t);
+    if (it->t != ITEM)
+        Py_XINCREF(item);
+    return item;
+}
+
+
+static PyObject *
+tree_iter_next(tree_iterator *it){
+    PyObject *item;
+
+    if (_lock(it->tree, 0) < 0)
+        return NULL;
+    item = _tree_iter_next(it);
+    _unlock(it->tree);
+    return item;
+}
+
+
+static PyObject *
+tree_iter_self(PyObject *it){
+    Py_INCREF(it);
+    return it;
+}
+
+
+static PyTypeObject TreeIterType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "tree.TreeIterator",       /* tp_name */
+    sizeof(tree_iterator),         /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)tree_iter_dealloc, /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    "lazy in-order iterator of a tree", /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    tree_iter_self,            /* tp_iter */
+    (iternextfunc)tree_iter_next, /* tp_iternext */
+};
+
+
+static PyObject *
+tree_iter(base_tree *self){
+    return _new_iter(self, KEY, 0, NULL, 0, NULL, 0);
+}
+
+
+#define DEFINE_ITER(SUFFIX, C_TYPE, REVERSE) \
+    static PyObject * \
+    tree_##SUFFIX(base_tree *self){ \
+        return _new_iter(self, C_TYPE, REVERSE, NULL, 0, NULL, 0); \
+    } \
+
+DEFINE_ITER(iterkeys, KEY, 0)
+DEFINE_ITER(itervalues, VALUE, 0)
+DEFINE_ITER(iteritems, ITEM, 0)
+DEFINE_ITER(reversed, KEY, 1)
+
+
+static PyObject *
+_irange(base_tree *self, PyObject *args, PyObject *kwds, content_type t){
+    static char *kwlist[] = {"lo", "hi", "inclusive", "reverse", NULL};
+    PyObject *lo = Py_None, *hi = Py_None;
+    int lo_inclusive = 1, hi_inclusive = 1, reverse = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|OO(pp)p:irange", kwlist,
+                                     &lo, &hi, &lo_inclusive, &hi_inclusive,
+                                     &reverse))
+        return NULL;
+
+    lo = (lo == Py_None) ? NULL : lo;
+    hi = (hi == Py_None) ? NULL : hi;
+    if (reverse){
+        return _new_iter(self, t, 1, hi, hi_inclusive, lo, lo_inclusive);
+    }
+    return _new_iter(self, t, 0, lo, lo_inclusive, hi, hi_inclusive);
+}
+
+
+PyDoc_STRVAR(irange__doc__,
+"irange(lo=None, hi=None, inclusive=(True, True), reverse=False) -> iterator\n\
+over the keys between lo and hi in order, None for no bound. Each bound is\n\
+included or not according to inclusive.");
+
+static PyObject *
+tree_irange(base_tree *self, PyObject *args, PyObject *kwds){
+    return _irange(self, args, kwds, KEY);
+}
+
+
+static PyObject *
+tree_irange_items(base_tree *self, PyObject *args, PyObject *kwds){
+    return _irange(self, args, kwds, ITEM);
+}
+
+
+/* The node of the greatest key before key (d == LEFT) or of the least key
+ * after it (d == RIGHT), key itself included if inclusive. NULL if there
+ * is none, check the error indicator. */
+static node_t *
+_bound(base_tree *self, probe_t *probe, int d, int inclusive){
+    node_t *node = self->root, *found = NULL;
+    int cmp_res;
+
+    while(node != NULL){
+        cmp_res = _compare_probe(self, probe, node);
+        if (cmp_res == 0){
+            if (PROBE_ERROR(probe))
+                return NULL;
+            if (inclusive)
+                return node;
+            node = CHILD(node, d);
+        } else if ((d == LEFT) ? cmp_res > 0 : cmp_res < 0){
+            /* node is on the side searched, look for a closer one */
+            found = node;
+            node = CHILD(node, 1 - d);
+        } else {
+            node = CHILD(node, d);
+        }
+    }
+    return found;
+}
+
+
+#define DEFINE_BOUND(SUFFIX, D) \
+    static PyObject * \
+    tree_##SUFFIX(base_tree *self, PyObject *key){ \
+        PyObject *item = NULL; \
+        PyThreadState *state; \
+        probe_t probe; \
+        node_t *node; \
+        _init_probe(self, key, &probe); \
+        if (_begin_lookup(self, &probe, NULL, &state) < 0) \
+            return NULL; \
+        node = _bound(self, &probe, D, 1); \
+        _resume(&state); \
+        if (node != NULL){ \
+            item = _get_object(node, ITEM); \
+        } else if (!PyErr_Occurred()){ \
+            _PyErr_SetKeyError(key); \
+        } \
+        _unlock(self); \
+        return item; \
+    } \
+
+DEFINE_BOUND(floor, LEFT)
+DEFINE_BOUND(ceiling, RIGHT)
+
+
+/* Number of keys before key, key itself included if inclusive, found with
+ * the sizes of the subtrees. -1 on error. */
+static Py_ssize_t
+_rank(base_tree *self, probe_t *probe, int inclusive){
+    node_t *node = self->root;
+    Py_ssize_t rank = 0;
+    int cmp_res;
+
+    while(node != NULL){
+        cmp_res = _compare_probe(self, probe, node);
+        if (cmp_res == 0){
+            if (PROBE_ERROR(probe))
+                return -1;
+            rank += COUNT(LEFT_NODE(node)) + (inclusive ? 1 : 0);
+            break;
+        } else if (cmp_res > 0){
+            rank += COUNT(LEFT_NODE(node)) + 1;
+            node = RIGHT_NODE(node);
+        } else {
+            node = LEFT_NODE(node);
+        }
+    }
+    return rank;
+}
+
+
+static PyObject *
+_rank_of(base_tree *self, PyObject *key, int inclusive){
+    PyThreadState *state;
+    probe_t probe;
+    Py_ssize_t rank;
+
+    _init_probe(self, key, &probe);
+    if (_begin_lookup(self, &probe, NULL, &state) < 0)
+        return NULL;
+    rank = _rank(self, &probe, inclusive);
+    _resume(&state);
+    _unlock(self);
+    return (rank < 0) ? NULL : PyLong_FromSsize_t(rank);
+}
+
+
+static PyObject *
+tree_bisect_left(base_tree *self, PyObject *key){
+    return _rank_of(self, key, 0);
+}
+
+
+static PyObject *
+tree_bisect_right(base_tree *self, PyObject *key){
+    return _rank_of(self, key, 1);
+}
+
+static PyObject *
+tree_select(base_tree *self, PyObject *arg){
+    node_t *node = NULL;
+    PyObject *item = NULL;
+    PyThreadState *state;
+    Py_ssize_t k, i, left;
+
+    k = PyNumber_AsSsize_t(arg, PyExc_IndexError);
+    if (k == -1 && PyErr_Occurred())
+        return NULL;
+
+    if (_begin_lookup(self, NULL, NULL, &state) < 0)
+        return NULL;
+    i = (k < 0) ? k + self->size : k;
+    if (i >= 0 && i < self->size){
+        node = self->root;
+        while(i != (left = COUNT(LEFT_NODE(node)))){
+            if (i < left){
+                node = LEFT_NODE(node);
+            } else {
+                i -= left + 1;
+                node = RIGHT_NODE(node);
+            }
+        }
+    }
+    _resume(&state);
+
+    if (node == NULL){
+        PyErr_SetString(PyExc_IndexError, "tree index out of range");
+    } else {
+        item = _get_object(node, ITEM);
+    }
+    _unlock(self);
+    return item;
+}
+
+PyDoc_STRVAR(count_range__doc__,
+"count_range(lo=None, hi=None, inclusive=(True, True)) -> number of keys\n\
+between lo and hi, as irange() would give, in O(log n).");
+
+static PyObject *
+tree_count_range(base_tree *self, PyObject *args, PyObject *kwds){
+    static char *kwlist[] = {"lo", "hi", "inclusive", NULL};
+    PyObject *lo = Py_None, *hi = Py_None;
+    int lo_inclusive = 1, hi_inclusive = 1;
+    Py_ssize_t lo_rank = 0, hi_rank;
+    PyThreadState *state;
+    probe_t lo_probe, hi_probe;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|OO(pp):count_range", kwlist,
+                                     &lo, &hi, &lo_inclusive, &hi_inclusive))
+        return NULL;
+
+    if (lo != Py_None)
+        _init_probe(self, lo, &lo_probe);
+    if (hi != Py_None)
+        _init_probe(self, hi, &hi_probe);
+    if (_begin_lookup(self, (lo != Py_None) ? &lo_probe : NULL,
+                      (hi != Py_None) ? &hi_probe : NULL, &state) < 0)
+        return NULL;
+    hi_rank = self->size;
+    if (lo != Py_None)
+        lo_rank = _rank(self, &lo_probe, !lo_inclusive);
+    if (hi != Py_None && lo_rank >= 0)
+        hi_rank = _rank(self, &hi_probe, hi_inclusive);
+    _resume(&state);
+    _unlock(self);
+
+    if (lo_rank < 0 || hi_rank < 0)
+        return NULL;
+    return PyLong_FromSsize_t((hi_rank > lo_rank) ? hi_rank - lo_rank : 0);
+}
+
+#define ITER_METHODS \
+    {"iterkeys", (PyCFunction)tree_iterkeys, METH_NOARGS, \
+     "lazy iterator over the keys"}, \
+    {"itervalues", (PyCFunction)tree_itervalues, METH_NOARGS, \
+     "lazy iterator over the values"}, \
+    {"iteritems", (PyCFunction)tree_iteritems, METH_NOARGS, \
+     "lazy iterator over the key-value pairs"}, \
+    {"__reversed__", (PyCFunction)tree_reversed, METH_NOARGS, \
+     "lazy iterator over the keys in descending order"}, \
+    {"irange", (PyCFunction)tree_irange, METH_VARARGS | METH_KEYWORDS, \
+     irange__doc__}, \
+    {"irange_items", (PyCFunction)tree_irange_items, \
+     METH_VARARGS | METH_KEYWORDS, \
+     "same as irange(), over the key-value pairs"}, \
+    {"floor", (PyCFunction)tree_floor, METH_O, \
+     "get the pair of the greatest key <= k, KeyError if none"}, \
+    {"ceiling", (PyCFunction)tree_ceiling, METH_O, \
+     "get the pair of the least key >= k, KeyError if none"}, \
+    {"bisect_left", (PyCFunction)tree_bisect_left, METH_O, \
+     "number of keys < k"}, \
+    {"bisect_right", (PyCFunction)tree_bisect_right, METH_O, \
+     "number of keys <= k"}, \
+    {"rank", (PyCFunction)tree_bisect_left, METH_O, \
+     "number of keys < k, in O(log n)"}, \
+    {"select", (PyCFunction)tree_select, METH_O, \
+     "get the key-value pair at index i of the keys in order, in O(log n)"}, \
+    {"count_range", (PyCFunction)tree_count_range, \
+     METH_VARARGS | METH_KEYWORDS, count_range__doc__},
+
+
+/* Unlink the node of key. Return its value as a new reference, or NULL
+ * with KeyError or the error of comparison set. */
+static PyObject *
+_binary_remove(base_tree *self, PyObject *key){
+
+    PyObject *value;
+    node_t *node = self->root, *t, *tp;
+    int cmp_res, chd = LEFT, d;
+    probe_t probe;
+    node_path path;
+
+    _init_probe(self, key, &probe);
+    _path_init(&path);
+    while (node != NULL) {
+        cmp_res = _compare_probe(self, &probe, node);
+        if (cmp_res == 0){
+            if (PyErr_Occurred()){
+                _path_done(&path, 0);
+                return NULL;
+            }
+
+            /* found, the node may hold the last reference */
+            value = node->value;
+            Py_INCREF(value);
+            self->size --;
+            self->version++;
+
+            if (CHILD(node, LEFT) != NULL && CHILD(node, RIGHT) != NULL ){
+                /* replace node by successor or predecessor in turn */
+                d = self->d_flag;
+                node->count--;
+                t = CHILD(node, d);
+                tp = NULL;
+                while(CHILD(t, 1 - d) != NULL){
+                    t->count--;
+                    tp = t;
+                    t = CHILD(t, 1 - d);
+                }
+                _swap_node_data(node, t);
+                if (tp == NULL){
+                    /* successor or predecessor is direct child */
+                    CHILD(node, d) = CHILD(t, d);
+                } else {
+                    CHILD(tp, 1 - d) = CHILD(t, d);
+                }
+                self->d_flag = 1 - d;
+            } else {
+                t = node;
+                cmp_res = (CHILD(node, LEFT) == NULL) ? RIGHT : LEFT;
+                if (path.depth == 0){
+                    /* found on root */
+                    self->root = CHILD(node, cmp_res);
+                } else {
+                    CHILD(path.nodes[path.depth - 1], chd) = CHILD(node, cmp_res);
+                }
+            }
+            _path_done(&path, -1);
+            _delete_node(self, t);
+            return value;
+        }
+
+        if (_path_push(&path, node) < 0){
+            _path_done(&path, 0);
+            return NULL;
+        }
+        chd = (cmp_res > 0) ? RIGHT : LEFT;
+        node = CHILD(node, chd);
+    }
+
+    _path_done(&path, 0);
+    _PyErr_SetKeyError(key);
+    return NULL;
+}
+
+
+static int
+_binary_insert(base_tree *self, PyObject *key, PyObject *value){
+
+    PyObject *old_value;
+    node_t *node = self->root;
+    int cmp_res, child = LEFT;
+    probe_t probe;
+    node_path path;
+
+    if (value == NULL){
+        /* del tree[key] */
+        value = _binary_remove(self, key);
+        if (value == NULL)
+            return -1;
+        _release(self, value);
+        return 0;
+    }
+
+    _init_probe(self, key, &probe);
+    _path_init(&path);
+    while(node != NULL){
+        cmp_res = _compare_probe(self, &probe, node);
+        if (cmp_res == 0){
+            _path_done(&path, 0);
+            if (PyErr_Occurred())
+                return -1;
+            Py_INCREF(value);
+            old_value = node->value;
+            node->value = value;
+            _release(self, old_value);
+            return 0;
+        }
+        if (_path_push(&path, node) < 0){
+            _path_done(&path, 0);
+            return -1;
+        }
+        child = (cmp_res > 0) ? RIGHT : LEFT;
+        node = CHILD(node, child);
+    }
+
+    node = _new_node(self, key, value);
+    if (node == NULL){
+        _path_done(&path, 0);
+        return -1;
+    }
+    if (path.depth == 0){
+        self->root = node;
+    } else {
+        CHILD(path.nodes[path.depth - 1], child) = node;
+    }
+    _path_done(&path, 1);
+    self->size += 1;
+    self->version++;
+    return 0;
+}
+
+
+/* the same function under the exclusive lock of a thread-safe tree, ERROR
+ * if the lock could not be taken */
+#define DEFINE_LOCKED(NAME, R_TYPE, ERROR, PARAMS, ARGS) \
+    static R_TYPE \
+    NAME PARAMS { \
+        R_TYPE res; \
+        if (_lock(self, 1) < 0) \
+            return ERROR; \
+        res = _##NAME ARGS; \
+        _unlock(self); \
+        return res; \
+    } \
+
+DEFINE_LOCKED(binary_insert, int, -1,
+              (base_tree *self, PyObject *key, PyObject *value),
+              (self, key, value))
+
+
+static PyMappingMethods binarytree_as_mapping = {
+    (lenfunc)tree_length,            /*mp_length*/
+    (binaryfunc)tree_subscript,      /*mp_subscript*/
+    (objobjargproc)binary_insert,    /*mp_ass_subscript*/
+};
+
+
+PyDoc_STRVAR(pop__doc__,
+"D.pop(k[,d]) -> v, remove specified key and return the corresponding value.\n\
+If key is not found, d is returned if given, otherwise KeyError is raised");
+
+
+
+
+static PyObject *
+_pop(base_tree *self, PyObject *args,
+     PyObject *(*remove)(base_tree *, PyObject *)){
+
+    PyObject *key, *deflt = NULL, *value;
+
+    if(!PyArg_UnpackTuple(args, "pop", 1, 2, &key, &deflt))
+        return NULL;
+
+    value = remove(self, key);
+    if (value == NULL && deflt != NULL
+        && PyErr_ExceptionMatches(PyExc_KeyError)){
+        PyErr_Clear();
+        Py_INCREF(deflt);
+        return deflt;
+    }
+    return value;
+}
+
+
+static PyObject *
+_binary_pop(base_tree *self, PyObject *args){
+    return _pop(self, args, _binary_remove);
+}
+
+
+DEFINE_LOCKED(binary_pop, PyObject *, NULL,
+              (base_tree *self, PyObject *args),
+              (self, args))
+
+
+static void
+_avl_update(node_t *node){
+    int left = HEIGHT(LEFT_NODE(node)), right = HEIGHT(RIGHT_NODE(node));
+
+    node->xdata = 1 + ((left > right) ? left : right);
+    node->count = 1 + COUNT(LEFT_NODE(node)) + COUNT(RIGHT_NODE(node));
+}
+
+
+/* rotate node towards d, return the new root of the subtree */
+static node_t *
+_avl_rotate(node_t *node, int d){
+    node_t *child = CHILD(node, 1 - d);
+
+    CHILD(node, 1 - d) = CHILD(child, d);
+    CHILD(child, d) = node;
+    _avl_update(node);
+    _avl_update(child);
+    return child;
+}
+
+
+/* restore the balance of node, whose subtrees differ by at most 2 in
+ * height, return the new root of the subtree */
+static node_t *
+_avl_balance(node_t *node){
+    int d, balance = HEIGHT(LEFT_NODE(node)) - HEIGHT(RIGHT_NODE(node));
+
+    if (balance > 1 || balance < -1){
+        /* d is the lower side */
+        d = (balance > 1) ? RIGHT : LEFT;
+        if (HEIGHT(CHILD(CHILD(node, 1 - d), d)) >
+            HEIGHT(CHILD(CHILD(node, 1 - d), 1 - d))){
+            CHILD(node, 1 - d) = _avl_rotate(CHILD(node, 1 - d), 1 - d);
+        }
+        return _avl_rotate(node, d);
+    }
+    _avl_update(node);
+    return node;
+}
+
+
+/* Rebalance the nodes of path from the bottom up and update their sizes,
+ * after an insertion or a removal below path[depth - 1]. dirs[i] is the
+ * child of path[i] taken. */
+static void
+_avl_fix_path(base_tree *self, node_t **path, int *dirs, int depth){
+    node_t *node;
+    int height, balanced = 0;
+
+    while(depth-- > 0){
+        if (balanced){
+            /* only the sizes change above */
+            node = path[depth];
+            node->count = 1 + COUNT(LEFT_NODE(node)) + COUNT(RIGHT_NODE(node));
+            continue;
+        }
+        height = path[depth]->xdata;
+        node = _avl_balance(path[depth]);
+        if (depth == 0){
+            self->root = node;
+        } else {
+            CHILD(path[depth - 1], dirs[depth - 1]) = node;
+        }
+        if (node == path[depth] && node->xdata == height){
+            balanced = 1;
+        }
+    }
+}
+
+
+/* Unlink the node of key and rebalance. Return its value as a new
+ * reference, or NULL with KeyError or the error of comparison set. */
+static PyObject *
+_avl_remove(base_tree *self, PyObject *key){
+    node_t *path[AVL_MAX_HEIGHT], *node = self->root, *t;
+    int dirs[AVL_MAX_HEIGHT], depth = 0, cmp_res;
+    PyObject *tmp, *value;
+    native_key ntmp;
+    probe_t probe;
+    Py_ssize_t version = self->version;
+
+    _init_probe(self, key, &probe);
+    while(node != NULL){
+        cmp_res = _compare_probe(self, &probe, node);
+        if (PROBE_ERROR(&probe))
+            return NULL;
+        if (self->version != version){
+            /* by the comparison, path is stale */
+            PyErr_SetString(PyExc_RuntimeError,
+                            "tree changed size during removal");
+            return NULL;
+        }
+        if (cmp_res == 0)
+            break;
+        path[depth] = node;
+        dirs[depth++] = (cmp_res > 0) ? RIGHT : LEFT;
+        node = CHILD(node, dirs[depth - 1]);
+    }
+    if (node == NULL){
+        _PyErr_SetKeyError(key);
+        return NULL;
+    }
+
+    if (LEFT_NODE(node) != NULL && RIGHT_NODE(node) != NULL){
+        /* take the place of the successor, which has no left child */
+        path[depth] = node;
+        dirs[depth++] = RIGHT;
+        t = RIGHT_NODE(node);
+        while(LEFT_NODE(t) != NULL){
+            path[depth] = t;
+            dirs[depth++] = LEFT;
+            t = LEFT_NODE(t);
+        }
+        tmp = node->key;   node->key = t->key;  t->key = tmp;
+        tmp = node->value;   node->value = t->value;  t->value = tmp;
+        ntmp = node->nkey;   node->nkey = t->nkey;  t->nkey = ntmp;
+        node = t;
+    }
+
+    t = CHILD(node, (LEFT_NODE(node) == NULL) ? RIGHT : LEFT);
+    if (depth == 0){
+        self->root = t;
+    } else {
+        CHILD(path[depth - 1], dirs[depth - 1]) = t;
+    }
+    self->size--;
+    self->version++;
+
+    value = node->value;
+    Py_INCREF(value);
+    _avl_fix_path(self, path, dirs, depth);
+    _delete_node(self, node);
+    return value;
+}
+
+
+static int
+_avl_insert(base_tree *self, PyObject *key, PyObject *value){
+
+    PyObject *old_value;
+    node_t *path[AVL_MAX_HEIGHT], *node = self->root;
+    int dirs[AVL_MAX_HEIGHT], depth = 0, cmp_res;
+    probe_t probe;
+    Py_ssize_t version = self->version;
+
+    if (value == NULL){
+        /* del tree[key] */
+        value = _avl_remove(self, key);
+        if (value == NULL)
+            return -1;
+        _release(self, value);
+        return 0;
+    }
+
+    _init_probe(self, key, &probe);
+    while(node != NULL){
+        cmp_res = _compare_probe(self, &probe, node);
+        if (PROBE_ERROR(&probe))
+            return -1;
+        if (self->version != version){
+            /* by the comparison, path is stale */
+            PyErr_SetString(PyExc_RuntimeError,
+                            "tree changed size during insert");
+            return -1;
+        }
+        if (cmp_res == 0){
+            Py_INCREF(value);
+            old_value = node->value;
+            node->value = value;
+            _release(self, old_value);
+            return 0;
+        }
+        path[depth] = node;
+        dirs[depth++] = (cmp_res > 0) ? RIGHT : LEFT;
+        node = CHILD(node, dirs[depth - 1]);
+    }
+
+    node = _new_node(self, key, value);
+    if (node == NULL)
+        return -1;
+    node->xdata = 1;
+    if (depth == 0){
+        self->root = node;
+    } else {
+        CHILD(path[depth - 1], dirs[depth - 1]) = node;
+    }
+    self->size += 1;
+    self->version++;
+    _avl_fix_path(self, path, dirs, depth);
+    return 0;
+}
+
+
+DEFINE_LOCKED(avl_insert, int, -1,
+              (base_tree *self, PyObject *key, PyObject *value),
+              (self, key, value))
+
+
+static PyMappingMethods avltree_as_mapping = {
+    (lenfunc)tree_length,            /*mp_length*/
+    (binaryfunc)tree_subscript,      /*mp_subscript*/
+    (objobjargproc)avl_insert,       /*mp_ass_subscript*/
+};
+
+
+
+
+static PyObject *
+_avl_pop(base_tree *self, PyObject *args){
+    return _pop(self, args, _avl_remove);
+}
+
+
+DEFINE_LOCKED(avl_pop, PyObject *, NULL,
+              (base_tree *self, PyObject *args),
+              (self, args))
+
+
+/* Link nodes[0:n], whose keys are in ascending order, into a perfectly
+ * balanced tree and return its root. The sizes are set, and the heights
+ * as AVLTree wants them, BinaryTree ignores them. The ranges still to link
+ * are on a stack of AVL_MAX_HEIGHT entries, no deeper than the tree. */
+static node_t *
+_build(node_t **nodes, Py_ssize_t n){
+    struct {
+        Py_ssize_t lo, hi;
+        node_t **link;
+    } stack[AVL_MAX_HEIGHT];
+    node_t *root = NULL, *node;
+    Py_ssize_t lo, hi, mid, size;
+    int depth, height;
+
+    stack[0].lo = 0;
+    stack[0].hi = n;
+    stack[0].link = &root;
+    depth = 1;
+    while(depth > 0){
+        depth--;
+        lo = stack[depth].lo;
+        hi = stack[depth].hi;
+        if (lo >= hi){
+            *stack[depth].link = NULL;
+            continue;
+        }
+        mid = lo + (hi - lo) / 2;
+        node = nodes[mid];
+        *stack[depth].link = node;
+
+        /* halving the range, the height is its number of bits */
+        node->count = hi - lo;
+        for(height = 0, size = hi - lo; size > 0; size >>= 1)
+            height++;
+        node->xdata = height;
+
+        stack[depth].lo = mid + 1;
+        stack[depth].hi = hi;
+        stack[depth++].link = &RIGHT_NODE(node);
+        stack[depth].lo = lo;
+        stack[depth].hi = mid;
+        stack[depth++].link = &LEFT_NODE(node);
+    }
+    return root;
+}
+
+
+/* Get the key-value pairs of items, a mapping or an iterable of pairs, as
+ * a new list of 2-tuples. *sorted tells whether the keys are strictly
+ * ascending. */
+static PyObject *
+_get_pairs(PyObject *items, int *sorted){
+    PyObject *list, *pair, *prev = NULL;
+    Py_ssize_t i;
+    int cmp_res;
+
+    if (PyObject_HasAttrString(items, "items")){
+        pair = PyObject_CallMethod(items, "items", NULL);
+        if (pair == NULL)
+            return NULL;
+        list = PySequence_List(pair);
+        Py_DECREF(pair);
+    } else {
+        list = PySequence_List(items);
+    }
+    if (list == NULL)
+        return NULL;
+
+    *sorted = 1;
+    for(i = 0; i < PyList_GET_SIZE(list); i++){
+        pair = PyList_GET_ITEM(list, i);
+        if (!PyTuple_Check(pair)){
+            pair = PySequence_Tuple(pair);
+            if (pair == NULL)
+                goto error;
+            PyList_SetItem(list, i, pair);
+        }
+        if (PyTuple_GET_SIZE(pair) != 2){
+            PyErr_SetString(PyExc_ValueError,
+                            "items must be key-value pairs");
+            goto error;
+        }
+
+        if (prev != NULL && *sorted){
+            cmp_res = _compare(NULL, prev, PyTuple_GET_ITEM(pair, 0));
+            if (cmp_res == 0 && PyErr_Occurred())
+                goto error;
+            *sorted = (cmp_res < 0);
+        }
+        prev = PyTuple_GET_ITEM(pair, 0);
+    }
+    return list;
+
+error:
+    Py_DECREF(list);
+    return NULL;
+}
+
+
+/* Merge pairs, as given by _get_pairs with sorted keys, into the tree and
+ * relink all nodes into a balanced tree, in O(n + m) for n nodes and m
+ * pairs. The nodes are kept, an existing key gets the new value. */
+static int
+_merge_sorted(base_tree *self, PyObject *pairs){
+    Py_ssize_t n = self->size, m = PyList_GET_SIZE(pairs);
+    Py_ssize_t i, j, k, c, depth, created = 0, version = self->version;
+    node_t **merged, **old, **added, *node;
+    Py_ssize_t *match;
+    PyObject **garbage, *pair;
+    int cmp_res;
+
+    merged = PyMem_New(node_t *, 2 * (n + m));
+    match = PyMem_New(Py_ssize_t, m);
+    garbage = PyMem_New(PyObject *, m);
+    if (merged == NULL || match == NULL || garbage == NULL){
+        PyErr_NoMemory();
+        goto error;
+    }
+    old = merged + n + m;
+    added = old + n;
+
+    /* the nodes in order, merged serves as the stack */
+    i = depth = 0;
     node = self->root;
-    while(1){
+    while(node != NULL || depth > 0){
+        if (node != NULL){
+            merged[depth++] = node;
+            node = LEFT_NODE(node);
+        } else {
+            node = merged[--depth];
+            old[i++] = node;
+            node = RIGHT_NODE(node);
+        }
+    }
+
+    /* match[i] is the index of the node of the key of pairs[i], or ~j if
+     * it is a new key coming after the first j nodes */
+    for(i = j = 0; i < m; i++){
+        pair = PyList_GET_ITEM(pairs, i);
+        match[i] = ~n;
+        while(j < n){
+            cmp_res = _compare(self, old[j]->key, PyTuple_GET_ITEM(pair, 0));
+            if (cmp_res == 0 && PyErr_Occurred())
+                goto error;
+            if (self->version != version){
+                /* by the comparison */
+                PyErr_SetString(PyExc_RuntimeError,
+                                "tree changed size during update");
+                goto error;
+            }
+            if (cmp_res >= 0){
+                match[i] = (cmp_res == 0) ? j++ : ~j;
+                break;
+            }
+            j++;
+        }
+        if (match[i] < 0)
+            created++;
+    }
+
+    /* allocate first, so that failing leaves the tree as it was */
+    for(i = k = 0; i < m; i++){
+        if (match[i] >= 0)
+            continue;
+        pair = PyList_GET_ITEM(pairs, i);
+        node = _new_node(self, PyTuple_GET_ITEM(pair, 0),
+                         PyTuple_GET_ITEM(pair, 1));
         if (node == NULL){
-            node = _new_node(key, value);
-            if (node == NULL)
-                return -1;
-            CHILD(p, child) = node;
-            self->size += 1;
-            return 0;
+            /* pairs still holds the keys and values, no code is run */
+            self->size += k;
+            while(k-- > 0){
+                self->size--;
+                _delete_node(self, added[k]);
+            }
+            goto error;
         }
+        added[k++] = node;
+    }
 
-        cmp_res = _compare(key, node->key);
-        if (cmp_res == 0){
-            if (PyErr_Occurred())
-                return -1;
-            Py_INCREF(value);
-            Py_DECREF(node->value);
-            node->value = value;
-            return 0;
+    for(i = j = k = c = 0; i < m; i++){
+        while(j < ((match[i] >= 0) ? match[i] : ~match[i]))
+            merged[k++] = old[j++];
+        if (match[i] >= 0){
+            node = old[j++];
+            garbage[i] = node->value;
+            node->value = PyTuple_GET_ITEM(PyList_GET_ITEM(pairs, i), 1);
+            Py_INCREF(node->value);
+        } else {
+            node = added[c++];
+            garbage[i] = NULL;
         }
-        p = node;
-        child = (cmp_res > 0) ? RIGHT : LEFT;
-        node = CHILD(node, child);
+        merged[k++] = node;
     }
+    while(j < n)
+        merged[k++] = old[j++];
+
+    self->root = _build(merged, k);
+    self->size = k;
+    self->version++;
+
+    /* the tree is complete, the replaced values may run any code */
+    for(i = 0; i < m; i++)
+        _release(self, garbage[i]);
+    PyMem_Free(merged);
+    PyMem_Free(match);
+    PyMem_Free(garbage);
+    return 0;
+
+error:
+    PyMem_Free(merged);
+    PyMem_Free(match);
+    PyMem_Free(garbage);
+    return -1;
 }
 
 
-static PyMappingMethods binarytree_as_mapping = {
-    (lenfunc)tree_length,            /*mp_length*/
-    (binaryfunc)tree_subscript,      /*mp_subscript*/
-    (objobjargproc)binary_insert,    /*mp_ass_subscript*/
-};
+PyDoc_STRVAR(from_sorted__doc__,
+"from_sorted(items) -> new balanced tree of items, a mapping or an\n\
+iterable of key-value pairs whose keys are strictly ascending, in O(n).");
 
+static PyObject *
+tree_from_sorted(PyObject *cls, PyObject *items){
+    PyObject *tree, *pairs;
+    int sorted;
 
-PyDoc_STRVAR(pop__doc__,
-"D.pop(k[,d]) -> v, remove specified key and return the corresponding value.\n\
-If key is not found, d is returned if given, otherwise KeyError is raised");
+    pairs = _get_pairs(items, &sorted);
+    if (pairs == NULL)
+        return NULL;
+    if (!sorted){
+        Py_DECREF(pairs);
+        PyErr_SetString(PyExc_ValueError,
+                        "keys are not in strictly ascending order");
+        return NULL;
+    }
+
+    tree = PyObject_CallObject(cls, NULL);
+    if (tree != NULL && _merge_sorted((base_tree *)tree, pairs) < 0){
+        Py_CLEAR(tree);
+    }
+    Py_DECREF(pairs);
+    return tree;
+}
 
 
+PyDoc_STRVAR(update__doc__,
+"T.update(items) -> None, set the key-value pairs of items, a mapping or\n\
+an iterable of pairs. Strictly ascending keys are merged in O(n + m) if\n\
+they are enough compared to the size of the tree, which is then balanced.");
+
 static PyObject *
-binary_pop(base_tree *self, PyObject *args){
+tree_update(base_tree *self, PyObject *items){
+    PyObject *pairs, *pair;
+    objobjargproc setitem = Py_TYPE(self)->tp_as_mapping->mp_ass_subscript;
+    Py_ssize_t i, m;
+    int sorted, res = 0;
+
+    pairs = _get_pairs(items, &sorted);
+    if (pairs == NULL)
+        return NULL;
+
+    /* m inserts cost about m log n */
+    m = PyList_GET_SIZE(pairs);
+    if (sorted && m > 0 && m * UPDATE_MERGE_RATIO >= self->size){
+        res = _lock(self, 1);
+        if (res == 0){
+            res = _merge_sorted(self, pairs);
+            _unlock(self);
+        }
+    } else {
+        for(i = 0; i < m && res == 0; i++){
+            pair = PyList_GET_ITEM(pairs, i);
+            res = setitem((PyObject *)self, PyTuple_GET_ITEM(pair, 0),
+                          PyTuple_GET_ITEM(pair, 1));
+        }
+    }
+    Py_DECREF(pairs);
+    if (res < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
 
-    PyObject *key, *deflt = NULL;
-    node_t *node = self->root, *p = NULL, *t = NULL, *tp = NULL;
-    int cmp_res, chd;
 
-    if(!PyArg_UnpackTuple(args, "pop", 1, 2, &key, &deflt))
+/* The items are the state, set by update() after the tree is created, so
+ * that a tree may hold itself. */
+static PyObject *
+tree_reduce(base_tree *self){
+    PyObject *items = tree_items(self);
+
+    if (items == NULL)
         return NULL;
+    return Py_BuildValue("O(O)N", (PyObject *)Py_TYPE(self),
+                         self->lock ? Py_True : Py_False, items);
+}
 
-    while (node != NULL) {
-        cmp_res = _compare(key, node->key);
-        if (cmp_res == 0){
-            if (PyErr_Occurred())
-                return NULL;
 
-            /* found */
-            deflt = node->value;
-            self->size --;
+/* header of dump(), followed by the keys, size int64 for int keys or
+ * size + 1 uint64 offsets and the utf-8 data for str keys, then the values
+ * pickled as one list. flags were 0 before TREE_THREADSAFE. */
+typedef struct{
+    char magic[8];
+    uint32_t byte_order;
+    uint32_t version;
+    uint32_t kind;
+    uint32_t flags;
+    uint64_t size;
+    uint64_t keys_len;
+}tree_header;
 
-            if (CHILD(node, LEFT) != NULL && CHILD(node, RIGHT) != NULL ){
-                /* replace node by successor or predecessor in turn */
-                _min_or_max(CHILD(node, self->d_flag), &t, &tp,
-                            1 - self->d_flag);
-                _swap_node_data(node, t);
-                if (tp == NULL){
-                    /* successor or predecessor is direct child */
-                    CHILD(node, self->d_flag) = CHILD(t, self->d_flag);
-                } else {
-                    CHILD(tp, 1 - self->d_flag) = CHILD(t, self->d_flag);;
-                }
-                self->d_flag = 1 - self->d_flag;
-                _delete_node(t);
-            } else {
-                cmp_res = (CHILD(node, LEFT) == NULL) ? RIGHT : LEFT;
-                if (p == NULL){
-                    /* found on root */
-                    self->root = CHILD(node, cmp_res);
-                } else {
-                    CHILD(p, chd) = CHILD(node, cmp_res);
-                }
-                _delete_node(node);
+#define TREE_MAGIC "PYTREE01"
+#define TREE_BYTE_ORDER 0x01020304
+#define TREE_VERSION 1
+#define TREE_THREADSAFE 0x1
+
+
+/* pickle.dumps(obj, -1) or pickle.loads(obj) */
+static PyObject *
+_pickle(const char *method, PyObject *obj){
+    PyObject *pickle, *res;
+
+    pickle = PyImport_ImportModule("pickle");
+    if (pickle == NULL)
+        return NULL;
+    if (method[0] == 'd'){
+        res = PyObject_CallMethod(pickle, method, "Oi", obj, -1);
+    } else {
+        res = PyObject_CallMethod(pickle, method, "O", obj);
+    }
+    Py_DECREF(pickle);
+    return res;
+}
+
+
+PyDoc_STRVAR(dump__doc__,
+"T.dump() -> bytes, a compact image of a tree whose keys are all int\n\
+fitting in 64 bits or all str, the values being pickled. See load().");
+
+static PyObject *
+tree_dump(base_tree *self){
+    PyObject *keys, *values = NULL, *pickled = NULL, *res = NULL;
+    tree_header header;
+    native_key n = {0};
+    Py_ssize_t i, len, size;
+    uint64_t offset;
+    const char *data;
+    char *p;
+
+    /* work on copies, pickling the values may change the tree */
+    if (_lock(self, 0) < 0)
+        return NULL;
+    keys = _get_all(self, KEY);
+    values = (keys == NULL) ? NULL : _get_all(self, VALUE);
+    _unlock(self);
+    if (values == NULL){
+        Py_XDECREF(keys);
+        return NULL;
+    }
+    size = PyList_GET_SIZE(keys);
+
+    memset(&header, 0, sizeof(header));
+    memcpy(header.magic, TREE_MAGIC, sizeof(header.magic));
+    header.byte_order = TREE_BYTE_ORDER;
+    header.version = TREE_VERSION;
+    header.flags = self->lock ? TREE_THREADSAFE : 0;
+    header.kind = (size == 0) ? EMPTY_KEYS
+                              : _key_kind(PyList_GET_ITEM(keys, 0), &n);
+    header.size = size;
+    header.keys_len = (header.kind == STR_KEYS)
+                      ? (size + 1) * sizeof(uint64_t) : size * sizeof(int64_t);
+    for(i = 0; i < size; i++){
+        if (_key_kind(PyList_GET_ITEM(keys, i), &n) != header.kind
+            || (header.kind != INT_KEYS && header.kind != STR_KEYS)){
+            PyErr_SetString(PyExc_TypeError,
+                            "dump() needs keys all int of 64 bits or all str");
+            goto finish;
+        }
+        if (header.kind == STR_KEYS){
+            if (PyUnicode_AsUTF8AndSize(PyList_GET_ITEM(keys, i), &len) == NULL)
+                goto finish;
+            header.keys_len += len;
+        }
+    }
+
+    pickled = _pickle("dumps", values);
+    if (pickled == NULL)
+        goto finish;
+    if (!PyBytes_Check(pickled)){
+        PyErr_SetString(PyExc_TypeError, "pickle.dumps() did not give bytes");
+        goto finish;
+    }
+
+    res = PyBytes_FromStringAndSize(NULL, sizeof(header) + header.keys_len
+                                          + PyBytes_GET_SIZE(pickled));
+    if (res == NULL)
+        goto finish;
+    p = PyBytes_AS_STRING(res);
+    memcpy(p, &header, sizeof(header));
+    p += sizeof(header);
+
+    if (header.kind == INT_KEYS){
+        for(i = 0; i < size; i++){
+            _key_kind(PyList_GET_ITEM(keys, i), &n);
+            memcpy(p, &n.i, sizeof(int64_t));
+            p += sizeof(int64_t);
+        }
+    } else if (header.kind == STR_KEYS){
+        /* offsets in the first round, string data in the second */
+        offset = 0;
+        memcpy(p, &offset, sizeof(uint64_t));
+        p += sizeof(uint64_t);
+        for(i = 0; i < size; i++){
+            PyUnicode_AsUTF8AndSize(PyList_GET_ITEM(keys, i), &len);
+            offset += len;
+            memcpy(p, &offset, sizeof(uint64_t));
+            p += sizeof(uint64_t);
+        }
+        for(i = 0; i < size; i++){
+            data = PyUnicode_AsUTF8AndSize(PyList_GET_ITEM(keys, i), &len);
+            memcpy(p, data, len);
+            p += len;
+        }
+    }
+    memcpy(p, PyBytes_AS_STRING(pickled), PyBytes_GET_SIZE(pickled));
+
+finish:
+    Py_DECREF(keys);
+    Py_DECREF(values);
+    Py_XDECREF(pickled);
+    return res;
+}
+
+
+static uint64_t
+_load_offset(const char *data, Py_ssize_t i){
+    uint64_t offset;
+
+    /* the buffer may not be aligned */
+    memcpy(&offset, data + i * sizeof(uint64_t), sizeof(uint64_t));
+    return offset;
+}
+
+
+/* Decode the keys of a dump() image into pairs with values, checking that
+ * they are strictly ascending. */
+static int
+_load_keys(tree_header *header, const char *data, PyObject *values,
+           PyObject *pairs){
+    Py_ssize_t i, size = (Py_ssize_t)header->size;
+    const char *strings = data + (size + 1) * sizeof(uint64_t);
+    uint64_t begin = 0, end, prev_begin = 0, prev_len = 0, strings_len = 0;
+    int64_t key, prev = 0;
+    PyObject *pair, *obj;
+    int cmp_res;
+
+    if (header->kind == STR_KEYS){
+        strings_len = header->keys_len - (size + 1) * sizeof(uint64_t);
+        if (_load_offset(data, 0) != 0
+            || _load_offset(data, size) != strings_len)
+            goto corrupted;
+    }
+
+    for(i = 0; i < size; i++){
+        if (header->kind == INT_KEYS){
+            memcpy(&key, data + i * sizeof(int64_t), sizeof(int64_t));
+            if (i > 0 && key <= prev)
+                goto corrupted;
+            prev = key;
+            obj = PyLong_FromLongLong(key);
+        } else {
+            end = _load_offset(data, i + 1);
+            if (end < begin || end > strings_len)
+                goto corrupted;
+            /* the order of utf-8 bytes is the order of code points */
+            if (i > 0){
+                cmp_res = memcmp(strings + prev_begin, strings + begin,
+                                 (prev_len < end - begin) ? prev_len
+                                                          : end - begin);
+                if (cmp_res > 0 || (cmp_res == 0 && prev_len >= end - begin))
+                    goto corrupted;
             }
+            obj = PyUnicode_DecodeUTF8(strings + begin, end - begin, NULL);
+            prev_begin = begin;
+            prev_len = end - begin;
+            begin = end;
+        }
+        if (obj == NULL)
+            return -1;
+        pair = PyTuple_Pack(2, obj, PyList_GET_ITEM(values, i));
+        Py_DECREF(obj);
+        if (pair == NULL)
+            return -1;
+        PyList_SET_ITEM(pairs, i, pair);
+    }
+    return 0;
 
-            break;
+corrupted:
+    PyErr_SetString(PyExc_ValueError, "truncated or corrupted tree image");
+    return -1;
+}
+
+
+PyDoc_STRVAR(load__doc__,
+"load(data) -> new tree from a bytes-like image made by dump(), built in\n\
+a single linear pass, thread-safe if the dumped tree was.");
+
+static PyObject *
+tree_load(PyObject *cls, PyObject *arg){
+    PyObject *tree = NULL, *pairs = NULL, *values = NULL, *view;
+    Py_buffer buf;
+    tree_header header;
+
+    if (PyObject_GetBuffer(arg, &buf, PyBUF_SIMPLE) < 0)
+        return NULL;
+
+    if ((size_t)buf.len < sizeof(header)
+        || memcmp(buf.buf, TREE_MAGIC, sizeof(header.magic)) != 0){
+        PyErr_SetString(PyExc_ValueError, "not a tree image");
+        goto finish;
+    }
+    memcpy(&header, buf.buf, sizeof(header));
+    if (header.byte_order != TREE_BYTE_ORDER || header.version != TREE_VERSION){
+        PyErr_SetString(PyExc_ValueError,
+                        "unsupported byte order or version of tree image");
+        goto finish;
+    }
+    if ((header.kind != INT_KEYS && header.kind != STR_KEYS
+         && !(header.kind == EMPTY_KEYS && header.size == 0))
+        || (header.flags & ~TREE_THREADSAFE) != 0
+        || header.keys_len > buf.len - sizeof(header)
+        || header.size > header.keys_len / sizeof(int64_t)
+        || (header.kind == INT_KEYS
+            && header.keys_len != header.size * sizeof(int64_t))
+        || (header.kind == STR_KEYS
+            && header.keys_len < (header.size + 1) * sizeof(uint64_t))){
+        PyErr_SetString(PyExc_ValueError, "truncated or corrupted tree image");
+        goto finish;
+    }
+
+    view = PyMemoryView_FromMemory((char *)buf.buf + sizeof(header)
+                                   + header.keys_len,
+                                   buf.len - sizeof(header) - header.keys_len,
+                                   PyBUF_READ);
+    if (view == NULL)
+        goto finish;
+    values = _pickle("loads", view);
+    Py_DECREF(view);
+    if (values == NULL)
+        goto finish;
+    if (!PyList_CheckExact(values)
+        || PyList_GET_SIZE(values) != (Py_ssize_t)header.size){
+        PyErr_SetString(PyExc_ValueError, "truncated or corrupted tree image");
+        goto finish;
+    }
+
+    pairs = PyList_New(header.size);
+    if (pairs == NULL)
+        goto finish;
+    if (_load_keys(&header, (char *)buf.buf + sizeof(header), values,
+                   pairs) < 0)
+        goto finish;
+
+    /* the keys are in order, the tree is empty: no comparison at all */
+    tree = PyObject_CallFunctionObjArgs(
+        cls, (header.flags & TREE_THREADSAFE) ? Py_True : Py_False, NULL);
+    if (tree != NULL && _merge_sorted((base_tree *)tree, pairs) < 0)
+        Py_CLEAR(tree);
+
+finish:
+    PyBuffer_Release(&buf);
+    Py_XDECREF(pairs);
+    Py_XDECREF(values);
+    return tree;
+}
+
+
+static PyTypeObject BinaryTreeType;
+static PyTypeObject AVLTreeType;
+
+
+/* the items of other, which must be a tree, or NULL with TypeError */
+static PyObject *
+_items_of(PyObject *other){
+    if (!PyObject_TypeCheck(other, &BinaryTreeType)
+        && !PyObject_TypeCheck(other, &AVLTreeType)){
+        PyErr_Format(PyExc_TypeError, "expected a tree, got %.200s",
+                     Py_TYPE(other)->tp_name);
+        return NULL;
+    }
+    return tree_items((base_tree *)other);
+}
+
+
+/* a new tree of the type of self, as thread-safe, of pairs in order */
+static PyObject *
+_new_like(base_tree *self, PyObject *pairs){
+    PyObject *tree;
+
+    tree = PyObject_CallFunctionObjArgs((PyObject *)Py_TYPE(self),
+                                        self->lock ? Py_True : Py_False, NULL);
+    if (tree != NULL && PyList_GET_SIZE(pairs) > 0
+        && _merge_sorted((base_tree *)tree, pairs) < 0){
+        Py_CLEAR(tree);
+    }
+    return tree;
+}
+
+
+PyDoc_STRVAR(merge__doc__,
+"T.merge(other) -> None, set the items of the tree other, an existing key\n\
+getting the value of other, in O(n + m). other is left as it is.");
+
+static PyObject *
+tree_merge(base_tree *self, PyObject *other){
+    PyObject *pairs = _items_of(other);
+    int res = 0;
+
+    if (pairs == NULL)
+        return NULL;
+    if (PyList_GET_SIZE(pairs) > 0){
+        res = _lock(self, 1);
+        if (res == 0){
+            res = _merge_sorted(self, pairs);
+            _unlock(self);
         }
+    }
+    Py_DECREF(pairs);
+    if (res < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
 
-        p = node;
-        chd = (cmp_res > 0) ? RIGHT : LEFT;
-        node = CHILD(node, chd);
+
+PyDoc_STRVAR(split__doc__,
+"T.split(k) -> (new tree of the keys < k, new tree of the keys >= k),\n\
+in O(n). T is left as it is.");
+
+static PyObject *
+tree_split(base_tree *self, PyObject *key){
+    PyObject *pairs, *lower, *upper, *lo_tree = NULL, *hi_tree = NULL;
+    Py_ssize_t lo, hi, mid;
+    int cmp_res;
+
+    pairs = tree_items(self);
+    if (pairs == NULL)
+        return NULL;
+
+    /* bisect_left on the items, which hold their keys */
+    lo = 0;
+    hi = PyList_GET_SIZE(pairs);
+    while(lo < hi){
+        mid = lo + (hi - lo) / 2;
+        cmp_res = _compare(NULL,
+                           PyTuple_GET_ITEM(PyList_GET_ITEM(pairs, mid), 0),
+                           key);
+        if (cmp_res == 0 && PyErr_Occurred()){
+            Py_DECREF(pairs);
+            return NULL;
+        }
+        if (cmp_res < 0){
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
     }
 
-    if (deflt == NULL){
-        _PyErr_SetKeyError(key);
-    } else {
-        Py_INCREF(deflt);
+    lower = PyList_GetSlice(pairs, 0, lo);
+    upper = PyList_GetSlice(pairs, lo, PyList_GET_SIZE(pairs));
+    Py_DECREF(pairs);
+    if (lower != NULL && upper != NULL){
+        lo_tree = _new_like(self, lower);
+        if (lo_tree != NULL)
+            hi_tree = _new_like(self, upper);
+    }
+    Py_XDECREF(lower);
+    Py_XDECREF(upper);
+    if (hi_tree == NULL){
+        Py_XDECREF(lo_tree);
+        return NULL;
+    }
+    return Py_BuildValue("NN", lo_tree, hi_tree);
+}
+
+
+PyDoc_STRVAR(union__doc__,
+"T.union(other) -> new tree of the items of T and of the tree other, an\n\
+existing key getting the value of other, in O(n + m).");
+
+static PyObject *
+tree_union(base_tree *self, PyObject *other){
+    PyObject *pairs, *other_pairs, *tree = NULL;
+
+    other_pairs = _items_of(other);
+    if (other_pairs == NULL)
+        return NULL;
+    pairs = tree_items(self);
+    if (pairs != NULL){
+        tree = _new_like(self, pairs);
+        Py_DECREF(pairs);
+    }
+    if (tree != NULL && PyList_GET_SIZE(other_pairs) > 0
+        && _merge_sorted((base_tree *)tree, other_pairs) < 0){
+        Py_CLEAR(tree);
+    }
+    Py_DECREF(other_pairs);
+    return tree;
+}
+
+
+PyDoc_STRVAR(intersection__doc__,
+"T.intersection(other) -> new tree of the items of T whose key is in the\n\
+tree other, in O(n + m).");
+
+static PyObject *
+tree_intersection(base_tree *self, PyObject *other){
+    PyObject *pairs, *other_pairs, *common, *pair, *tree = NULL;
+    Py_ssize_t i, j, n, m;
+    int cmp_res;
+
+    other_pairs = _items_of(other);
+    if (other_pairs == NULL)
+        return NULL;
+    pairs = tree_items(self);
+    common = PyList_New(0);
+    if (pairs == NULL || common == NULL)
+        goto finish;
+
+    /* both are in order, the lists hold the keys compared */
+    n = PyList_GET_SIZE(pairs);
+    m = PyList_GET_SIZE(other_pairs);
+    for(i = j = 0; i < n && j < m;){
+        pair = PyList_GET_ITEM(pairs, i);
+        cmp_res = _compare(NULL, PyTuple_GET_ITEM(pair, 0),
+                           PyTuple_GET_ITEM(PyList_GET_ITEM(other_pairs, j), 0));
+        if (cmp_res == 0 && PyErr_Occurred())
+            goto finish;
+        if (cmp_res == 0){
+            if (PyList_Append(common, pair) < 0)
+                goto finish;
+            i++;
+            j++;
+        } else if (cmp_res < 0){
+            i++;
+        } else {
+            j++;
+        }
     }
-    return deflt;
+    tree = _new_like(self, common);
+
+finish:
+    Py_DECREF(other_pairs);
+    Py_XDECREF(pairs);
+    Py_XDECREF(common);
+    return tree;
 }
 
 
+#define BULK_METHODS \
+    {"from_sorted", (PyCFunction)tree_from_sorted, METH_O | METH_CLASS, \
+     from_sorted__doc__}, \
+    {"update", (PyCFunction)tree_update, METH_O, \
+     update__doc__}, \
+    {"__reduce__", (PyCFunction)tree_reduce, METH_NOARGS, \
+     "pickle the items in order"}, \
+    {"__setstate__", (PyCFunction)tree_update, METH_O, \
+     "set the pickled items, merged in O(n)"}, \
+    {"dump", (PyCFunction)tree_dump, METH_NOARGS, \
+     dump__doc__}, \
+    {"load", (PyCFunction)tree_load, METH_O | METH_CLASS, \
+     load__doc__}, \
+    {"merge", (PyCFunction)tree_merge, METH_O, \
+     merge__doc__}, \
+    {"split", (PyCFunction)tree_split, METH_O, \
+     split__doc__}, \
+    {"union", (PyCFunction)tree_union, METH_O, \
+     union__doc__}, \
+    {"intersection", (PyCFunction)tree_intersection, METH_O, \
+     intersection__doc__},
+
+
 static PyMethodDef binary_methods[] = {
     {"pop", (PyCFunction)binary_pop, METH_VARARGS,
      pop__doc__},
+    {"clear", (PyCFunction)tree_clear, METH_VARARGS,
+     clear__doc__},
     {"root", (PyCFunction)tree_root, METH_NOARGS,
      "get the value at the root"},
     {"keys", (PyCFunction)tree_keys, METH_NOARGS,
@@ -384,6 +2579,8 @@ static PyMethodDef binary_methods[] = {
      "get the max key-value pair"},
     {"min", (PyCFunction)tree_min, METH_NOARGS,
      "get the min key-value pair"},
+    ITER_METHODS
+    BULK_METHODS
     {NULL}  /* Sentinel */
 };
 
@@ -410,22 +2607,92 @@ static PyTypeObject BinaryTreeType = {
     0,                         /* tp_as_buffer */
     Py_TPFLAGS_DEFAULT |
         Py_TPFLAGS_BASETYPE,   /* tp_flags */
-    "Binary tree",             /* tp_doc */
+    "BinaryTree(threadsafe=False)\n\n"
+    "Binary tree. A thread-safe tree has a reader-writer lock: lookups of\n"
+    "int, float or str keys run without the GIL, changes are exclusive.",
+                               /* tp_doc */
     0,                         /* tp_traverse */
     0,                         /* tp_clear */
     0,                         /* tp_richcompare */
     0,                         /* tp_weaklistoffset */
-    0,                         /* tp_iter */
+    (getiterfunc)tree_iter,    /* tp_iter */
     0,                         /* tp_iternext */
     binary_methods,            /* tp_methods */
     NULL,                      /* tp_members */
-    0,                         /* tp_getset */
+    tree_getset,               /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc)init_tree,       /* tp_init */
+    0,                         /* tp_alloc */
+    PyType_GenericNew,         /* tp_new */
+};
+
+static PyMethodDef avl_methods[] = {
+    {"pop", (PyCFunction)avl_pop, METH_VARARGS,
+     pop__doc__},
+    {"clear", (PyCFunction)tree_clear, METH_VARARGS,
+     clear__doc__},
+    {"root", (PyCFunction)tree_root, METH_NOARGS,
+     "get the value at the root"},
+    {"keys", (PyCFunction)tree_keys, METH_NOARGS,
+     "get all keys "},
+    {"values", (PyCFunction)tree_values, METH_NOARGS,
+     "get all values "},
+    {"items", (PyCFunction)tree_items, METH_NOARGS,
+     "get all key-value pairs"},
+    {"max", (PyCFunction)tree_max, METH_NOARGS,
+     "get the max key-value pair"},
+    {"min", (PyCFunction)tree_min, METH_NOARGS,
+     "get the min key-value pair"},
+    ITER_METHODS
+    BULK_METHODS
+    {NULL}  /* Sentinel */
+};
+
+
+static PyTypeObject AVLTreeType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "tree.AVLTree",            /* tp_name */
+    sizeof(base_tree),         /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)dealloc_tree,  /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    &avltree_as_mapping,       /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT |
+        Py_TPFLAGS_BASETYPE,   /* tp_flags */
+    "AVLTree(threadsafe=False)\n\n"
+    "Self-balancing binary tree, with the interface of BinaryTree.\n"
+    "Insert, pop and lookup are O(log n) whatever the order of keys.", /* tp_doc */
+    0,                         /* tp_traverse */
+    0,                         /* tp_clear */
+    0,                         /* tp_richcompare */
+    0,                         /* tp_weaklistoffset */
+    (getiterfunc)tree_iter,    /* tp_iter */
+    0,                         /* tp_iternext */
+    avl_methods,               /* tp_methods */
+    NULL,                      /* tp_members */
+    tree_getset,               /* tp_getset */
     0,                         /* tp_base */
     0,                         /* tp_dict */
     0,                         /* tp_descr_get */
     0,                         /* tp_descr_set */
     0,                         /* tp_dictoffset */
-    NULL,                      /* tp_init */
+    (initproc)init_tree,       /* tp_init */
     0,                         /* tp_alloc */
     PyType_GenericNew,         /* tp_new */
 };
@@ -446,6 +2713,10 @@ PyInit_tree(void)
 
     if (PyType_Ready(&BinaryTreeType) < 0)
         return NULL;
+    if (PyType_Ready(&AVLTreeType) < 0)
+        return NULL;
+    if (PyType_Ready(&TreeIterType) < 0)
+        return NULL;
 
     EmptyError = PyErr_NewException("tree.Empty", NULL, NULL);
     if (EmptyError == NULL)
@@ -457,6 +2728,8 @@ PyInit_tree(void)
 
     Py_INCREF(&BinaryTreeType);
     PyModule_AddObject(m, "BinaryTree", (PyObject *)&BinaryTreeType);
+    Py_INCREF(&AVLTreeType);
+    PyModule_AddObject(m, "AVLTree", (PyObject *)&AVLTreeType);
     Py_INCREF(EmptyError);
     PyModule_AddObject(m, "Empty", EmptyError);
     return m;